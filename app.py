@@ -1,35 +1,122 @@
-from flask import Flask, render_template, request, make_response, redirect, send_from_directory, url_for, flash,  abort, jsonify
+from flask import Flask, render_template, request, make_response, redirect, send_from_directory, url_for, flash,  abort, jsonify, Response, stream_with_context
 import os
 import threading
 import time
+import json
 
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from simulator import Simulator
+from archive import ArchiveMismatch, MatchArchive
+from simulator import Simulator, VM_STATUS_FAULT, VM_STATUS_TIMEOUT
+from scheduler import ProcessSimulationJob, SimulationJob, SimulationScheduler
+from tournament import Tournament, ROUND_ROBIN, SWISS
+from metrics import METRICS
 
 import logging
 
 class IgnoreSpecificRoutesFilter(logging.Filter):
     def filter(self, record):
         msg = record.getMessage()
-        if "/api/round_info" in msg:
+        if "/api/round_info" in msg or "/api/records" in msg or "/api/metrics" in msg or "/api/profile" in msg:
             return False
         return True
 
 logging.getLogger('werkzeug').addFilter(IgnoreSpecificRoutesFilter())
 
+logger = logging.getLogger(__name__)
 
-SIMULATOR = Simulator(1)
-SIMULATE_START = False
+
+class EventStream:
+    """Server-Sent Events fan-out for the current round.
+
+    Every event is serialized once when it is published; clients only copy
+    the bytes they have not seen yet, so the cost grows with turns and not
+    with clients times poll rate.
+    """
+    KEEPALIVE_SECONDS = 15
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.round = 0
+        self.events: list[bytes] = []
+
+    def reset(self, round: int):
+        with self.cond:
+            self.round = round
+            self.events = []
+            self.cond.notify_all()
+
+    def publish(self, name: str, data):
+        with self.cond:
+            event_id = f"{self.round}:{len(self.events)}"
+            self.events.append(f"id: {event_id}\nevent: {name}\ndata: {json.dumps(data)}\n\n".encode())
+            self.cond.notify_all()
+
+    def follow(self, last_event_id: str | None = None):
+        round, index = self.round, 0
+        if last_event_id:
+            # resume after the last event a reconnecting client saw, if it is still this round
+            seen_round, _, seen_index = last_event_id.partition(":")
+            if seen_round == str(round) and seen_index.isdigit():
+                index = int(seen_index) + 1
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: len(self.events) > index or self.round != round,
+                                   timeout=self.KEEPALIVE_SECONDS)
+                if self.round != round:
+                    round, index = self.round, 0
+                batch = self.events[index:]
+                index += len(batch)
+            yield b"".join(batch) if batch else b": keepalive\n\n"
+
+
+STREAM = EventStream()
+# SIMULATOR is the round being shown; CHECKER only parses uploads, since a round
+# played in another process has no VM on this side.
+# These, SCHEDULER and ARCHIVE are built by init_app(), not on import: spawned
+# round processes and tournament workers import this module again as __mp_main__
+# and must not load a VM, start a scheduler thread or open the archive
+CHECKER: Simulator | None = None
+SIMULATOR: Simulator | None = None
+# KOH_SIMULATOR_PROCESS=1 plays rounds in a worker process, see ProcessSimulationJob
+SIMULATOR_PROCESS = os.environ.get("KOH_SIMULATOR_PROCESS") == "1"
+SCHEDULER: SimulationScheduler | None = None
+CURRENT_JOB: SimulationJob | None = None
 ROUND_DURATION = 300
 ROUND_START_TIME = None
 NOW_ROUND = 0
+# rounds are numbered when requested, NOW_ROUND follows the one being played
+NEXT_ROUND = 0
+ROUND_LOCK = threading.Lock()
 STORED_SCRIPT = "ret #0"
+MAX_SCRIPT_SIZE = 100 * 1024
+# the offline tournament, one at a time: state, games played and the final leaderboard
+TOURNAMENT = {"state": "idle"}
+TOURNAMENT_LOCK = threading.Lock()
+# finished rounds are archived by their inputs and replayed on demand, see archive.py;
+# <round>.koh binary replays from before the archive are still served
+REPLAY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "replays")
+ARCHIVE: MatchArchive | None = None
 
 app = Flask(__name__)
 app.secret_key = os.urandom(32)
 
+
+def init_app() -> Flask:
+    """Build the web process's state once and return the app,
+    e.g. `flask --app "app:init_app()" run`."""
+    global CHECKER, SIMULATOR, SCHEDULER, ARCHIVE, NEXT_ROUND
+    if SCHEDULER is None:
+        CHECKER = SIMULATOR = Simulator(1)
+        # one round runs at a time, at most a few more wait behind it
+        SCHEDULER = SimulationScheduler(workers=1, max_queued=4)
+        ARCHIVE = MatchArchive(os.path.join(REPLAY_DIR, "archive.koha"), writable=True)
+        # round numbers key the archive, so they carry on from the last archived round
+        NEXT_ROUND = max(ARCHIVE.matches, default=0)
+    return app
+
+
 @app.route("/")
 def root():
     return render_template("game.html")
@@ -49,32 +136,87 @@ def round_timer():
         "elapsed_seconds": int(elapsed),
         "remaining_seconds": int(remaining),
         "expired": elapsed >= ROUND_DURATION,
-        "simulate_finished": SIMULATOR.finished
+        "simulate_finished": CURRENT_JOB.state == SimulationJob.FINISHED,
+        "simulate_state": CURRENT_JOB.state,
+        "queued_rounds": [job.round for job in SCHEDULER.pending() if job.state == SimulationJob.QUEUED]
     })
 
 @app.route("/get_map")
 def get_map():
     return jsonify(SIMULATOR.map)
 
+# the dumps below read SIMULATOR.published, the snapshot of the last finished turn,
+# so they never see a turn half played and serialize once per turn
 @app.route("/get_scores")
 def get_scores():
-    return jsonify(SIMULATOR.dump_scores())
+    res = make_response(SIMULATOR.published.json("scores"))
+    res.headers['Content-Type'] = "application/json"
+    return res
 
 @app.route("/get_character_records")
 def get_character_records():
-    res = make_response(SIMULATOR.dump_character_records())
+    res = make_response(SIMULATOR.published.json("character_records"))
     res.headers['Content-Type'] = "application/json"
     return res
 
 @app.route("/get_chest_records")
 def get_chest_records():
-    res = make_response(SIMULATOR.dump_chest_records())
+    res = make_response(SIMULATOR.published.json("chest_records"))
     res.headers['Content-Type'] = "application/json"
     return res
 
 @app.route("/get_score_records")
 def get_score_records():
-    res = make_response(SIMULATOR.dump_score_records())
+    res = make_response(SIMULATOR.published.json("score_records"))
+    res.headers['Content-Type'] = "application/json"
+    return res
+
+@app.route("/api/stream")
+def stream():
+    res = Response(stream_with_context(STREAM.follow(request.headers.get("Last-Event-ID"))),
+                   mimetype="text/event-stream")
+    res.headers['Cache-Control'] = "no-cache"
+    res.headers['X-Accel-Buffering'] = "no"
+    return res
+
+@app.route("/api/replay.bin")
+def get_replay():
+    round = request.args.get("round", default=NOW_ROUND, type=int)
+    path = os.path.join(REPLAY_DIR, f"{round}.koh")
+    if round == NOW_ROUND:
+        data = SIMULATOR.published.dump_replay()
+    elif ARCHIVE.get(round) is not None:
+        try:
+            data = ARCHIVE.replay(round)
+        except ArchiveMismatch as e:
+            app.logger.error("%s", e)
+            return f"Round {round} can no longer be replayed", 410
+    elif os.path.exists(path):
+        with open(path, "rb") as f:
+            data = f.read()
+    else:
+        abort(404)
+    res = make_response(data)
+    res.mimetype = "application/octet-stream"
+    return res
+
+@app.route("/api/archive")
+def get_archive():
+    """Every archived round with its map and final scores, oldest first."""
+    return jsonify([match.summary() for match in ARCHIVE.rounds()])
+
+@app.route("/api/metrics")
+def get_metrics():
+    res = make_response(METRICS.render())
+    res.mimetype = "text/plain; version=0.0.4"
+    return res
+
+@app.route("/api/records")
+def get_records():
+    snapshot = SIMULATOR.published
+    # clamped before it becomes a cache key
+    since = max(0, min(request.args.get("since", 0, type=int), snapshot.turn))
+    res = make_response(snapshot.json("records_since", since))
     res.headers['Content-Type'] = "application/json"
     return res
 
@@ -82,20 +224,17 @@ def get_score_records():
 @app.route("/uploads", methods=["GET", "POST"])
 def uploads():
     global STORED_SCRIPT
-    global SIMULATE_START
 
-    MAX_SIZE = 100 * 1024
     if request.method == "POST":
-        SIMULATE_START = False
         file = request.files.get("file")
         if file:
             try:
                 content = file.read()
-                if len(content) > MAX_SIZE:
+                if len(content) > MAX_SCRIPT_SIZE:
                     return "File too large! Maximum 100 KB allowed.", 400
 
                 file_content = content.decode("utf-8", errors="ignore")
-                success, line = SIMULATOR.check_script(file_content)
+                success, line = CHECKER.check_script(file_content)
                 msg = None
                 if success:
                     STORED_SCRIPT = file_content
@@ -109,35 +248,143 @@ def uploads():
     return render_template("uploads.html", latest_script=STORED_SCRIPT)
 
 
-@app.route("/start_simulate")
-def start_simulate():
-    global SIMULATOR, ROUND_START_TIME
+def profile_report(team: dict) -> dict:
+    """One team of dump_profile() laid out for profile.html: every source line with its hits,
+    and per turn the fuel and time of the team's most expensive fork."""
+    hits = dict(team["lines"])
+    total = team["instructions"] or 1
+    # parse_opcode numbers lines from 1, splitting on newlines only
+    lines = [{"number": number, "text": text, "hits": hits.get(number, 0), "share": hits.get(number, 0) / total}
+             for number, text in enumerate(team["script"].split("\n"), 1)]
+    runs = team["runs"]
+    turns = {}
+    for turn, steps, status, nanos in zip(runs["turn"], runs["steps"], runs["status"], runs["nanos"]):
+        row = turns.setdefault(turn, {"turn": turn, "forks": 0, "steps": 0, "ms": 0.0, "timeouts": 0, "faults": 0})
+        row["forks"] += 1
+        row["steps"] = max(row["steps"], steps)
+        row["ms"] = max(row["ms"], nanos / 1e6)
+        row["timeouts"] += status == VM_STATUS_TIMEOUT
+        row["faults"] += status == VM_STATUS_FAULT
+    return {
+        "team": team["team"],
+        "instructions": team["instructions"],
+        "budget": team["budget"],
+        "runs": len(runs["turn"]),
+        "timeouts": runs["status"].count(VM_STATUS_TIMEOUT),
+        "faults": runs["status"].count(VM_STATUS_FAULT),
+        # falling off the end of the script
+        "end_hits": hits.get(0, 0),
+        "lines": lines,
+        "hot": sorted((line for line in lines if line["hits"]), key=lambda line: -line["hits"])[:10],
+        "turns": sorted(turns.values(), key=lambda turn: turn["turn"]),
+    }
+
+
+@app.route("/api/profile")
+def get_profile():
+    """The current round's profile, see Simulator.dump_profile. Empty unless the round
+    was started with /start_simulate?profile=1 (in a worker process: until it finishes)."""
+    return jsonify(SIMULATOR.dump_profile())
+
+
+@app.route("/profile")
+def profile():
+    teams = [profile_report(team) for team in SIMULATOR.dump_profile()]
+    return render_template("profile.html", teams=teams, round=NOW_ROUND)
+
+
+@app.route("/api/tournament", methods=["GET", "POST"])
+def tournament():
+    """POST script files as `files` (and optionally format, rounds, size, seeds, turns) to start a
+    tournament on a process pool, GET its progress and leaderboard."""
+    global TOURNAMENT
+    if request.method == "GET":
+        return jsonify(TOURNAMENT)
+
+    names, scripts = [], []
+    for file in request.files.getlist("files"):
+        content = file.read()
+        if len(content) > MAX_SCRIPT_SIZE:
+            return jsonify({"error": f"{file.filename}: file too large, maximum 100 KB"}), 400
+        script = content.decode("utf-8", errors="ignore")
+        success, line = CHECKER.check_script(script)
+        if not success:
+            return jsonify({"error": f"{file.filename}: script parse error at line '{line}'"}), 400
+        names.append(file.filename)
+        scripts.append(script)
+    format = request.form.get("format", ROUND_ROBIN)
+    if format not in (ROUND_ROBIN, SWISS):
+        return jsonify({"error": f"format must be {ROUND_ROBIN} or {SWISS}"}), 400
+    rounds = request.form.get("rounds", None, type=int)
+    try:
+        runner = Tournament(names, scripts, size=request.form.get("size", 2, type=int),
+                            seeds=request.form.get("seeds", 1, type=int),
+                            turns=request.form.get("turns", 200, type=int))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    with TOURNAMENT_LOCK:
+        if TOURNAMENT["state"] == "running":
+            return jsonify({"error": "a tournament is already running"}), 503
+        state = {"state": "running", "format": format, "scripts": names, "games_played": 0, "leaderboard": None}
+        TOURNAMENT = state
+
+    def run():
+        try:
+            state["leaderboard"] = runner.run(format, rounds,
+                                              progress=lambda played: state.update(games_played=played))
+            state["state"] = "finished"
+        except Exception as e:
+            state["error"] = str(e)
+            state["state"] = "failed"
+    threading.Thread(target=run, daemon=True).start()
+    return jsonify(state)
+
+
+def start_round(job: SimulationJob):
+    """Runs on the scheduler worker when the job leaves the queue: make it the round everyone sees."""
+    global SIMULATOR, ROUND_START_TIME, NOW_ROUND, CURRENT_JOB
+    NOW_ROUND = job.round
+    SIMULATOR = job.simulator
+    CURRENT_JOB = job
+    # last: round_timer takes a start time to mean CURRENT_JOB is set
     ROUND_START_TIME = time.time()
-    print(f"== Start to Simulator ==")
-    # initialize
-    SIMULATOR = Simulator(1)
-    SIMULATOR.finished = False
-
-    def simulate_all(sim: Simulator, total_rounds=200):
-        global SIMULATE_START
-        for i in range(total_rounds):
-            SIMULATOR.simulate()
-        SIMULATOR.finished = True
-    SIMULATOR.players[0].script = STORED_SCRIPT
-    
-    # simulate it
-    t = threading.Thread(target=simulate_all, args=(SIMULATOR,), daemon=True)
-    t.start()
+    logger.info("round %d started", job.round)
+    STREAM.reset(job.round)
+    STREAM.publish("round_start", {"round": job.round, "team_num": job.simulator.team_num})
+    job.simulator.listeners.append(lambda event: STREAM.publish("turn", event))
+
+def finish_round(job: SimulationJob):
+    ARCHIVE.add(job.round, job.inputs(), job.simulator.dump_replay())
+    STREAM.publish("round_finish", {"round": job.round, "scores": job.simulator.dump_scores()})
+
 
+@app.route("/start_simulate")
+def start_simulate():
+    global NEXT_ROUND
+    # ?profile=1 counts every instruction and times every fork, see /profile
+    profile = request.args.get("profile", "0") == "1"
+    with ROUND_LOCK:
+        if SIMULATOR_PROCESS:
+            job = ProcessSimulationJob(NEXT_ROUND + 1, 1, [STORED_SCRIPT], turns=200,
+                                       on_start=start_round, on_finish=finish_round, profile=profile)
+        else:
+            sim = Simulator(1, profile=profile)
+            sim.players[0].script = STORED_SCRIPT
+            job = SimulationJob(NEXT_ROUND + 1, sim, turns=200, on_start=start_round, on_finish=finish_round)
+        # a new round replaces the ones before it, they stop at their next turn
+        if not SCHEDULER.submit(job, supersede=True):
+            job.simulator.close()
+            return "Too many simulations queued, try again later", 503
+        NEXT_ROUND = job.round
     return f"Start simulation"
 
 @app.route("/kill_simulation")
 def kill_simulate():
-    global SIMULATE_START
-    SIMULATE_START = False
+    SCHEDULER.cancel_all()
     return "killed simulation"
 
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=48763, debug=False)
+    init_app().run(host="0.0.0.0", port=48763, debug=False)
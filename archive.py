@@ -0,0 +1,238 @@
+import collections
+import hashlib
+import os
+import struct
+import threading
+
+from mapstore import MAPS, MapStore
+from metrics import Metrics
+from replay import MatchRecord
+from simulator import Simulator
+
+'''
+Archive of finished rounds, kept as the inputs that determine them.
+
+A round is a function of its seed (which also picks the map), scripts,
+instruction budget and turn count, so the archive stores those plus a
+digest of the replay instead of the replay itself. replay() plays the
+round again and serves it only if the digest matches.
+
+Append-only log, little-endian:
+
+    header   "KOHA", u16 version, u16 reserved
+    entries  u32 length, then one entry of that many bytes:
+        script  u8 kind (0), 32-byte sha256, UTF-8 script
+                once per distinct script, before the first match using it
+        match   u8 kind (1), i64 seed, u32 round, u32 instruction budget,
+                u32 turns, u16 team_num, 16-byte replay digest,
+                team_num script sha256s, int32[team_num] final scores,
+                UTF-8 map name
+
+An entry cut short while it was appended is dropped when the log is loaded.
+'''
+ARCHIVE_MAGIC = b"KOHA"
+ARCHIVE_VERSION = 1
+HEADER = struct.Struct("<4sHH")
+LENGTH = struct.Struct("<I")
+MATCH = struct.Struct("<BqIIIH16s")
+
+ENTRY_SCRIPT = 0
+ENTRY_MATCH = 1
+
+# rebuilt replays kept in memory, by total size
+DEFAULT_CACHE_BYTES = 16 << 20
+
+
+def replay_digest(replay: bytes) -> bytes:
+    return hashlib.blake2b(replay, digest_size=16).digest()
+
+
+class ArchiveMismatch(Exception):
+    """A rebuilt round differs from the one archived: the simulator, the VM or the maps changed since."""
+
+
+class MatchInputs:
+    """Everything a round depends on besides its length."""
+    def __init__(self, seed: int, instruction_budget: int, map_name: str, scripts: list[str]):
+        self.seed = seed
+        self.instruction_budget = instruction_budget
+        self.map_name = map_name
+        # in team order
+        self.scripts = scripts
+
+    @classmethod
+    def of(cls, sim: Simulator) -> "MatchInputs":
+        return cls(sim.seed, sim.instruction_budget, sim.game_map.name, [player.script for player in sim.players])
+
+
+class ArchivedMatch:
+    def __init__(self, round: int, inputs: MatchInputs, turns: int, scores: list[int], digest: bytes):
+        self.round = round
+        self.inputs = inputs
+        self.turns = turns
+        self.scores = scores
+        self.digest = digest
+
+    def summary(self) -> dict:
+        return {
+            "round": self.round,
+            "map": self.inputs.map_name,
+            "turns": self.turns,
+            "scores": {team: score for team, score in enumerate(self.scores, 1)},
+        }
+
+
+class MatchArchive:
+    """Finished rounds by number, stored as inputs and rebuilt on demand.
+
+    Rebuilt replays stay in an LRU bounded by their total size, so a round
+    that is being watched is only played once. Rebuilds run one at a time
+    on the caller's thread; a caller that waited for another rebuild of the
+    same round finds it in the cache.
+
+    Only the process that appends to the log opens it writable; readers
+    never touch the file, so they cannot cut off an entry being appended.
+    """
+    def __init__(self, path: str, cache_bytes: int = DEFAULT_CACHE_BYTES, maps: MapStore = MAPS,
+                 writable: bool = False):
+        self.path = path
+        self.writable = writable
+        self.cache_bytes = cache_bytes
+        self.maps = maps
+        # guards the index, the log and the cache
+        self.lock = threading.Lock()
+        self.rebuild_lock = threading.Lock()
+        # sha256 -> script, shared by every match that played it
+        self.scripts: dict[bytes, str] = {}
+        self.matches: dict[int, ArchivedMatch] = {}
+        # round -> replay, least recently used first
+        self.cache: collections.OrderedDict[int, bytes] = collections.OrderedDict()
+        self.cached_bytes = 0
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        magic, version, _ = HEADER.unpack_from(data)
+        if magic != ARCHIVE_MAGIC or version != ARCHIVE_VERSION:
+            raise ValueError(f"{self.path}: not a match archive")
+        offset = HEADER.size
+        while offset + LENGTH.size <= len(data):
+            (length,) = LENGTH.unpack_from(data, offset)
+            end = offset + LENGTH.size + length
+            if end > len(data):
+                break
+            self.read_entry(data[offset + LENGTH.size:end])
+            offset = end
+        if offset != len(data) and self.writable:
+            # a torn last entry, appending after it would hide every later one
+            with open(self.path, "r+b") as f:
+                f.truncate(offset)
+
+    def read_entry(self, entry: bytes):
+        if entry[0] == ENTRY_SCRIPT:
+            self.scripts[entry[1:33]] = entry[33:].decode()
+            return
+        _, seed, round, instruction_budget, turns, team_num, digest = MATCH.unpack_from(entry)
+        offset = MATCH.size
+        hashes = [entry[offset + 32 * i:offset + 32 * (i + 1)] for i in range(team_num)]
+        offset += 32 * team_num
+        scores = list(struct.unpack_from(f"<{team_num}i", entry, offset))
+        map_name = entry[offset + 4 * team_num:].decode()
+        inputs = MatchInputs(seed, instruction_budget, map_name, [self.scripts[h] for h in hashes])
+        self.matches[round] = ArchivedMatch(round, inputs, turns, scores, digest)
+
+    def add(self, round: int, inputs: MatchInputs, replay: bytes) -> ArchivedMatch:
+        """Archive a finished round given its inputs and the replay it produced.
+        Raises ValueError if the round is already archived, entries are never replaced."""
+        if not self.writable:
+            raise PermissionError(f"{self.path}: archive opened read-only")
+        record = MatchRecord.from_buffer(replay)
+        match = ArchivedMatch(round, inputs, record.turns, list(record.scores[-record.team_num:]),
+                              replay_digest(replay))
+        hashes = [hashlib.sha256(script.encode()).digest() for script in inputs.scripts]
+        entries = []
+        with self.lock:
+            if round in self.matches:
+                raise ValueError(f"round {round} is already archived")
+            for script_hash, script in zip(hashes, inputs.scripts):
+                if script_hash not in self.scripts:
+                    self.scripts[script_hash] = script
+                    entries.append(bytes([ENTRY_SCRIPT]) + script_hash + script.encode())
+            entries.append(MATCH.pack(ENTRY_MATCH, inputs.seed, round, inputs.instruction_budget, match.turns,
+                                      len(inputs.scripts), match.digest)
+                           + b"".join(hashes)
+                           + struct.pack(f"<{len(match.scores)}i", *match.scores)
+                           + inputs.map_name.encode())
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, "ab") as f:
+                if f.tell() == 0:
+                    f.write(HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, 0))
+                f.write(b"".join(LENGTH.pack(len(entry)) + entry for entry in entries))
+            self.matches[round] = match
+            # just played, the likeliest to be watched next
+            self.remember(round, replay)
+        return match
+
+    def get(self, round: int) -> ArchivedMatch | None:
+        return self.matches.get(round)
+
+    def rounds(self) -> list[ArchivedMatch]:
+        with self.lock:
+            return sorted(self.matches.values(), key=lambda match: match.round)
+
+    def replay(self, round: int) -> bytes:
+        """The binary replay of an archived round, rebuilt if it is not cached.
+        Raises KeyError for rounds not in the archive and ArchiveMismatch if the rebuild diverges."""
+        replay = self.cached(round)
+        if replay is not None:
+            return replay
+        match = self.matches[round]
+        with self.rebuild_lock:
+            replay = self.cached(round)
+            if replay is None:
+                replay = self.rebuild(match)
+                with self.lock:
+                    self.remember(round, replay)
+        return replay
+
+    def rebuild(self, match: ArchivedMatch) -> bytes:
+        inputs = match.inputs
+        # no checkpoints, and counters of its own so live metrics only count live rounds
+        sim = Simulator(len(inputs.scripts), instruction_budget=inputs.instruction_budget, seed=inputs.seed,
+                        metrics=Metrics(), maps=self.maps, checkpoint_interval=0)
+        try:
+            if sim.game_map.name != inputs.map_name:
+                raise ArchiveMismatch(f"round {match.round} was played on {inputs.map_name}, "
+                                      f"its seed now picks {sim.game_map.name}")
+            for team, script in enumerate(inputs.scripts, 1):
+                sim.set_script(team, script)
+            for _ in range(match.turns):
+                sim.simulate()
+            replay = sim.dump_replay()
+        finally:
+            sim.close()
+        if replay_digest(replay) != match.digest:
+            raise ArchiveMismatch(f"round {match.round} does not replay to the archived digest")
+        return replay
+
+    def cached(self, round: int) -> bytes | None:
+        with self.lock:
+            replay = self.cache.get(round)
+            if replay is not None:
+                self.cache.move_to_end(round)
+            return replay
+
+    def remember(self, round: int, replay: bytes):
+        """Cache a replay, evicting the least recently used ones over cache_bytes. Needs self.lock."""
+        if len(replay) > self.cache_bytes:
+            return
+        old = self.cache.pop(round, None)
+        if old is not None:
+            self.cached_bytes -= len(old)
+        self.cache[round] = replay
+        self.cached_bytes += len(replay)
+        while self.cached_bytes > self.cache_bytes:
+            _, evicted = self.cache.popitem(last=False)
+            self.cached_bytes -= len(evicted)
@@ -0,0 +1,245 @@
+'''
+Throughput benchmarks for the VM and the simulator.
+
+    python bench.py                      run everything and print seconds per op
+    python bench.py --save               also store the results as the baseline
+    python bench.py --check              exit 1 if anything is slower than the baseline
+                                         by more than --threshold (default 20%)
+    python bench.py -k simulate          only benchmarks whose name contains "simulate"
+
+Each benchmark reports the best of --repeat timed runs, which is the
+least noisy estimate on a shared machine. Baselines are per machine, so
+record one before changing vm/vm.cpp or simulator.py and check against it after.
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from ctypes import *
+
+from simulator import Simulator, Chest, VM_Character, VM_Chest, VM_Buffer
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+COMPUTE_SCRIPT = """
+mov 0 #0
+mov 1 #1
+$loop:
+inc 0
+add 1 0
+mul 1 #3
+shr 1 #1
+and 1 #65535
+jg 0 #50000 $done
+je 0 0 $loop
+$done:
+ret #0
+"""
+
+LOCATE_SCRIPT = """
+mov 0 #0
+$loop:
+inc 0
+locate_nearest_k_chest 10 #0
+locate_nearest_k_character 13 #0
+locate_nearest_k_character 16 #3
+load_map 20 10 11
+jg 0 #2000 $done
+je 0 0 $loop
+$done:
+ret #0
+"""
+
+HUNT_SCRIPT = """
+inc 0
+mov 1 0
+and 1 #7
+je 1 #0 $attack
+je 1 #1 $fork
+locate_nearest_k_chest 10 #0
+je 10 #-1 $attack
+load_loc 20
+jg 10 20 $right
+jg 20 10 $left
+jg 11 21 $down
+jg 21 11 $up
+ret #5
+$attack:
+ret #6
+$fork:
+ret #7
+$right:
+ret #4
+$left:
+ret #3
+$down:
+ret #2
+$up:
+ret #1
+"""
+
+
+def sized_script(size: int) -> str:
+    """A script of roughly `size` bytes, made of compute blocks with their own labels."""
+    blocks = []
+    length = 0
+    while length < size:
+        i = len(blocks)
+        block = f"$l{i}:\ninc 0\nadd 1 0\nmul 1 #3\nshr 1 #1\njg 0 #{i} $l{i}\n"
+        blocks.append(block)
+        length += len(block)
+    return "".join(blocks) + "ret #0\n"
+
+
+def play(sim: Simulator, turns: int):
+    for _ in range(turns):
+        sim.simulate()
+
+
+def new_match(teams: int, seed: int = 1) -> Simulator:
+    sim = Simulator(teams, seed=seed)
+    for i in range(1, teams + 1):
+        sim.set_script(i, HUNT_SCRIPT)
+    return sim
+
+
+def bench_parse(size: int):
+    sim = Simulator(1, seed=0)
+    script = sized_script(size).encode()
+    error_line = c_int(0)
+    def run():
+        if not sim.vm.vm_parse_script(script, pointer(error_line)):
+            raise RuntimeError(f"benchmark script does not parse (line {error_line.value})")
+    return run, sim.close
+
+
+def bench_vm_run(script: str):
+    # a mid-game world: 8 teams after 50 turns, with forks and chests around
+    sim = new_match(8)
+    play(sim, 50)
+    forks = [fork for player in sim.players for fork in player.forks]
+    characters = (POINTER(VM_Character) * len(forks))(*[pointer(fork.vm_char) for fork in forks])
+    chests = (POINTER(VM_Chest) * len(sim.chests))(*[pointer(chest.vm_chest) for chest in sim.chests.values()])
+    buffer = VM_Buffer()
+    code = script.encode()
+    def run():
+        sim.vm.vm_run(1, code, cast(pointer(buffer), POINTER(c_uint)),
+                      characters, len(forks), chests, len(sim.chests),
+                      sim.turnmap, 0, forks[0].vm_char, 0)
+    return run, sim.close
+
+
+def bench_simulate(teams: int, turns: int = 20):
+    # plays `turns` turns per call and starts a new match every 200 turns,
+    # so the average covers a whole round
+    sims = [new_match(teams, seed=0)]
+    def run():
+        if sims[-1].turn >= 200:
+            sims.append(new_match(teams, seed=len(sims)))
+        play(sims[-1], turns)
+    def close():
+        for sim in sims:
+            sim.close()
+    return run, close
+
+
+def bench_challenge(generator):
+    rng = random.Random(0)
+    return (lambda: generator(rng)), None
+
+
+def bench_dump_character_records():
+    sim = new_match(8)
+    play(sim, 200)
+    return sim.dump_character_records, sim.close
+
+
+# name -> (setup, ops per call, unit), setup returns (callable, cleanup or None)
+BENCHMARKS = {
+    "vm_parse_script_1kb": (lambda: bench_parse(1_000), 1, "parse"),
+    "vm_parse_script_10kb": (lambda: bench_parse(10_000), 1, "parse"),
+    "vm_parse_script_100kb": (lambda: bench_parse(100_000), 1, "parse"),
+    "vm_run_compute": (lambda: bench_vm_run(COMPUTE_SCRIPT), 1, "run"),
+    "vm_run_locate": (lambda: bench_vm_run(LOCATE_SCRIPT), 1, "run"),
+    "simulate_1_team": (lambda: bench_simulate(1), 20, "turn"),
+    "simulate_8_teams": (lambda: bench_simulate(8), 20, "turn"),
+    "simulate_64_teams": (lambda: bench_simulate(64), 20, "turn"),
+    **{f"chal_{generator.__name__}": ((lambda generator=generator: bench_challenge(generator)), 1, "challenge")
+       for generator in Chest.CHALS},
+    "dump_character_records_200_turns": (bench_dump_character_records, 1, "dump"),
+}
+
+
+def measure(setup, ops: int, repeat: int, min_time: float) -> float:
+    """Best seconds per op over `repeat` runs of at least `min_time` seconds each."""
+    run, cleanup = setup()
+    try:
+        run()
+        # calibrate so that one timed run takes at least min_time
+        calls = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(calls):
+                run()
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+            calls *= 2 if elapsed == 0 else max(2, int(min_time / elapsed * 1.2))
+        best = elapsed
+        for _ in range(repeat - 1):
+            start = time.perf_counter()
+            for _ in range(calls):
+                run()
+            best = min(best, time.perf_counter() - start)
+        return best / (calls * ops)
+    finally:
+        if cleanup:
+            cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the VM and the simulator.")
+    parser.add_argument("-k", dest="filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per timed run")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="write the results to the baseline file")
+    parser.add_argument("--check", action="store_true", help="fail on regressions against the baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown, 0.2 = 20%%")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.check:
+        if not os.path.exists(args.baseline):
+            sys.exit(f"no baseline at {args.baseline}, run with --save first")
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    regressions = []
+    for name, (setup, ops, unit) in BENCHMARKS.items():
+        if args.filter not in name:
+            continue
+        seconds = measure(setup, ops, args.repeat, args.min_time)
+        results[name] = {"seconds": seconds, "unit": unit}
+        line = f"{name:40} {seconds * 1e6:14.2f} us/{unit}"
+        if name in baseline:
+            change = seconds / baseline[name]["seconds"] - 1
+            line += f"  {change:+7.1%}"
+            if change > args.threshold:
+                regressions.append(name)
+                line += "  REGRESSION"
+        print(line, flush=True)
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump({"threshold": args.threshold, "results": results}, f, indent=2, sort_keys=True)
+    if regressions:
+        sys.exit(f"{len(regressions)} benchmark(s) slower than baseline by more than {args.threshold:.0%}: "
+                 + ", ".join(regressions))
+
+
+if __name__ == "__main__":
+    main()
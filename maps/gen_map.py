@@ -1,33 +1,108 @@
-import random
+import argparse
+import functools
+import multiprocessing
 import os
+import random
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from mapstore import MAP_SIZE, PATH, WALL, label_components, write_pack
+
+WALL_RATIO = 0.12
+# a seed that keeps producing disconnected floors is a bug, not bad luck
+MAX_ATTEMPTS = 1000
+# grid cells -> map_NN.txt characters
+TEXT_CELLS = bytes.maketrans(bytes([PATH, WALL]), b".#")
 
-def generate_map(width=50, height=50, wall_ratio=0.12):
-    grid = [['.' for _ in range(width)] for _ in range(height)]
-    wall_count = int(width * height * wall_ratio)
+
+def generate_map(rng: random.Random, wall_ratio=WALL_RATIO) -> bytearray:
+    """Row-major MAP_SIZE x MAP_SIZE grid of straight wall clusters, exactly int(cells * wall_ratio) walls."""
+    grid = bytearray(MAP_SIZE * MAP_SIZE)
+    wall_count = int(MAP_SIZE * MAP_SIZE * wall_ratio)
     added = 0
 
     while added < wall_count:
-        cluster_len = random.randint(5, 20)
-        thick = 1 if random.random() < 0.8 else random.randint(2, 4)
-        horizontal = random.choice([True, False])
-        x = random.randint(0, width - (cluster_len if horizontal else thick))
-        y = random.randint(0, height - (thick if horizontal else cluster_len))
-
-        for dy in range(thick):
-            for dx in range(cluster_len):
-                cx = x + dx if horizontal else x + dy
-                cy = y + dy if horizontal else y + dx
-                if 0 <= cx < width and 0 <= cy < height and grid[cy][cx] == '.':
-                    grid[cy][cx] = '#'
+        cluster_len = rng.randint(5, 20)
+        thick = 1 if rng.random() < 0.8 else rng.randint(2, 4)
+        horizontal = rng.choice([True, False])
+        x = rng.randint(0, MAP_SIZE - (cluster_len if horizontal else thick))
+        y = rng.randint(0, MAP_SIZE - (thick if horizontal else cluster_len))
+
+        for d in range(thick):
+            # one row (or column) of the cluster is a single slice of the flat grid
+            if horizontal:
+                line = slice((y + d) * MAP_SIZE + x, (y + d) * MAP_SIZE + x + cluster_len)
+            else:
+                line = slice(y * MAP_SIZE + x + d, (y + cluster_len) * MAP_SIZE + x + d, MAP_SIZE)
+            new = grid[line].count(PATH)
+            if added + new <= wall_count:
+                grid[line] = bytes([WALL]) * cluster_len
+                added += new
+                continue
+            # the last cluster only fills up to wall_count, in scan order
+            for cell in range(line.start, line.stop, line.step or 1):
+                if grid[cell] == PATH:
+                    grid[cell] = WALL
                     added += 1
                     if added >= wall_count:
                         break
-            if added >= wall_count:
-                break
+            break
 
     return grid
 
-for i in range(1, 6):
-    data = generate_map()
-    with open(f"map_{i:02}.txt", "w") as f:
-        f.write("\n".join("".join(row) for row in data))
+
+def validate_map(grid: bytes, wall_ratio=WALL_RATIO) -> str | None:
+    """Why the map is unusable, or None."""
+    if grid.count(WALL) != int(MAP_SIZE * MAP_SIZE * wall_ratio):
+        return f"wall ratio {grid.count(WALL) / len(grid):.3f}, expected {wall_ratio}"
+    _, sizes = label_components(grid)
+    if len(sizes) != 2:
+        return f"floor split into {len(sizes) - 1} regions"
+    return None
+
+
+def generate_valid_map(seed: int, wall_ratio: float, index: int) -> bytes:
+    # every map has its own stream, so the output does not depend on how work is split across processes
+    rng = random.Random(f"{seed}:{index}")
+    for _ in range(MAX_ATTEMPTS):
+        grid = generate_map(rng, wall_ratio)
+        if validate_map(grid, wall_ratio) is None:
+            return bytes(grid)
+    raise RuntimeError(f"map {index}: no valid layout after {MAX_ATTEMPTS} attempts")
+
+
+def generate_maps(count: int, seed: int, wall_ratio=WALL_RATIO, processes: int | None = None) -> list[bytes]:
+    job = functools.partial(generate_valid_map, seed, wall_ratio)
+    processes = processes or os.cpu_count() or 1
+    if processes == 1 or count < 2:
+        return [job(i) for i in range(count)]
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(job, range(count), chunksize=max(1, count // (processes * 4)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate connected 50x50 maps.")
+    parser.add_argument("--count", type=int, default=5, help="number of maps")
+    parser.add_argument("--seed", type=int, default=None, help="seed, random if omitted")
+    parser.add_argument("--wall-ratio", type=float, default=WALL_RATIO)
+    parser.add_argument("--processes", type=int, default=None, help="worker processes, default one per CPU")
+    parser.add_argument("--pack", help="write every map into this multi-map pack (see mapstore.read_pack)")
+    parser.add_argument("--text", help="write map_NN.txt files into this directory")
+    args = parser.parse_args()
+
+    seed = args.seed if args.seed is not None else random.randrange(2**32)
+    grids = generate_maps(args.count, seed, args.wall_ratio, args.processes)
+    if args.pack:
+        write_pack(args.pack, grids)
+    if args.text or not args.pack:
+        directory = args.text or "."
+        for i, grid in enumerate(grids, 1):
+            rows = (grid[y * MAP_SIZE:(y + 1) * MAP_SIZE] for y in range(MAP_SIZE))
+            with open(os.path.join(directory, f"map_{i:02}.txt"), "w") as f:
+                f.write("\n".join(row.translate(TEXT_CELLS).decode() for row in rows))
+    print(f"generated {len(grids)} maps with seed {seed}")
+
+
+if __name__ == "__main__":
+    main()
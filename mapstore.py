@@ -0,0 +1,181 @@
+from array import array
+import glob
+import os
+import random
+import re
+import struct
+
+MAP_SIZE = 50
+
+PATH = 0
+WALL = 1
+PATH_RUN = re.compile(bytes([PATH]) + b"+")
+
+'''
+Multi-map pack written by maps/gen_map.py, little-endian:
+
+    header  "KOHM", u16 version, u16 width, u16 height, u16 reserved, u32 count
+    maps    count grids of ceil(width * height / 8) bytes each, row-major,
+            one bit per cell (1 = wall), most significant bit first
+'''
+PACK_MAGIC = b"KOHM"
+PACK_VERSION = 1
+PACK_HEADER = struct.Struct("<4sHHHHI")
+PACKED_SIZE = (MAP_SIZE * MAP_SIZE + 7) // 8
+# b"\x00"/b"\x01" cells <-> b"0"/b"1" digits, for packing through int(digits, 2)
+_TO_DIGITS = bytes.maketrans(b"\x00\x01", b"01")
+_FROM_DIGITS = bytes.maketrans(b"01", b"\x00\x01")
+
+
+def pack_grid(grid: bytes) -> bytes:
+    digits = grid.translate(_TO_DIGITS) + b"0" * (PACKED_SIZE * 8 - len(grid))
+    return int(digits, 2).to_bytes(PACKED_SIZE, "big")
+
+
+def unpack_grid(packed: bytes) -> bytes:
+    digits = bin(int.from_bytes(packed, "big"))[2:].zfill(PACKED_SIZE * 8)
+    return digits[:MAP_SIZE * MAP_SIZE].encode().translate(_FROM_DIGITS)
+
+
+def write_pack(path: str, grids: list[bytes]):
+    with open(path, "wb") as f:
+        f.write(PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, MAP_SIZE, MAP_SIZE, 0, len(grids)))
+        for grid in grids:
+            f.write(pack_grid(grid))
+
+
+def read_pack(path: str) -> list[bytes]:
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, width, height, _, count = PACK_HEADER.unpack_from(data)
+    if magic != PACK_MAGIC or version != PACK_VERSION:
+        raise ValueError(f"{path}: not a map pack")
+    if (width, height) != (MAP_SIZE, MAP_SIZE):
+        raise ValueError(f"{path}: maps are {width}x{height}, expected {MAP_SIZE}x{MAP_SIZE}")
+    if len(data) != PACK_HEADER.size + count * PACKED_SIZE:
+        raise ValueError(f"{path}: truncated")
+    return [unpack_grid(data[offset:offset + PACKED_SIZE])
+            for offset in range(PACK_HEADER.size, len(data), PACKED_SIZE)]
+
+
+class GameMap:
+    """One parsed map plus the indexes spawning needs.
+
+    grid is the row-major wall layout (1 = wall), labels numbers the
+    4-connected path regions (0 on walls) and spawn_cells lists the cells
+    of the largest region, so anything placed there can reach the rest of it.
+    """
+    def __init__(self, name: str, grid: bytes):
+        self.name = name
+        self.grid = grid
+        self.rows = [list(grid[y * MAP_SIZE:(y + 1) * MAP_SIZE]) for y in range(MAP_SIZE)]
+        self.labels, sizes = label_components(grid)
+        largest = max(range(1, len(sizes)), key=lambda label: sizes[label])
+        self.spawn_cells = array("H", (cell for cell, label in enumerate(self.labels) if label == largest))
+
+    def random_cell(self, rng: random.Random) -> tuple[int, int]:
+        cell = self.spawn_cells[rng.randrange(len(self.spawn_cells))]
+        return cell % MAP_SIZE, cell // MAP_SIZE
+
+
+def parse_map(name: str, text: str) -> bytes:
+    lines = text.splitlines()
+    while lines and not lines[-1].strip():
+        lines.pop()
+    if len(lines) != MAP_SIZE:
+        raise ValueError(f"{name}: expected {MAP_SIZE} rows, got {len(lines)}")
+    grid = bytearray(MAP_SIZE * MAP_SIZE)
+    for y, line in enumerate(lines):
+        if len(line) != MAP_SIZE or line.strip(".#"):
+            raise ValueError(f"{name}: row {y} must be {MAP_SIZE} '.' or '#' characters")
+        for x, c in enumerate(line):
+            if c == '#':
+                grid[y * MAP_SIZE + x] = WALL
+    if PATH not in grid:
+        raise ValueError(f"{name}: no walkable cell")
+    return bytes(grid)
+
+
+def path_runs(grid: bytes) -> list[list[tuple[int, int]]]:
+    """Per row, the [start, stop) cell indices of each horizontal stretch of path."""
+    return [[m.span() for m in PATH_RUN.finditer(grid, y * MAP_SIZE, (y + 1) * MAP_SIZE)]
+            for y in range(MAP_SIZE)]
+
+
+def label_components(grid: bytes) -> tuple[array, list[int]]:
+    """Label the 4-connected path regions 1..n in scan order; returns (labels, sizes) with sizes[0] unused.
+
+    Works on horizontal runs of path rather than cells: runs in adjacent rows
+    that overlap are merged with a union-find, then each run is labelled by slice.
+    """
+    rows = path_runs(grid)
+    runs = [run for row in rows for run in row]
+    parent = list(range(len(runs)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    first = 0
+    for y in range(1, MAP_SIZE):
+        above, below = first, first + len(rows[y - 1])
+        first = below
+        for i in range(below, below + len(rows[y])):
+            start, stop = runs[i][0] - MAP_SIZE, runs[i][1] - MAP_SIZE
+            for j in range(above, below):
+                if runs[j][1] <= start:
+                    continue
+                if runs[j][0] >= stop:
+                    break
+                a, b = find(i), find(j)
+                if a != b:
+                    # keep the earlier run as root, so labels follow scan order
+                    parent[max(a, b)] = min(a, b)
+
+    labels = array("H", bytes(2 * len(grid)))
+    sizes = [0]
+    root_label: dict[int, int] = {}
+    for i, (start, stop) in enumerate(runs):
+        root = find(i)
+        if root not in root_label:
+            root_label[root] = len(sizes)
+            sizes.append(0)
+        label = root_label[root]
+        labels[start:stop] = array("H", [label]) * (stop - start)
+        sizes[label] += stop - start
+    return labels, sizes
+
+
+class MapStore:
+    """All maps of a directory, parsed and validated once."""
+    def __init__(self, maps: list[GameMap]):
+        if not maps:
+            raise ValueError("no maps")
+        self.maps = maps
+
+    @classmethod
+    def load_dir(cls, directory: str) -> "MapStore":
+        maps = []
+        for path in sorted(glob.glob(os.path.join(directory, "*.txt"))):
+            with open(path, "r") as f:
+                maps.append(GameMap(os.path.basename(path), parse_map(path, f.read())))
+        return cls(maps)
+
+    @classmethod
+    def load_pack(cls, path: str) -> "MapStore":
+        """Maps of a pack written by maps/gen_map.py, named <file>#<index>."""
+        name = os.path.basename(path)
+        maps = []
+        for i, grid in enumerate(read_pack(path)):
+            if PATH not in grid:
+                raise ValueError(f"{name}#{i}: no walkable cell")
+            maps.append(GameMap(f"{name}#{i}", grid))
+        return cls(maps)
+
+    def choice(self, rng: random.Random) -> GameMap:
+        return rng.choice(self.maps)
+
+
+MAPS = MapStore.load_dir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "maps"))
@@ -0,0 +1,74 @@
+import threading
+
+# upper bounds of the instructions-per-fork histogram buckets
+STEP_BUCKETS = (10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+# phases of Simulator.simulate, in order
+PHASES = ("chests", "map", "vm", "actions", "records")
+
+
+class Metrics:
+    """Process-wide simulator counters, rendered in the Prometheus text format.
+
+    Every Simulator reports into the same instance (METRICS by default), so
+    the numbers keep accumulating across rounds.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.turns = 0
+        self.phase_seconds = dict.fromkeys(PHASES, 0.0)
+        self.forks = 0
+        self.instructions = 0
+        self.timeouts = 0
+        self.faults = 0
+        self.step_buckets = [0] * len(STEP_BUCKETS)
+
+    def observe_turn(self, phase_seconds: dict[str, float], steps, timeouts: int, faults: int):
+        with self.lock:
+            self.turns += 1
+            for phase, seconds in phase_seconds.items():
+                self.phase_seconds[phase] += seconds
+            self.forks += len(steps)
+            for n in steps:
+                self.instructions += n
+                for i, bound in enumerate(STEP_BUCKETS):
+                    if n <= bound:
+                        self.step_buckets[i] += 1
+                        break
+            self.timeouts += timeouts
+            self.faults += faults
+
+    def render(self) -> str:
+        with self.lock:
+            lines = [
+                "# HELP koh_turns_total Simulated turns.",
+                "# TYPE koh_turns_total counter",
+                f"koh_turns_total {self.turns}",
+                "# HELP koh_turn_phase_seconds_total Wall time spent in each phase of a turn.",
+                "# TYPE koh_turn_phase_seconds_total counter",
+            ]
+            lines += [f'koh_turn_phase_seconds_total{{phase="{phase}"}} {seconds:.9f}'
+                      for phase, seconds in self.phase_seconds.items()]
+            lines += [
+                "# HELP koh_vm_instructions_per_fork Instructions executed by one fork in one turn.",
+                "# TYPE koh_vm_instructions_per_fork histogram",
+            ]
+            cumulative = 0
+            for bound, count in zip(STEP_BUCKETS, self.step_buckets):
+                cumulative += count
+                lines.append(f'koh_vm_instructions_per_fork_bucket{{le="{bound}"}} {cumulative}')
+            lines += [
+                f'koh_vm_instructions_per_fork_bucket{{le="+Inf"}} {self.forks}',
+                f"koh_vm_instructions_per_fork_sum {self.instructions}",
+                f"koh_vm_instructions_per_fork_count {self.forks}",
+                "# HELP koh_vm_timeouts_total Fork runs stopped by the instruction budget or wall clock.",
+                "# TYPE koh_vm_timeouts_total counter",
+                f"koh_vm_timeouts_total {self.timeouts}",
+                "# HELP koh_vm_faults_total Fork runs stopped by an out-of-bounds memory access.",
+                "# TYPE koh_vm_faults_total counter",
+                f"koh_vm_faults_total {self.faults}",
+            ]
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
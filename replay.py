@@ -0,0 +1,149 @@
+from array import array
+import mmap
+import struct
+
+MAP_SIZE = 50
+
+'''
+Binary replay file, little-endian, every section 4-byte aligned:
+
+    header      "KOHR", u16 version, u16 team_num, u32 turns,
+                u32 char_count, u32 chest_count, u32 tape_size
+    map         MAP_SIZE * MAP_SIZE bytes, row-major
+    characters  int32 columns of char_count entries:
+                cid, team, is_fork, spawn_x, spawn_y, spawn_turn, dead_turn
+    tape_start  int32[char_count + 1], offsets of each opcode tape in `tapes`
+    tapes       tape_size bytes, one opcode (0-7) per character per turn, padded
+    chests      int32 columns of chest_count entries:
+                cid, x, y, spawn_turn, opened_turn
+    scores      int32[(turns + 1) * team_num], row t + 1 holds the scores after turn t
+'''
+REPLAY_MAGIC = b"KOHR"
+REPLAY_VERSION = 1
+HEADER = struct.Struct("<4sHHIIII")
+
+CHAR_COLUMNS = ("cid", "team", "is_fork", "spawn_x", "spawn_y", "spawn_turn", "dead_turn")
+CHEST_COLUMNS = ("cid", "x", "y", "spawn_turn", "opened_turn")
+
+
+def _pad(n: int) -> int:
+    return (n + 3) & ~3
+
+
+class MatchRecord:
+    """Columnar record of one round.
+
+    Characters and chests are rows addressed by their record index; each
+    character has an array('B') opcode tape starting at its spawn, and the
+    scores are an int32 [turns + 1 x teams] matrix. Records loaded from a
+    replay file are read-only views over the (memory-mapped) buffer.
+    """
+    def __init__(self, team_num: int, map: bytes):
+        self.team_num = team_num
+        self.map = map
+        self.chars = {name: array("i") for name in CHAR_COLUMNS}
+        self.tapes: list = []
+        self.chests = {name: array("i") for name in CHEST_COLUMNS}
+        self.scores = array("i", bytes(4 * team_num))
+
+    @property
+    def turns(self) -> int:
+        return len(self.scores) // self.team_num - 1
+
+    @property
+    def char_count(self) -> int:
+        return len(self.chars["cid"])
+
+    @property
+    def chest_count(self) -> int:
+        return len(self.chests["cid"])
+
+    def add_character(self, cid: int, team: int, is_fork: bool, x: int, y: int, turn: int) -> int:
+        for name, value in zip(CHAR_COLUMNS, (cid, team, is_fork, x, y, turn, -1)):
+            self.chars[name].append(value)
+        self.tapes.append(array("B"))
+        return self.char_count - 1
+
+    def add_chest(self, cid: int, x: int, y: int, turn: int) -> int:
+        for name, value in zip(CHEST_COLUMNS, (cid, x, y, turn, -1)):
+            self.chests[name].append(value)
+        return self.chest_count - 1
+
+    def add_scores(self, scores: list[int]):
+        self.scores.extend(scores)
+
+    def truncate(self, turn: int, char_count: int, chest_count: int, tape_lengths):
+        """Cut the record back to the start of `turn`: rows created later are dropped and
+        deaths/openings at or after it are undone. tape_lengths[i] is the tape length to keep."""
+        for column in self.chars.values():
+            del column[char_count:]
+        del self.tapes[char_count:]
+        for tape, length in zip(self.tapes, tape_lengths):
+            del tape[length:]
+        dead_turn = self.chars["dead_turn"]
+        for i in range(char_count):
+            if dead_turn[i] >= turn:
+                dead_turn[i] = -1
+        for column in self.chests.values():
+            del column[chest_count:]
+        opened_turn = self.chests["opened_turn"]
+        for i in range(chest_count):
+            if opened_turn[i] >= turn:
+                opened_turn[i] = -1
+        del self.scores[(turn + 1) * self.team_num:]
+
+    def score_column(self, team_index: int, start: int = 0, stop: int | None = None):
+        """Scores of one team for samples [start, stop)."""
+        stop = self.turns + 1 if stop is None else stop
+        return self.scores[start * self.team_num + team_index:stop * self.team_num:self.team_num]
+
+    def to_bytes(self) -> bytes:
+        tape_start = array("i", [0])
+        for tape in self.tapes:
+            tape_start.append(tape_start[-1] + len(tape))
+        tape_size = tape_start[-1]
+        parts = [HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, self.team_num, self.turns,
+                             self.char_count, self.chest_count, tape_size),
+                 bytes(self.map)]
+        parts += [self.chars[name].tobytes() for name in CHAR_COLUMNS]
+        parts.append(tape_start.tobytes())
+        parts += [bytes(tape) for tape in self.tapes]
+        parts.append(bytes(_pad(tape_size) - tape_size))
+        parts += [self.chests[name].tobytes() for name in CHEST_COLUMNS]
+        parts.append(self.scores.tobytes())
+        return b"".join(parts)
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def from_buffer(cls, buffer) -> "MatchRecord":
+        """Wrap a replay produced by to_bytes without copying its columns."""
+        view = memoryview(buffer)
+        magic, version, team_num, turns, char_count, chest_count, tape_size = HEADER.unpack_from(view)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError("not a replay file")
+        offset = HEADER.size
+
+        def take(size: int):
+            nonlocal offset
+            section = view[offset:offset + size]
+            offset += size
+            return section
+
+        record = cls.__new__(cls)
+        record.team_num = team_num
+        record.map = take(MAP_SIZE * MAP_SIZE)
+        record.chars = {name: take(4 * char_count).cast("i") for name in CHAR_COLUMNS}
+        tape_start = take(4 * (char_count + 1)).cast("i")
+        tapes = take(_pad(tape_size))
+        record.tapes = [tapes[tape_start[i]:tape_start[i + 1]] for i in range(char_count)]
+        record.chests = {name: take(4 * chest_count).cast("i") for name in CHEST_COLUMNS}
+        record.scores = take(4 * (turns + 1) * team_num).cast("i")
+        return record
+
+    @classmethod
+    def load(cls, path: str) -> "MatchRecord":
+        with open(path, "rb") as f:
+            return cls.from_buffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
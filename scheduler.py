@@ -0,0 +1,254 @@
+import logging
+import multiprocessing
+import queue
+import random
+import threading
+import time
+from typing import Callable
+
+from archive import MatchInputs
+from metrics import METRICS, Metrics
+from simulator import DEFAULT_INSTRUCTION_BUDGET, Simulator
+from turnring import (FRAME_FINISH, FRAME_METRICS, FRAME_PROFILE, FRAME_START, FRAME_TURN,
+                      OUTCOME_CANCELLED, OUTCOME_FINISHED, TurnFollower, TurnRing, decode_finish,
+                      decode_metrics, decode_profile, decode_start, decode_turn, encode_finish,
+                      encode_metrics, encode_profile, encode_start, encode_turn, frame_kind)
+
+logger = logging.getLogger(__name__)
+
+
+class SimulationJob:
+    """One round: a Simulator played turn by turn on a scheduler worker.
+
+    Cancellation is cooperative, the flag is checked between turns, so a
+    cancelled job stops after at most one more turn and a job cancelled
+    while queued never starts.
+    """
+    QUEUED = "queued"
+    RUNNING = "running"
+    FINISHED = "finished"
+    CANCELLED = "cancelled"
+    FAILED = "failed"
+
+    def __init__(self, round: int, simulator: Simulator, turns: int = 200,
+                 on_start: Callable[["SimulationJob"], None] | None = None,
+                 on_finish: Callable[["SimulationJob"], None] | None = None):
+        self.round = round
+        self.simulator = simulator
+        self.turns = turns
+        self.on_start = on_start
+        self.on_finish = on_finish
+        self.state = self.QUEUED
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        return self.done.wait(timeout)
+
+    def inputs(self) -> MatchInputs:
+        """What the round was played from, for MatchArchive."""
+        return MatchInputs.of(self.simulator)
+
+    def run(self):
+        try:
+            if self.cancelled.is_set():
+                self.state = self.CANCELLED
+                return
+            self.state = self.RUNNING
+            if self.on_start:
+                self.on_start(self)
+            for _ in range(self.turns):
+                if self.cancelled.is_set():
+                    self.state = self.CANCELLED
+                    return
+                self.simulator.simulate()
+            self.state = self.FINISHED
+            if self.on_finish:
+                self.on_finish(self)
+        except Exception:
+            logger.exception("round %d failed", self.round)
+            self.state = self.FAILED
+        finally:
+            # records stay readable, only the challenge pool and compiled programs are released
+            self.simulator.close()
+            self.done.set()
+
+
+class RingMetrics:
+    """Stands in for Metrics in a round process: every observation becomes a frame."""
+    def __init__(self, ring: TurnRing):
+        self.ring = ring
+
+    def observe_turn(self, phase_seconds: dict[str, float], steps, timeouts: int, faults: int):
+        self.ring.write(encode_metrics(phase_seconds, steps, timeouts, faults))
+
+
+def play_round_process(ring_name: str, team_num: int, scripts: list[str], turns: int,
+                       seed: int, instruction_budget: int, stop, profile: bool = False):
+    """Entry point of a round process: play the round and write every turn to the ring."""
+    ring = TurnRing.attach(ring_name)
+    sim = Simulator(team_num, instruction_budget=instruction_budget, seed=seed, metrics=RingMetrics(ring),
+                    profile=profile)
+    try:
+        for team, script in enumerate(scripts, 1):
+            sim.set_script(team, script)
+        ring.write(encode_start(team_num, sim.record.map, sim.game_map.name))
+        sim.listeners.append(lambda event: ring.write(encode_turn(event)))
+        outcome = OUTCOME_FINISHED
+        for _ in range(turns):
+            if stop.is_set():
+                outcome = OUTCOME_CANCELLED
+                break
+            sim.simulate()
+        if profile:
+            ring.write(encode_profile(sim.dump_profile()))
+        ring.write(encode_finish(outcome))
+    finally:
+        sim.close()
+        ring.close()
+
+
+class ProcessSimulationJob(SimulationJob):
+    """A round played in its own process, so turn resolution never competes
+    with request handlers for the web process's GIL.
+
+    The process writes turn frames into a shared-memory TurnRing; run() is
+    the only reader and rebuilds the round in `simulator`, a TurnFollower,
+    which the web process serves like a local Simulator. on_start is called
+    once the process has picked its map. A profiled round's profile arrives
+    with the last turn, not turn by turn.
+    """
+    POLL_SECONDS = 0.005
+    context = multiprocessing.get_context("spawn")
+
+    def __init__(self, round: int, team_num: int, scripts: list[str], turns: int = 200,
+                 seed: int | None = None, instruction_budget: int = DEFAULT_INSTRUCTION_BUDGET,
+                 on_start: Callable[["SimulationJob"], None] | None = None,
+                 on_finish: Callable[["SimulationJob"], None] | None = None,
+                 metrics: Metrics = METRICS, ring_size: int = 4 << 20, profile: bool = False):
+        super().__init__(round, TurnFollower(), turns, on_start, on_finish)
+        self.team_num = team_num
+        self.scripts = scripts
+        # drawn here rather than in the process, so the round can be archived by its inputs
+        self.seed = seed if seed is not None else random.randrange(2**63)
+        self.instruction_budget = instruction_budget
+        self.metrics = metrics
+        self.ring_size = ring_size
+        self.profile = profile
+        self.stop = self.context.Event()
+
+    def cancel(self):
+        super().cancel()
+        self.stop.set()
+
+    def inputs(self) -> MatchInputs:
+        return MatchInputs(self.seed, self.instruction_budget, self.simulator.map_name, self.scripts)
+
+    def run(self):
+        if self.cancelled.is_set():
+            self.state = self.CANCELLED
+            self.done.set()
+            return
+        ring = process = None
+        try:
+            # inside the try: a full /dev/shm fails the job, not the scheduler worker
+            ring = TurnRing.create(self.ring_size)
+            process = self.context.Process(target=play_round_process, daemon=True,
+                                           args=(ring.name, self.team_num, self.scripts, self.turns, self.seed,
+                                                 self.instruction_budget, self.stop, self.profile))
+            process.start()
+            cursor = 0
+            outcome = None
+            while outcome is None:
+                frames, cursor = ring.read(cursor)
+                if not frames:
+                    if not process.is_alive() and ring.head == cursor:
+                        raise RuntimeError(f"round process exited with code {process.exitcode}")
+                    time.sleep(self.POLL_SECONDS)
+                    continue
+                for frame in frames:
+                    kind = frame_kind(frame)
+                    if kind == FRAME_TURN:
+                        self.simulator.apply(decode_turn(frame, self.team_num))
+                    elif kind == FRAME_METRICS:
+                        self.metrics.observe_turn(*decode_metrics(frame))
+                    elif kind == FRAME_PROFILE:
+                        self.simulator.profile = decode_profile(frame)
+                    elif kind == FRAME_START:
+                        self.simulator.start(*decode_start(frame))
+                        self.state = self.RUNNING
+                        if self.on_start:
+                            self.on_start(self)
+                    elif kind == FRAME_FINISH:
+                        outcome = decode_finish(frame)
+            if outcome == OUTCOME_CANCELLED:
+                self.state = self.CANCELLED
+                return
+            self.state = self.FINISHED
+            if self.on_finish:
+                self.on_finish(self)
+        except Exception:
+            logger.exception("round %d failed", self.round)
+            self.state = self.FAILED
+        finally:
+            if process is not None and process.pid is not None:
+                # a process we stopped reading from stops at its next turn, or is killed
+                self.stop.set()
+                process.join(timeout=1)
+                if process.is_alive():
+                    process.kill()
+                    process.join()
+            if ring is not None:
+                ring.close()
+            self.done.set()
+
+
+class SimulationScheduler:
+    """A fixed number of worker threads fed by a bounded queue of jobs.
+
+    submit() never blocks: when the queue is full the job is rejected, so a
+    burst of requests is turned away instead of piling up simulations.
+    """
+    def __init__(self, workers: int = 1, max_queued: int = 4):
+        self.queue: queue.Queue[SimulationJob] = queue.Queue(maxsize=max_queued)
+        self.lock = threading.Lock()
+        # submitted and not done yet, in submission order
+        self.jobs: list[SimulationJob] = []
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, job: SimulationJob, supersede: bool = False) -> bool:
+        """Queue the job, returns False if the queue is full.
+        With supersede, every earlier job is cancelled once this one is accepted."""
+        with self.lock:
+            try:
+                self.queue.put_nowait(job)
+            except queue.Full:
+                return False
+            if supersede:
+                for earlier in self.jobs:
+                    earlier.cancel()
+            self.jobs.append(job)
+        return True
+
+    def cancel_all(self) -> int:
+        with self.lock:
+            for job in self.jobs:
+                job.cancel()
+            return len(self.jobs)
+
+    def pending(self) -> list[SimulationJob]:
+        with self.lock:
+            return list(self.jobs)
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            job.run()
+            with self.lock:
+                self.jobs.remove(job)
+            self.queue.task_done()
@@ -1,13 +1,21 @@
 from ctypes import *
-import glob
 import random
 import copy
-import concurrent.futures
 import threading
 import json
 import time
 import math
 import os
+import hashlib
+import collections
+import logging
+from array import array
+from typing import Callable
+from replay import MatchRecord
+from metrics import METRICS, Metrics
+from mapstore import MAPS, GameMap, MapStore
+
+logger = logging.getLogger(__name__)
 
 MAP_SIZE = 50
 
@@ -17,260 +25,675 @@ class VM_Character(Structure):
 class VM_Chest(Structure):
     _fields_ = [("x", c_int), ("y", c_int)]
 
+# words of per-character self memory, VM_Buffer.self
+SELF_SIZE = 8
+
 class VM_Buffer(Structure):
     _pack_ = 1
-    _fields_ = [("global", c_uint * 50), ("self", c_uint * 8), ("tmp", c_uint * 42)]
+    _fields_ = [("global", c_uint * 50), ("self", c_uint * SELF_SIZE), ("tmp", c_uint * 42)]
 
-last_chest_id = 0
-class Chest:
-    cid: int
-    type:int = 0
-    score = 0
-    param = []
-    result = []
-    def reverse_chal(self):
-        self.param = [random.randint(0, 65536) for _ in range(7)]
-        self.result = copy.deepcopy(self.param)
-        self.param.reverse()
-        self.score = 60
-
-    def sort_chal(self):
-        self.param = [random.randint(0, 65536) for _ in range(7)]
-        self.result = copy.deepcopy(self.param)
-        self.result.sort()
-        self.score = 80
-    
-    def point_addition_chal(self):
-        self.score = 120
-
-        # y^2 = x^3 + a*x + b (mod p)
-        p = 9739
-        a, b = 3, 7
-
-        def inv_mod(x, m):
-            return pow(x, -1, m)
-
-        def is_on_curve(x, y):
-            return (y * y - (x * x * x + a * x + b)) % p == 0
-
-        def point_add(P, Q):
-            x1, y1 = P
-            x2, y2 = Q
-
-            if x1 == x2 and (y1 + y2) % p == 0:
-                return None  
-
-            if P != Q:
-                lam = ((y2 - y1) * inv_mod((x2 - x1) % p, p)) % p
-            else:
-                if y1 == 0:
-                    return None 
-                lam = ((3 * x1 * x1 + a) * inv_mod((2 * y1) % p, p)) % p
-
-            x3 = (lam * lam - x1 - x2) % p
-            y3 = (lam * (x1 - x3) - y1) % p
-            return (x3, y3)
-
-        def random_point():
-            while True:
-                x = random.randint(0, p - 1)
-                rhs = (x**3 + a*x + b) % p
-            
-                if pow(rhs, (p-1)//2, p) != 1:
-                    continue  
-                for y in range(p):
-                    if (y*y) % p == rhs:
-                        return (x, y)
+# RSA primes are drawn from [RSA_PRIME_LOW, RSA_PRIME_HIGH]
+RSA_PRIME_LOW = 1000
+RSA_PRIME_HIGH = 50000
+RSA_E = 65537
 
-        while True:
-            P = random_point()
-            Q = random_point()
-            R = point_add(P, Q)
-            if R is not None:
-                break
-
-        # print(f"P = {P}")
-        # print(f"Q = {Q}")
-        # print(f"P + Q = {R}")
-        # a, b, p, px, py, qx, qy
-        self.param = [a, b, p, P[0], P[1], Q[0], Q[1]]
-        self.result = [R[0], R[1]]
-
-    def rsa_chal(self):
-        self.score = 100
-
-        def is_prime(n):
-            if n < 2:
-                return False
-            if n % 2 == 0:
-                return n == 2
-            r = int(n ** 0.5) + 1
-            for i in range(3, r, 2):
-                if n % i == 0:
-                    return False
-            return True
+# y^2 = x^3 + a*x + b (mod p)
+CURVE_P = 9739
+CURVE_A, CURVE_B = 3, 7
+
+def prime_sieve(high: int) -> bytearray:
+    sieve = bytearray([1]) * (high + 1)
+    sieve[0:2] = b"\x00\x00"
+    for i in range(2, int(high ** 0.5) + 1):
+        if sieve[i]:
+            sieve[i * i::i] = bytes(len(range(i * i, high + 1, i)))
+    return sieve
+
+_sieve = prime_sieve(RSA_PRIME_HIGH)
+# picking uniformly from this list is the same distribution as sampling integers until one is prime
+RSA_PRIMES = [n for n in range(RSA_PRIME_LOW, RSA_PRIME_HIGH + 1) if _sieve[n]]
+del _sieve
+
+# CURVE_SQRT[r] is the smallest y with y*y == r (mod p), or -1 for non-residues
+CURVE_SQRT = [-1] * CURVE_P
+for _y in range(CURVE_P - 1, -1, -1):
+    CURVE_SQRT[_y * _y % CURVE_P] = _y
+del _y
+
+def reverse_chal(rng: random.Random):
+    param = [rng.randint(0, 65536) for _ in range(7)]
+    result = copy.deepcopy(param)
+    param.reverse()
+    return param, result, 60
+
+def sort_chal(rng: random.Random):
+    param = [rng.randint(0, 65536) for _ in range(7)]
+    result = copy.deepcopy(param)
+    result.sort()
+    return param, result, 80
+
+def point_addition_chal(rng: random.Random):
+    p = CURVE_P
+    a, b = CURVE_A, CURVE_B
 
-        def gen_prime(low=1000, high=50000):
-            while True:
-                n = random.randint(low, high)
-                if is_prime(n):
-                    return n
-
-        def egcd(a, b):
-            if b == 0:
-                return (a, 1, 0)
-            g, x1, y1 = egcd(b, a % b)
-            return (g, y1, x1 - (a // b) * y1)
-
-        def modinv(a, m):
-            g, x, y = egcd(a, m)
-            if g != 1:
+    def inv_mod(x, m):
+        return pow(x, -1, m)
+
+    def point_add(P, Q):
+        x1, y1 = P
+        x2, y2 = Q
+
+        if x1 == x2 and (y1 + y2) % p == 0:
+            return None
+
+        if P != Q:
+            lam = ((y2 - y1) * inv_mod((x2 - x1) % p, p)) % p
+        else:
+            if y1 == 0:
                 return None
-            return x % m
+            lam = ((3 * x1 * x1 + a) * inv_mod((2 * y1) % p, p)) % p
 
-        def rsa_gen():
+        x3 = (lam * lam - x1 - x2) % p
+        y3 = (lam * (x1 - x3) - y1) % p
+        return (x3, y3)
 
-            p = gen_prime()
-            q = gen_prime()
-            n = p * q
-            if n > 2**32 - 1:
-                return rsa_gen() 
+    def random_point():
+        while True:
+            x = rng.randint(0, p - 1)
+            rhs = (x**3 + a*x + b) % p
+            # rhs == 0 is skipped as well, like the Euler criterion check it replaces
+            if rhs != 0 and CURVE_SQRT[rhs] != -1:
+                return (x, CURVE_SQRT[rhs])
 
-            phi = (p - 1) * (q - 1)
+    while True:
+        P = random_point()
+        Q = random_point()
+        R = point_add(P, Q)
+        if R is not None:
+            break
 
-            e = 65537  
-            if math.gcd(e, phi) != 1:
-                return rsa_gen()
-            d = modinv(e, phi)
+    # a, b, p, px, py, qx, qy
+    return [a, b, p, P[0], P[1], Q[0], Q[1]], [R[0], R[1]], 120
 
-            m = random.randint(2, n-1)
+def rsa_chal(rng: random.Random):
+    while True:
+        p = rng.choice(RSA_PRIMES)
+        q = rng.choice(RSA_PRIMES)
+        n = p * q
+        phi = (p - 1) * (q - 1)
+        if math.gcd(RSA_E, phi) != 1:
+            continue
+        d = pow(RSA_E, -1, phi)
 
-            c = pow(m, e, n)
+        m = rng.randint(2, n-1)
+        c = pow(m, RSA_E, n)
+        if pow(c, d, n) == m:
+            break
+    return [p, q, RSA_E, c], [m], 100
 
-            m2 = pow(c, d ,n)
-            if m2 != m:
-                return rsa_gen()
+class ChallengePool:
+    """Reservoir of ready-made (type, param, result, score) chest challenges.
 
-            return (p, q, e, c, m)
+    A daemon worker keeps the reservoir topped up so `draw` is O(1) on
+    chest-spawn turns. Challenges are generated one at a time under the
+    lock from a single RNG, so the sequence handed out does not depend on
+    whether the worker or `draw` produced an entry.
+    """
+    def __init__(self, capacity: int = 64, rng: random.Random | None = None):
+        self.capacity = capacity
+        self.rng = rng if rng is not None else random.Random()
+        self.ready: collections.deque[tuple[int, list[int], list[int], int]] = collections.deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.worker: threading.Thread | None = None
+        self.stopped = False
 
-        rsa_list = rsa_gen()
-        self.param = [rsa_list[0], rsa_list[1], rsa_list[2], rsa_list[3]]
-        self.result = [rsa_list[4]]
+    def start(self):
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._refill, daemon=True)
+                self.worker.start()
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+    def getstate(self):
+        """The challenges still to be handed out: the ready ones plus the RNG that makes the rest."""
+        with self.lock:
+            return self.rng.getstate(), tuple(self.ready)
+
+    def setstate(self, state):
+        with self.lock:
+            rng_state, ready = state
+            self.rng.setstate(rng_state)
+            self.ready = collections.deque(ready)
+        self.wakeup.set()
+
+    def draw(self) -> tuple[int, list[int], list[int], int]:
+        with self.lock:
+            challenge = self.ready.popleft() if self.ready else self._generate()
+        if self.worker is None:
+            self.start()
+        else:
+            self.wakeup.set()
+        return challenge
+
+    def _generate(self):
+        type = self.rng.randrange(1, len(Chest.CHALS) + 1)
+        param, result, score = Chest.CHALS[type - 1](self.rng)
+        return type, param, result, score
+
+    def _refill(self):
+        while not self.stopped:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            while not self.stopped:
+                with self.lock:
+                    if len(self.ready) >= self.capacity:
+                        break
+                    self.ready.append(self._generate())
+
+def _grown(old, ctype, length: int):
+    """A zeroed ctypes array of `length` ctype, starting with a copy of `old`."""
+    new = (ctype * length)()
+    memmove(new, old, sizeof(old))
+    return new
+
+
+class EntityStore:
+    """Preallocated slots for one kind of entity, with a free list.
+
+    Subclasses keep their fields in columns indexed by slot and extend them
+    in grow(), which doubles the capacity when every slot is taken, so a
+    turn allocates nothing as long as the population stays below the high
+    water mark. `order` is scratch space for the slots handed to the VM.
+    """
+    def __init__(self, capacity: int):
+        self.capacity = 0
+        self.free: list[int] = []
+        self.order = (c_int * 0)()
+        self.grow(max(capacity, 1))
+
+    def grow(self, capacity: int):
+        self.order = _grown(self.order, c_int, capacity)
+        # popped from the end, so the lowest slots are used first
+        self.free[:0] = range(capacity - 1, self.capacity - 1, -1)
+        self.capacity = capacity
+
+    def allocate(self) -> int:
+        if not self.free:
+            self.grow(self.capacity * 2)
+        return self.free.pop()
+
+    def release(self, slot: int):
+        self.free.append(slot)
+
+    def clear(self):
+        self.free = list(range(self.capacity - 1, -1, -1))
+
+
+class CharacterStore(EntityStore):
+    """Character columns. vm and selfbufs (SELF_SIZE words per slot) are handed to vm_run_batch as is."""
+    def __init__(self, capacity: int = 64):
+        self.vm = (VM_Character * 0)()
+        self.selfbufs = (c_uint * 0)()
+        self.cid = array("i")
+        self.health = array("i")
+        self.record_index = array("i")
+        self.move_to: list[tuple[int, int] | None] = []
+        # bit (team_id - 1) set for every team that hit the character this turn
+        self.attackers: list[int] = []
+        # per run position, filled by vm_run_batch
+        self.opcodes = (c_int * 0)()
+        self.statuses = (c_int * 0)()
+        self.steps = (c_uint * 0)()
+        self.nanos = (c_ulonglong * 0)()
+        super().__init__(capacity)
+
+    def grow(self, capacity: int):
+        added = capacity - self.capacity
+        self.vm = _grown(self.vm, VM_Character, capacity)
+        self.selfbufs = _grown(self.selfbufs, c_uint, capacity * SELF_SIZE)
+        self.cid.extend(array("i", bytes(4 * added)))
+        self.health.extend(array("i", bytes(4 * added)))
+        self.record_index.extend(array("i", bytes(4 * added)))
+        self.move_to += [None] * added
+        self.attackers += [0] * added
+        self.opcodes = (c_int * capacity)()
+        self.statuses = (c_int * capacity)()
+        self.steps = (c_uint * capacity)()
+        self.nanos = (c_ulonglong * capacity)()
+        super().grow(capacity)
+
+
+class ChestStore(EntityStore):
+    """Chest columns. vm is handed to vm_run_batch as is."""
+    def __init__(self, capacity: int = 64):
+        self.vm = (VM_Chest * 0)()
+        self.cid = array("i")
+        self.record_index = array("i")
+        self.challenge: list[tuple[int, list[int], list[int], int] | None] = []
+        super().__init__(capacity)
+
+    def grow(self, capacity: int):
+        added = capacity - self.capacity
+        self.vm = _grown(self.vm, VM_Chest, capacity)
+        self.cid.extend(array("i", bytes(4 * added)))
+        self.record_index.extend(array("i", bytes(4 * added)))
+        self.challenge += [None] * added
+        super().grow(capacity)
+
+
+class Chest:
+    """A chest: a view of one slot of a ChestStore, valid until release()."""
+    __slots__ = ("store", "slot")
 
-    
     CHALS = [reverse_chal, sort_chal, rsa_chal, point_addition_chal]
 
-    def __init__(self, map):
-        global last_chest_id
-        self.cid = last_chest_id
-        last_chest_id += 1
-        rx = random.randrange(0, MAP_SIZE)
-        ry = random.randrange(0, MAP_SIZE)
-        if map != None:
-            while map[ry][rx] == WALL:
-                rx = random.randrange(0, MAP_SIZE)
-                ry = random.randrange(0, MAP_SIZE)
-        self.vm_chest = VM_Chest(rx, ry)
-        self.type = random.randrange(1, len(self.CHALS)+1)
-        self.CHALS[self.type - 1](self)
-    
-last_cid = 0
+    def __init__(self, store: ChestStore, cid: int, x: int, y: int, challenge: tuple[int, list[int], list[int], int]):
+        self.store = store
+        self.slot = slot = store.allocate()
+        store.vm[slot].x, store.vm[slot].y = x, y
+        store.cid[slot] = cid
+        store.challenge[slot] = challenge
+        # row of this chest in the match record
+        store.record_index[slot] = -1
+
+    def release(self):
+        self.store.challenge[self.slot] = None
+        self.store.release(self.slot)
+
+    @property
+    def cid(self) -> int:
+        return self.store.cid[self.slot]
+
+    @property
+    def x(self) -> int:
+        return self.store.vm[self.slot].x
+
+    @property
+    def y(self) -> int:
+        return self.store.vm[self.slot].y
+
+    @property
+    def vm_chest(self) -> VM_Chest:
+        return self.store.vm[self.slot]
+
+    @property
+    def challenge(self) -> tuple[int, list[int], list[int], int]:
+        return self.store.challenge[self.slot]
+
+    @property
+    def type(self) -> int:
+        return self.challenge[0]
+
+    @property
+    def param(self) -> list[int]:
+        return self.challenge[1]
+
+    @property
+    def result(self) -> list[int]:
+        return self.challenge[2]
+
+    @property
+    def score(self) -> int:
+        return self.challenge[3]
+
+    @property
+    def record_index(self) -> int:
+        return self.store.record_index[self.slot]
+
+    @record_index.setter
+    def record_index(self, index: int):
+        self.store.record_index[self.slot] = index
+
+
 class Character:
-    def __init__(self, x: int, y :int, team_id: int, is_fork: bool):
-        global last_cid
-        self.vm_char = VM_Character(x, y, team_id, is_fork)
-        self.selfbuf = (c_uint * 8)()
-        self.is_fork = is_fork
-        self.move_to = None
-        self.cid = last_cid
-        last_cid += 1
-        self.last_attackers: set[Player] = set()
-        if self.is_fork:
-            self.health = 2
-        else:
-            self.health = 3
+    """A character: a view of one slot of a CharacterStore, valid until release()."""
+    __slots__ = ("store", "slot")
+
+    def __init__(self, store: CharacterStore, cid: int, x: int, y: int, team_id: int, is_fork: bool):
+        self.store = store
+        self.slot = slot = store.allocate()
+        vm_char = store.vm[slot]
+        vm_char.x, vm_char.y, vm_char.team_id, vm_char.is_fork = x, y, team_id, is_fork
+        memset(byref(store.selfbufs, slot * SELF_SIZE * sizeof(c_uint)), 0, SELF_SIZE * sizeof(c_uint))
+        store.cid[slot] = cid
+        store.health[slot] = 2 if is_fork else 3
+        # row of this character in the match record
+        store.record_index[slot] = -1
+        store.move_to[slot] = None
+        store.attackers[slot] = 0
+
+    def release(self):
+        self.store.release(self.slot)
+
+    @property
+    def cid(self) -> int:
+        return self.store.cid[self.slot]
+
+    @property
+    def vm_char(self) -> VM_Character:
+        return self.store.vm[self.slot]
+
+    @property
+    def x(self) -> int:
+        return self.store.vm[self.slot].x
+
+    @property
+    def y(self) -> int:
+        return self.store.vm[self.slot].y
+
+    @property
+    def team_id(self) -> int:
+        return self.store.vm[self.slot].team_id
+
+    @property
+    def is_fork(self) -> bool:
+        return self.store.vm[self.slot].is_fork
+
+    def place(self, x: int, y: int):
+        vm_char = self.store.vm[self.slot]
+        vm_char.x, vm_char.y = x, y
+
+    @property
+    def selfbuf(self):
+        """The character's SELF_SIZE words of self memory, as a ctypes array sharing the store's."""
+        return (c_uint * SELF_SIZE).from_buffer(self.store.selfbufs, self.slot * SELF_SIZE * sizeof(c_uint))
+
+    @property
+    def health(self) -> int:
+        return self.store.health[self.slot]
+
+    @health.setter
+    def health(self, health: int):
+        self.store.health[self.slot] = health
+
+    @property
+    def record_index(self) -> int:
+        return self.store.record_index[self.slot]
+
+    @record_index.setter
+    def record_index(self, index: int):
+        self.store.record_index[self.slot] = index
+
+    @property
+    def move_to(self) -> tuple[int, int] | None:
+        return self.store.move_to[self.slot]
+
+    @move_to.setter
+    def move_to(self, cell: tuple[int, int] | None):
+        self.store.move_to[self.slot] = cell
+
+    @property
+    def attackers(self) -> int:
+        return self.store.attackers[self.slot]
+
+    @attackers.setter
+    def attackers(self, teams: int):
+        self.store.attackers[self.slot] = teams
+
     def can_interact(self, x:int, y:int):
-        self_x = self.vm_char.x 
-        self_y = self.vm_char.y
+        self_x = self.x
+        self_y = self.y
         # surrounding cells
         if not (self_x == x and self_y == y) and abs(self_x - x) <= 1 and abs(self_y - y) <= 1:
             return True
         return False
-    def spawn(self, map: list[list[int]]):
-
-        rx = random.randrange(0, MAP_SIZE)
-        ry = random.randrange(0, MAP_SIZE)
-        if map != None:
-            while map[ry][rx] == WALL:
-                rx = random.randrange(0, MAP_SIZE)
-                ry = random.randrange(0, MAP_SIZE)
-        self.vm_char.x = rx
-        self.vm_char.y = ry
+    def spawn(self, game_map: GameMap, rng: random.Random):
+        self.place(*game_map.random_cell(rng))
 
 class Player:
     forks: list[Character]
-    def __init__(self, id: int, script: str):
+    def __init__(self, id: int, script: str, character: Character):
         self.id = id
         self.buffer = VM_Buffer()
         self.script = script
-        self.forks = [Character(0, 0, id, False)]
+        self.forks = [character]
         self.score = 0
         self.fork_cost = 70
         pass
-class CharacterRecord:
-    team_num: int
-    spawn_x: int
-    spawn_y: int
-    spawn_turn: int
-    dead_turn: int = -1
-    opcodes: list[int]
-    def __init__(self, team_num, spawn_x, spawn_y, spawn_turn):
-        self.team_num = team_num
-        self.spawn_x = spawn_x
-        self.spawn_y = spawn_y
-        self.spawn_turn = spawn_turn
-        self.opcodes = []
-        pass
 
-class ChestRecord:
-    x: int
-    y: int
-    spawn_turn: int
-    opened_turn: int = -1
-    def __init__(self, x, y, spawn_turn):
-        self.x = x
-        self.y = y
-        self.spawn_turn = spawn_turn
-        pass
+    @property
+    def script(self) -> str:
+        return self._script
 
-class ScoreRecord:
-    team_id: int
-    scores: list[int]
-    def __init__(self, team_id):
-        self.team_id = team_id
-        self.scores = [0]
-        pass
+    @script.setter
+    def script(self, script: str):
+        # hashed once per assignment, the simulator caches compiled programs by this key
+        self._script = script
+        self.script_hash = hashlib.sha256(script.encode()).digest()
+
+class ScriptProfile:
+    """Where one team's script spent its turns, collected by Simulator(profile=True).
 
+    hits[pc] counts how often each op of the compiled program ran and
+    lines[pc] is the source line it came from, 0 for falling off the end;
+    superinstructions count for the first line they merge. runs has one
+    (turn, cid, steps, status, nanos) entry per fork per turn.
+    """
+    RUN_FIELDS = ("turn", "cid", "steps", "status", "nanos")
 
+    def __init__(self, script: str, script_hash: bytes, lines: array):
+        self.script = script
+        self.script_hash = script_hash
+        self.lines = lines
+        self.hits = (c_ulonglong * len(lines))()
+        # what vm_run_batch takes in its per-team hits array
+        self.hits_pointer = cast(self.hits, POINTER(c_ulonglong))
+        self.runs: list[tuple[int, int, int, int, int]] = []
+
+    def line_hits(self) -> dict[int, int]:
+        counts: dict[int, int] = {}
+        for line, count in zip(self.lines, self.hits):
+            if count:
+                counts[line] = counts.get(line, 0) + count
+        return counts
+
+    def to_dict(self) -> dict:
+        runs = list(self.runs)
+        return {
+            "script": self.script,
+            "instructions": sum(self.hits),
+            "lines": sorted(self.line_hits().items()),
+            # columnar, one entry per fork per turn
+            "runs": {field: [run[i] for run in runs] for i, field in enumerate(self.RUN_FIELDS)},
+        }
+
+
+class Snapshot:
+    """Everything simulate() depends on at the start of a turn, see Simulator.snapshot.
+
+    Characters are (cid, x, y, team_id, is_fork, health, selfbuf, record_index),
+    chests (cid, x, y, challenge, record_index) and players
+    (script, buffer, score, fork_cost, fork cids), with buffers as bytes.
+    """
+    def __init__(self, turn, next_cid, next_chest_id, rng_state, challenge_state,
+                 characters, chests, players, record_sizes, turn_event):
+        self.turn = turn
+        self.next_cid = next_cid
+        self.next_chest_id = next_chest_id
+        self.rng_state = rng_state
+        self.challenge_state = challenge_state
+        self.characters = characters
+        self.chests = chests
+        self.players = players
+        # (character rows, chest rows, tape length per character row)
+        self.record_sizes = record_sizes
+        self.turn_event = turn_event
+
+# how a fork run ended, see VM_STATUS_* in vm/vm.h
+VM_STATUS_OK = 0
+VM_STATUS_TIMEOUT = 1
+VM_STATUS_FAULT = 2
+
+# per-fork instruction limit for one turn, see vm_run in vm/vm.h (0 -> 250 ms wall clock only)
+DEFAULT_INSTRUCTION_BUDGET = 2_000_000
+# turns between automatic snapshots, seek() replays at most this many minus one
+DEFAULT_CHECKPOINT_INTERVAL = 10
+# characters a team may have at once, its player included
+DEFAULT_FORK_LIMIT = 4
+# chests planted with the map, and every CHEST_SPAWN_INTERVAL turns after that
+DEFAULT_INITIAL_CHESTS = 10
+DEFAULT_CHESTS_PER_SPAWN = 2
+CHEST_SPAWN_INTERVAL = 10
 
 MOVE_SCORE = 1
 KILL_FORK_SCORE = 40
 KILL_PLAYER_SCORE = 70
 
+# tape byte -> ascii digit, for the string opcodes of dump_character_records
+OPCODE_DIGITS = bytes.maketrans(bytes(range(8)), b"01234567")
+
 PATH = 0
 WALL = 1
 CHEST = 2
 CHARACTER = 4
 
 
-class Simulator:
+class RoundView:
+    """The read side of a round: dumps of its record and turn events for the web API.
+
+    Subclasses provide team_num, turn, record (a MatchRecord) and turn_events;
+    Simulator fills them as it plays, turnring.TurnFollower from the frames of
+    a round played in another process. Both call publish() after every change,
+    and request handlers read `published` rather than the live state.
+    """
+    team_num: int
+    turn: int
+    record: MatchRecord
+    turn_events: list[dict]
+    published: "RoundSnapshot | None" = None
+
+    def publish(self):
+        """Freeze the round as it is now and make it `published`, in one reference swap."""
+        version = self.published.version + 1 if self.published else 1
+        self.published = RoundSnapshot(version, self.team_num, self.turn, self.record.to_bytes(),
+                                       tuple(self.turn_events))
+
+    def dump_character_records(self):
+        records = {}
+        chars = self.record.chars
+        for i in range(self.record.char_count):
+            team = chars["team"][i]
+            if team not in records:
+                records[team] = []
+            records[team].append({
+                "cid": chars["cid"][i],
+                "opcodes": bytes(self.record.tapes[i]).translate(OPCODE_DIGITS).decode(),
+                "spawn_x": chars["spawn_x"][i],
+                "spawn_y": chars["spawn_y"][i],
+                "spawn_turn": chars["spawn_turn"][i],
+                "dead_turn": chars["dead_turn"][i],
+                "is_fork": bool(chars["is_fork"][i])
+            })
+        return json.dumps(records)
+    
+    def dump_chest_records(self):
+        records = []
+        chests = self.record.chests
+        for i in range(self.record.chest_count):
+            records.append({
+                "cid": chests["cid"][i],
+                "x": chests["x"][i],
+                "y": chests["y"][i],
+                "spawn_turn": chests["spawn_turn"][i],
+                "opened_turn": chests["opened_turn"][i]
+            })
+        return json.dumps(records)
+
+    def dump_replay(self) -> bytes:
+        """The match so far in the binary replay format, see replay.py."""
+        return self.record.to_bytes()
+
+    def dump_records_since(self, since: int):
+        """Records that changed during turns [since, turn), for incremental viewers.
+        `next` is the cursor to pass on the following call."""
+        turn = self.turn
+        since = max(0, min(since, turn))
+        characters = []
+        opcodes: dict[int, list[int]] = {}
+        dead = {}
+        chests = []
+        opened = {}
+        for event in self.turn_events[since:turn]:
+            characters += event["spawned"]
+            chests += event["chests"]
+            for cid, opcode in event["opcodes"]:
+                opcodes.setdefault(cid, []).append(opcode)
+            for cid in event["dead"]:
+                dead[cid] = event["turn"]
+            for cid in event["opened"]:
+                opened[cid] = event["turn"]
+        # scores[0] is the sample before turn 0, scores[t + 1] the one after turn t
+        score_offset = since + 1 if since else 0
+        return json.dumps({
+            "since": since,
+            "next": turn,
+            "characters": characters,
+            "opcodes": opcodes,
+            "dead": dead,
+            "chests": chests,
+            "opened": opened,
+            "score_offset": score_offset,
+            "scores": {team: self.record.score_column(team - 1, score_offset, turn + 1).tolist()
+                       for team in range(1, self.team_num + 1)}
+        })
+
+    def dump_scores(self):
+        # the last score sample, taken at the end of the previous turn
+        return {team: score for team, score in enumerate(self.record.scores[-self.team_num:], 1)}
+
+    def dump_score_records(self):
+        records = {}
+        for team in range(1, self.team_num + 1):
+            records[team] = self.record.score_column(team - 1).tolist()
+        return records
+
+
+class RoundSnapshot(RoundView):
+    """A published round: the record as a binary replay plus the turn events, never modified.
+
+    Readers need no lock, they just hold on to the snapshot they got. json()
+    serializes each dump at most once per snapshot, so polling clients cost
+    one serialization per turn rather than one per request.
+    """
+    def __init__(self, version: int, team_num: int, turn: int, replay: bytes, turn_events: tuple[dict, ...]):
+        self.version = version
+        self.team_num = team_num
+        self.turn = turn
+        self.replay = replay
+        self.record = MatchRecord.from_buffer(replay)
+        self.turn_events = turn_events
+        # (dump name, *args) -> UTF-8 JSON
+        self.serialized: dict[tuple, bytes] = {}
+
+    def dump_replay(self) -> bytes:
+        return self.replay
+
+    def json(self, name: str, *args) -> bytes:
+        """dump_<name>(*args) as JSON bytes, cached. Two readers racing on a miss both
+        serialize, and either result is kept, which is cheaper than a lock on every hit."""
+        key = (name, *args)
+        data = self.serialized.get(key)
+        if data is None:
+            value = getattr(self, f"dump_{name}")(*args)
+            data = self.serialized[key] = (value if isinstance(value, str) else json.dumps(value)).encode()
+        return data
+
+
+class Simulator(RoundView):
     players: list[Player]
-    chests: list[Chest]
-    char_records: dict[Character, CharacterRecord]
-    chest_records: dict[Chest, ChestRecord]
-    score_records: dict[Player, ScoreRecord]
+    chests: dict[int, Chest]
+    record: MatchRecord
     turn: int = 0
-    def __init__(self, team_num):
+    def __init__(self, team_num, instruction_budget: int = DEFAULT_INSTRUCTION_BUDGET, seed: int | None = None,
+                 metrics: Metrics = METRICS, maps: MapStore = MAPS,
+                 checkpoint_interval: int = DEFAULT_CHECKPOINT_INTERVAL,
+                 fork_limit: int = DEFAULT_FORK_LIMIT, initial_chests: int = DEFAULT_INITIAL_CHESTS,
+                 chests_per_spawn: int = DEFAULT_CHESTS_PER_SPAWN, profile: bool = False):
         self.base_dir = os.path.dirname(os.path.abspath(__file__))
         self.vm = CDLL(os.path.join(self.base_dir, "vm.lib"))
         '''
@@ -281,14 +704,15 @@ class Simulator:
             VM_Character** players, int player_count,
             VM_Chest** chests, int chest_count,
             unsigned char* map,
-            int scores, VM_Character* self
+            int scores, VM_Character* self,
+            unsigned int max_instructions
         );
         '''
         self.vm.vm_run.argtypes = [c_int, c_char_p, POINTER(c_uint),
                                     POINTER(POINTER(VM_Character)), c_int,
                                     POINTER(POINTER(VM_Chest)), c_int,
                                     POINTER(c_uint8),
-                                    c_int, POINTER(VM_Character)]
+                                    c_int, POINTER(VM_Character), c_uint]
         self.vm.vm_run.restype = c_int
         '''
         bool vm_parse_script(
@@ -297,220 +721,489 @@ class Simulator:
         '''
         self.vm.vm_parse_script.argtypes = [c_char_p, POINTER(c_int)]
         self.vm.vm_parse_script.restype = c_bool
+        '''
+        VM_Program* vm_compile(const char script[], int *error_line);
+        int vm_run_compiled(const VM_Program* program, ...same as vm_run after team_id...);
+        void vm_free(VM_Program* program);
+        '''
+        self.vm.vm_compile.argtypes = [c_char_p, POINTER(c_int)]
+        self.vm.vm_compile.restype = c_void_p
+        self.vm.vm_run_compiled.argtypes = [c_void_p, c_int, POINTER(c_uint),
+                                    POINTER(POINTER(VM_Character)), c_int,
+                                    POINTER(POINTER(VM_Chest)), c_int,
+                                    POINTER(c_uint8),
+                                    c_int, POINTER(VM_Character), c_uint]
+        self.vm.vm_run_compiled.restype = c_int
+        self.vm.vm_free.argtypes = [c_void_p]
+        self.vm.vm_free.restype = None
+        '''
+        void vm_run_batch(
+            const VM_Program** programs, const int* team_ids, const int* scores,
+            unsigned int** buffers, const int* fork_counts, int team_count,
+            VM_Character* characters, unsigned int* selfbufs,
+            const int* slots, int player_count,
+            const VM_Chest* chests, const int* chest_slots, int chest_count,
+            unsigned char* map,
+            unsigned int max_instructions,
+            int* opcodes,
+            int* statuses,
+            unsigned int* steps,
+            unsigned long long** hits,
+            unsigned long long* nanos
+        );
+        '''
+        self.vm.vm_run_batch.argtypes = [POINTER(c_void_p), POINTER(c_int), POINTER(c_int),
+                                    POINTER(POINTER(c_uint)), POINTER(c_int), c_int,
+                                    POINTER(VM_Character), POINTER(c_uint),
+                                    POINTER(c_int), c_int,
+                                    POINTER(VM_Chest), POINTER(c_int), c_int,
+                                    POINTER(c_uint8), c_uint,
+                                    POINTER(c_int), POINTER(c_int), POINTER(c_uint),
+                                    POINTER(POINTER(c_ulonglong)), POINTER(c_ulonglong)]
+        self.vm.vm_run_batch.restype = None
+        '''
+        unsigned int vm_program_size(const VM_Program* program);
+        void vm_program_lines(const VM_Program* program, unsigned int* lines);
+        '''
+        self.vm.vm_program_size.argtypes = [c_void_p]
+        self.vm.vm_program_size.restype = c_uint
+        self.vm.vm_program_lines.argtypes = [c_void_p, POINTER(c_uint)]
+        self.vm.vm_program_lines.restype = None
+        # script hash -> compiled program handle, kept while some player runs that script
+        self.programs: dict[bytes, int | None] = {}
+        self.instruction_budget = instruction_budget
+        # called with each finished turn event, see new_turn_event
+        self.listeners: list[Callable[[dict], None]] = []
+        self.metrics = metrics
+        self.maps = maps
+        self.checkpoint_interval = checkpoint_interval
+        self.fork_limit = fork_limit
+        self.initial_chests = initial_chests
+        self.chests_per_spawn = chests_per_spawn
+        # count every op and time every fork, see ScriptProfile; turns replayed by seek() count again
+        self.profile = profile
+        # every character and chest lives in these, see EntityStore
+        self.char_store = CharacterStore(team_num * fork_limit)
+        self.chest_store = ChestStore(2 * initial_chests)
+        # refreshed every turn, so disabled debug logging costs one attribute check per call site
+        self.debug = False
         self.team_num = team_num
+        # everything random in a match derives from the seed, so simulators never share state
+        self.seed = seed if seed is not None else random.randrange(2**63)
+        self.rng = random.Random(self.seed)
+        self.challenges = ChallengePool(rng=random.Random(self.rng.getrandbits(64)))
+        self.challenges.start()
         self.new_round()
         return
     def new_round(self):
-        global last_cid, last_chest_id
-        last_chest_id = 0
-        last_cid = 0
-        maps = glob.glob(os.path.join(self.base_dir, "maps/*.txt"))
-        self.read_map(random.choice(maps))
-
-    def read_map(self, map: str):
-        self.map = [[0 for i in range(MAP_SIZE)] for j in range(MAP_SIZE)]
-        m = open(map, "r").read()
-        i = 0
-        for line in m.splitlines():
-            if i == MAP_SIZE:
-                break
-            for j in range(MAP_SIZE):
-                if line[j] == '#':
-                    self.map[i][j] = 1
-            i += 1
+        self.next_cid = 0
+        self.next_chest_id = 0
+        self.load_map(self.maps.choice(self.rng))
+
+    def new_character(self, x: int, y: int, team_id: int, is_fork: bool) -> Character:
+        character = Character(self.char_store, self.next_cid, x, y, team_id, is_fork)
+        self.next_cid += 1
+        return character
+
+    def new_chest(self) -> Chest:
+        x, y = self.game_map.random_cell(self.rng)
+        chest = Chest(self.chest_store, self.next_chest_id, x, y, self.challenges.draw())
+        self.next_chest_id += 1
+        return chest
+
+    def load_map(self, game_map: GameMap):
+        self.game_map = game_map
+        # shared with every round on this map, read-only
+        self.map = game_map.rows
+        # row-major copy of the walls, the turn map is this plus chest/character bits
+        self.base_map = (c_uint8 * (MAP_SIZE * MAP_SIZE)).from_buffer_copy(game_map.grid)
+        self.turnmap = (c_uint8 * (MAP_SIZE * MAP_SIZE))()
+        memmove(self.turnmap, self.base_map, sizeof(self.base_map))
+        # cell index -> chest/character bits currently set in turnmap
+        self.overlay: dict[int, int] = {}
+        # cell index -> what stands there, kept up to date as characters move and chests open
+        self.char_cells: dict[int, list[Character]] = {}
+        self.chest_cells: dict[int, list[Chest]] = {}
 
-        # replant chests
-        self.chests = []
-        self.chest_records = {}
-        for i in range(10):
-            new_chest = Chest(self.map)
-            self.chests.append(new_chest)
-            self.chest_records[new_chest] = ChestRecord(new_chest.vm_chest.x, new_chest.vm_chest.y, self.turn)
+        self.turn_events = []
+        self.turn_event = self.new_turn_event()
+        # team id -> profile of its current script, while profiling
+        self.profiles: dict[int, ScriptProfile] = {}
+        self.record = MatchRecord(self.team_num, bytes(self.base_map))
+        # turn -> snapshot taken before that turn was simulated
+        self.checkpoints: dict[int, Snapshot] = {}
+
+        # replant chests, by cid in the order they were planted
+        self.char_store.clear()
+        self.chest_store.clear()
+        self.chests = {}
+        for i in range(self.initial_chests):
+            self.add_chest(self.new_chest())
 
         # respawn character
         self.players = []
-        self.char_records = {}
         for i in range(1, self.team_num + 1):
-            new_player = Player(i, "")
+            player_char = self.new_character(0, 0, i, False)
+            player_char.spawn(self.game_map, self.rng)
+            new_player = Player(i, "", player_char)
             self.players.append(new_player)
-            player_char = new_player.forks[0]
-            player_char.spawn(self.map)
-            self.char_records[player_char] = CharacterRecord(i, player_char.vm_char.x, player_char.vm_char.y, self.turn)
-        pass
-        self.score_records = {}
-        for p in self.players:
-            self.score_records[p] = ScoreRecord(p.id) 
+            self.add_character(player_char)
+        # per-team vm_run_batch arguments, refilled in place every turn
+        self.team_programs = (c_void_p * self.team_num)()
+        self.team_ids = (c_int * self.team_num)(*[player.id for player in self.players])
+        self.team_scores = (c_int * self.team_num)()
+        self.team_buffers = (POINTER(c_uint) * self.team_num)(
+            *[cast(pointer(player.buffer), POINTER(c_uint)) for player in self.players])
+        self.fork_counts = (c_int * self.team_num)()
+        self.team_hits = (POINTER(c_ulonglong) * self.team_num)()
+        self.publish()
+
+    def add_character(self, character: Character):
+        self.char_cells.setdefault(character.y * MAP_SIZE + character.x, []).append(character)
+        self.record_character(character)
+
+    def move_character(self, character: Character, x: int, y: int):
+        self.remove_character(character)
+        character.place(x, y)
+        self.char_cells.setdefault(y * MAP_SIZE + x, []).append(character)
+
+    def remove_character(self, character: Character):
+        cell = character.y * MAP_SIZE + character.x
+        occupants = self.char_cells[cell]
+        occupants.remove(character)
+        if not occupants:
+            del self.char_cells[cell]
+
+    def add_chest(self, chest: Chest):
+        self.chests[chest.cid] = chest
+        self.chest_cells.setdefault(chest.y * MAP_SIZE + chest.x, []).append(chest)
+        self.record_chest(chest)
+
+    def remove_chest(self, chest: Chest):
+        """Take the chest off the map and free its slot, the view is dead afterwards."""
+        del self.chests[chest.cid]
+        cell = chest.y * MAP_SIZE + chest.x
+        chests = self.chest_cells[cell]
+        chests.remove(chest)
+        if not chests:
+            del self.chest_cells[cell]
+        chest.release()
+
+    def neighbours(self, character: Character):
+        """Cell indices of the (up to 8) cells surrounding the character, see Character.can_interact."""
+        x, y = character.x, character.y
+        for ny in range(max(y - 1, 0), min(y + 2, MAP_SIZE)):
+            for nx in range(max(x - 1, 0), min(x + 2, MAP_SIZE)):
+                if nx != x or ny != y:
+                    yield ny * MAP_SIZE + nx
+
+    def new_turn_event(self) -> dict:
+        """Compact summary of one turn, appended to turn_events once the turn is simulated."""
+        return {
+            "turn": self.turn,
+            "spawned": [],
+            "dead": [],
+            "opcodes": [],
+            "chests": [],
+            "opened": [],
+            "scores": [],
+        }
+
+    def record_character(self, character: Character):
+        x, y, team_id = character.x, character.y, character.team_id
+        character.record_index = self.record.add_character(character.cid, team_id, character.is_fork,
+                                                           x, y, self.turn)
+        self.turn_event["spawned"].append({
+            "cid": character.cid,
+            "team": team_id,
+            "spawn_x": x,
+            "spawn_y": y,
+            "spawn_turn": self.turn,
+            "is_fork": character.is_fork
+        })
+
+    def record_chest(self, chest: Chest):
+        chest.record_index = self.record.add_chest(chest.cid, chest.x, chest.y, self.turn)
+        self.turn_event["chests"].append({
+            "cid": chest.cid,
+            "x": chest.x,
+            "y": chest.y,
+            "spawn_turn": self.turn
+        })
 
     def set_script(self, id: int, script: str):
         if id > len(self.players):
             return
-        self.players[id - 1].script = script
+        player = self.players[id - 1]
+        old = player.script_hash
+        player.script = script
+        self.drop_program(old)
+
+    def drop_program(self, key: bytes):
+        """Free the compiled program for a script hash once no player runs it any more."""
+        if any(player.script_hash == key for player in self.players):
+            return
+        program = self.programs.pop(key, None)
+        if program is not None:
+            self.vm.vm_free(program)
     
+    def get_program(self, player: Player) -> int | None:
+        """Return the compiled program for the player's script, compiling it on first use.
+        Scripts that fail to parse map to None, which the VM runs as `ret #0`."""
+        key = player.script_hash
+        if key not in self.programs:
+            error_line = c_int(0)
+            self.programs[key] = self.vm.vm_compile(player.script.encode(), pointer(error_line))
+        return self.programs[key]
+
+    def get_profile(self, player: Player, program: int | None) -> ScriptProfile | None:
+        """The profile of the player's current script, a new one whenever the script changes.
+        Scripts that fail to parse run no ops and get none."""
+        if program is None:
+            return None
+        profile = self.profiles.get(player.id)
+        if profile is None or profile.script_hash != player.script_hash:
+            lines = (c_uint * self.vm.vm_program_size(program))()
+            self.vm.vm_program_lines(program, lines)
+            profile = self.profiles[player.id] = ScriptProfile(player.script, player.script_hash, array("I", lines))
+        return profile
+
+    def dump_profile(self) -> list[dict]:
+        """Every team's ScriptProfile, empty unless profiling."""
+        return [{"team": team, "budget": self.instruction_budget, **profile.to_dict()}
+                for team, profile in sorted(self.profiles.items())]
+
+    def close(self):
+        self.challenges.stop()
+        for program in self.programs.values():
+            if program is not None:
+                self.vm.vm_free(program)
+        self.programs.clear()
+
+    def __del__(self):
+        if hasattr(self, "challenges"):
+            self.close()
+
     def check_script(self, script: str) -> tuple[bool, int]:
         error_line = c_int(0)
         success = self.vm.vm_parse_script(script.encode(), pointer(error_line))
         return (success, error_line.value)
     
     def move(self, player: Player, character: Character, dx:int, dy:int):
-        rx = character.vm_char.x + dx
-        ry = character.vm_char.y + dy
+        rx = character.x + dx
+        ry = character.y + dy
         if rx >= 0 and rx < MAP_SIZE and ry >= 0 and ry < MAP_SIZE:
             if self.map[ry][rx] == 0:
                 player.score += MOVE_SCORE
                 character.move_to = (rx, ry)
 
     def attack(self, player: Player, character: Character):
-        print("attack")
-        for p in self.players:
-            for fork in p.forks:
-                if character.can_interact(fork.vm_char.x, fork.vm_char.y):
+        if self.debug:
+            logger.debug("attack")
+        for cell in self.neighbours(character):
+            for fork in self.char_cells.get(cell, ()):
+                if self.debug:
                     if character.is_fork:
-                        print(f"attack player {p.id}")
+                        logger.debug("attack player %d", fork.team_id)
                     else:
-                        print(f"attack player {p.id} fork")    
-                    fork.last_attackers.add(player)
-                    fork.health -= 1
+                        logger.debug("attack player %d fork", fork.team_id)
+                fork.attackers |= 1 << (player.id - 1)
+                fork.health -= 1
         
 
     def interact(self, player: Player, character: Character):
-        print("interact")
-        for chest in self.chests:
-            if character.can_interact(chest.vm_chest.x, chest.vm_chest.y):
-                print("interact chest")
-
-                # the result is store in buf[50] ~ buf[57]
-                i = 1
-                for r in chest.result:
-                    # fill param
-                    if character.selfbuf[i] != r:
-                        character.selfbuf[0] = chest.type
-                        j = 1
-                        for p in chest.param:
-                            character.selfbuf[j] = p
-                            j +=1
-                        return
-                    i += 1
-                self.chests.remove(chest)
-                self.chest_records[chest].opened_turn = self.turn
-                player.score += chest.score
+        if self.debug:
+            logger.debug("interact")
+        # the earliest planted chest around the character
+        chest = min((chest for cell in self.neighbours(character) for chest in self.chest_cells.get(cell, ())),
+                    key=lambda chest: chest.cid, default=None)
+        if chest is None:
+            return
+        if self.debug:
+            logger.debug("interact chest")
+
+        # the result is store in buf[50] ~ buf[57]
+        selfbuf = character.selfbuf
+        i = 1
+        for r in chest.result:
+            # fill param
+            if selfbuf[i] != r:
+                selfbuf[0] = chest.type
+                j = 1
+                for p in chest.param:
+                    selfbuf[j] = p
+                    j +=1
                 return
+            i += 1
+        self.record.chests["opened_turn"][chest.record_index] = self.turn
+        self.turn_event["opened"].append(chest.cid)
+        player.score += chest.score
+        self.remove_chest(chest)
 
 
     def fork(self, player: Player, character: Character):
-        if len(player.forks) >= 4:
-            print("exceeds fork limit")
+        if len(player.forks) >= self.fork_limit:
+            if self.debug:
+                logger.debug("exceeds fork limit")
             return 
         if player.score >= player.fork_cost:
-            new_char = Character(character.vm_char.x, character.vm_char.y, player.id, True)
-            self.char_records[new_char] = CharacterRecord(player.id, new_char.vm_char.x, new_char.vm_char.y, self.turn)
+            new_char = self.new_character(character.x, character.y, player.id, True)
+            self.add_character(new_char)
             player.forks.append(new_char)
             player.score -= player.fork_cost
             player.fork_cost *= 1.2
             player.fork_cost = int(player.fork_cost)
-            print("fork")
+            if self.debug:
+                logger.debug("fork")
         return
     
-    def dump_character_records(self):
-        records = {}
-        for key, value in self.char_records.items():
-            if value.team_num not in records:
-                records[value.team_num] = []
-            records[value.team_num].append({
-                "cid": key.cid,
-                "opcodes": ''.join(str(i) for i in value.opcodes),
-                "spawn_x": value.spawn_x,
-                "spawn_y": value.spawn_y,
-                "spawn_turn": value.spawn_turn,
-                "dead_turn": value.dead_turn,
-                "is_fork": key.is_fork
-            })
-        return json.dumps(records)
-    
-    def dump_chest_records(self):
-        records = []
-        for key, value in self.chest_records.items():
-            records.append({
-                "cid": key.cid,
-                "x": value.x,
-                "y": value.y,
-                "spawn_turn": value.spawn_turn,
-                "opened_turn": value.opened_turn
-            })
-        return json.dumps(records)
-    def dump_scores(self):
-        scores = {}
-        for player in self.players:
-            scores[player.id] = player.score
-        return scores
-    
-    def dump_score_records(self):
-        records = {}
-        for key, value in self.score_records.items():
-            records[key.id] = value.scores
-        return records
+    def snapshot(self) -> Snapshot:
+        """Capture the match between two turns; restore() brings it back, records included."""
+        characters = [(c.cid, c.x, c.y, c.team_id, c.is_fork, c.health, bytes(c.selfbuf), c.record_index)
+                      for player in self.players for c in player.forks]
+        chests = [(c.cid, c.x, c.y, c.challenge, c.record_index) for c in self.chests.values()]
+        players = [(p.script, bytes(p.buffer), p.score, p.fork_cost, [c.cid for c in p.forks])
+                   for p in self.players]
+        record_sizes = (self.record.char_count, self.record.chest_count,
+                        array("I", [len(tape) for tape in self.record.tapes]))
+        return Snapshot(self.turn, self.next_cid, self.next_chest_id, self.rng.getstate(),
+                        self.challenges.getstate(), characters, chests, players, record_sizes,
+                        copy.deepcopy(self.turn_event))
+
+    def restore(self, snapshot: Snapshot):
+        """Go back (or forward) to a snapshot of this round. Records and turn events are cut back
+        to the snapshot's turn, and checkpoints after it are dropped since scripts may change."""
+        self.turn = snapshot.turn
+        self.next_cid = snapshot.next_cid
+        self.next_chest_id = snapshot.next_chest_id
+        self.rng.setstate(snapshot.rng_state)
+        self.challenges.setstate(snapshot.challenge_state)
+
+        self.char_cells = {}
+        self.chest_cells = {}
+        self.chests = {}
+        self.char_store.clear()
+        self.chest_store.clear()
+        for cid, x, y, challenge, record_index in snapshot.chests:
+            chest = Chest(self.chest_store, cid, x, y, challenge)
+            chest.record_index = record_index
+            self.chests[cid] = chest
+            self.chest_cells.setdefault(y * MAP_SIZE + x, []).append(chest)
+        characters = {}
+        for cid, x, y, team_id, is_fork, health, selfbuf, record_index in snapshot.characters:
+            character = Character(self.char_store, cid, x, y, team_id, is_fork)
+            character.health = health
+            memmove(character.selfbuf, selfbuf, len(selfbuf))
+            character.record_index = record_index
+            characters[cid] = character
+            self.char_cells.setdefault(y * MAP_SIZE + x, []).append(character)
+        replaced = {player.script_hash for player in self.players}
+        for player, (script, buffer, score, fork_cost, forks) in zip(self.players, snapshot.players):
+            player.script = script
+            memmove(pointer(player.buffer), buffer, len(buffer))
+            player.score = score
+            player.fork_cost = fork_cost
+            player.forks = [characters[cid] for cid in forks]
+        for key in replaced:
+            self.drop_program(key)
+
+        # the next update_turnmap rewrites every occupied cell
+        memmove(self.turnmap, self.base_map, sizeof(self.base_map))
+        self.overlay = {}
+
+        char_count, chest_count, tape_lengths = snapshot.record_sizes
+        self.record.truncate(snapshot.turn, char_count, chest_count, tape_lengths)
+        del self.turn_events[snapshot.turn:]
+        self.turn_event = copy.deepcopy(snapshot.turn_event)
+        for turn in [turn for turn in self.checkpoints if turn > snapshot.turn]:
+            del self.checkpoints[turn]
+        self.publish()
+
+    def seek(self, turn: int):
+        """Put the match at the start of `turn`. Going back restores the closest checkpoint at or
+        before it and replays the rest; listeners are not called for replayed turns."""
+        if turn < self.turn:
+            start = max((t for t in self.checkpoints if t <= turn), default=None)
+            if start is None:
+                raise ValueError(f"no checkpoint at or before turn {turn}")
+            self.restore(self.checkpoints[start])
+        listeners, self.listeners = self.listeners, []
+        try:
+            while self.turn < turn:
+                self.simulate()
+        finally:
+            self.listeners = listeners
+
+    def update_turnmap(self):
+        """Bring turnmap up to date with the chests and characters, only rewriting cells that changed."""
+        overlay = dict.fromkeys(self.chest_cells, CHEST)
+        for cell in self.char_cells:
+            overlay[cell] = overlay.get(cell, 0) | CHARACTER
+        turnmap, base_map, previous = self.turnmap, self.base_map, self.overlay
+        for cell in previous.keys() - overlay.keys():
+            turnmap[cell] = base_map[cell]
+        for cell, bits in overlay.items():
+            if previous.get(cell) != bits:
+                turnmap[cell] = base_map[cell] | bits
+        self.overlay = overlay
 
     def simulate(self):
-        character_num = 0
-        self.turnmap = ((c_uint8 * MAP_SIZE) * MAP_SIZE)()
-        for i in range(MAP_SIZE):
-            for j in range(MAP_SIZE):
-                self.turnmap[i][j] = self.map[i][j]
-        if self.turn % 10 == 0:
-            for i in range(2):
-                new_chest = Chest(self.map)
-                self.chests.append(new_chest)
-                self.chest_records[new_chest] = ChestRecord(new_chest.vm_chest.x, new_chest.vm_chest.y, self.turn)
+        self.debug = logger.isEnabledFor(logging.DEBUG)
+        if self.checkpoint_interval and self.turn % self.checkpoint_interval == 0:
+            self.checkpoints[self.turn] = self.snapshot()
+        t0 = time.perf_counter()
+        if self.turn % CHEST_SPAWN_INTERVAL == 0:
+            for i in range(self.chests_per_spawn):
+                self.add_chest(self.new_chest())
+        t1 = time.perf_counter()
         # fill map data
-        for chest in self.chests:
-            self.turnmap[chest.vm_chest.y][chest.vm_chest.x] |= CHEST
-
-        for player in self.players:
-            for fork in player.forks:
-                self.turnmap[fork.vm_char.y][fork.vm_char.x] |= CHARACTER
+        self.update_turnmap()
+        t2 = time.perf_counter()
 
         # count total character number
 
-        for player in self.players:    
-            character_num += len(player.forks)
+        forks = [(player, fork) for player in self.players for fork in player.forks]
+        character_num = len(forks)
+        chest_num = len(self.chests)
+        team_num = len(self.players)
 
-        characters = (POINTER(VM_Character) * character_num)()
-        chests = (POINTER(VM_Chest) * len(self.chests))()
-        i = 0
-        for player in self.players:
-            for fork in player.forks:
-                characters[i] = pointer(fork.vm_char)
-                i += 1
-
-        i = 0
-        for chest in self.chests:
-                chests[i] = pointer(chest.vm_chest)
-                i += 1
+        # the VM reads the stores' columns directly, only the slots to run and their order are filled in
+        chars, chests = self.char_store, self.chest_store
+        chars.order[:character_num] = [fork.slot for _, fork in forks]
+        chests.order[:chest_num] = [chest.slot for chest in self.chests.values()]
+        self.team_programs[:] = [self.get_program(player) for player in self.players]
+        self.team_scores[:] = [player.score for player in self.players]
+        self.fork_counts[:] = [len(player.forks) for player in self.players]
+        if self.profile:
+            profiles = [self.get_profile(player, program) for player, program in zip(self.players, self.team_programs)]
+            self.team_hits[:] = [profile.hits_pointer if profile else None for profile in profiles]
 
+        # every fork of every team in one native call
+        self.vm.vm_run_batch(self.team_programs, self.team_ids, self.team_scores, self.team_buffers,
+                             self.fork_counts, team_num,
+                             chars.vm, chars.selfbufs, chars.order, character_num,
+                             chests.vm, chests.order, chest_num, self.turnmap,
+                             self.instruction_budget, chars.opcodes, chars.statuses, chars.steps,
+                             self.team_hits if self.profile else None, chars.nanos if self.profile else None)
+        t3 = time.perf_counter()
+        opcodes = chars.opcodes[:character_num]
+        statuses = chars.statuses[:character_num]
+        steps = chars.steps[:character_num]
+        if self.profile:
+            for (player, fork), step, status, nanos in zip(forks, steps, statuses, chars.nanos[:character_num]):
+                profile = profiles[player.id - 1]
+                if profile:
+                    profile.runs.append((self.turn, fork.cid, step, status, nanos))
 
         # record results
-        character_opcode = []
-        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.players)) as executor:
-            def execute_vm(player: Player):
-                result_list = []
-                for fork in player.forks:
-                    memset(player.buffer.tmp, 0, 42 * sizeof(c_uint))
-                    memmove(player.buffer.self, fork.selfbuf, 8 * sizeof(c_uint))
-                    opcode = 0
-                    opcode = self.vm.vm_run(player.id, player.script.encode(), cast(pointer(player.buffer), POINTER(c_uint)),
-                            characters, character_num,
-                            chests, len(self.chests), cast(pointer(self.turnmap), POINTER(c_uint8)), player.score, fork.vm_char)
-                    memmove(fork.selfbuf, player.buffer.self, 8 * sizeof(c_uint))
-                    result_list.append((player, fork, opcode))
-                return result_list
-            jobs:list[concurrent.futures.Future] = []
-            for player in self.players:
-                jobs.append(executor.submit(execute_vm, player))
-            for job in jobs:
-                character_opcode += job.result()
+        character_opcode = [(player, fork, opcode) for (player, fork), opcode in zip(forks, opcodes)]
         # do operations
         for player, character, opcode in character_opcode:
-            if character in self.char_records:
-                self.char_records[character].opcodes.append(opcode)
+            # a division by zero (-1) does nothing, same as stop, records keep opcodes in 0-7
+            opcode = max(opcode, 0)
+            if character.record_index >= 0:
+                self.record.tapes[character.record_index].append(opcode)
+                self.turn_event["opcodes"].append([character.cid, opcode])
             match opcode:
                 case 1:
                     self.move(player, character, 0, -1)
@@ -526,31 +1219,52 @@ class Simulator:
                     self.attack(player, character)
                 case 7:
                     self.fork(player, character)
-        # remove dead characters
+        # apply moves and remove dead characters
         for player in self.players:
+            survivors = []
+            respawned = []
             for fork in player.forks:
                 if fork.move_to != None:
-                    fork.vm_char.x, fork.vm_char.y = fork.move_to
-                    print(f"{player.id}: move to {fork.vm_char.x} {fork.vm_char.y}")
+                    self.move_character(fork, *fork.move_to)
+                    if self.debug:
+                        logger.debug("%d: move to %d %d", player.id, fork.x, fork.y)
                     fork.move_to = None
-                if fork.health <= 0:
-                    player.forks.remove(fork)
-                    for attacker in fork.last_attackers:
-                        self.char_records[fork].dead_turn = self.turn
-                        if fork.is_fork:
-                            attacker.score += KILL_FORK_SCORE
-                        else:
-                            attacker.score += KILL_PLAYER_SCORE
-
-                    if not fork.is_fork:
-                        # respawn
-                        new_char = Character(0, 0, player.id, False)
-                        new_char.spawn(self.map)
-                        self.char_records[new_char] = CharacterRecord(player.id, new_char.vm_char.x, new_char.vm_char.y, self.turn)
-                        player.forks.append(new_char)
-                fork.last_attackers.clear()
-
-        for p in self.players:
-            self.score_records[p].scores.append(p.score)
+                if fork.health > 0:
+                    fork.attackers = 0
+                    survivors.append(fork)
+                    continue
+                self.remove_character(fork)
+                self.turn_event["dead"].append(fork.cid)
+                attackers = fork.attackers
+                for attacker in self.players:
+                    if not attackers >> (attacker.id - 1) & 1:
+                        continue
+                    self.record.chars["dead_turn"][fork.record_index] = self.turn
+                    if fork.is_fork:
+                        attacker.score += KILL_FORK_SCORE
+                    else:
+                        attacker.score += KILL_PLAYER_SCORE
+                fork.release()
+
+                if not fork.is_fork:
+                    # respawn
+                    new_char = self.new_character(0, 0, player.id, False)
+                    new_char.spawn(self.game_map, self.rng)
+                    self.add_character(new_char)
+                    respawned.append(new_char)
+            player.forks = survivors + respawned
+        t4 = time.perf_counter()
+
+        self.record.add_scores([p.score for p in self.players])
+        self.turn_event["scores"] = [p.score for p in self.players]
+        self.turn_events.append(self.turn_event)
+        for listener in self.listeners:
+            listener(self.turn_event)
         self.turn += 1
+        self.turn_event = self.new_turn_event()
+        self.publish()
+        t5 = time.perf_counter()
+
+        self.metrics.observe_turn({"chests": t1 - t0, "map": t2 - t1, "vm": t3 - t2, "actions": t4 - t3, "records": t5 - t4},
+                                  steps, statuses.count(VM_STATUS_TIMEOUT), statuses.count(VM_STATUS_FAULT))
         return
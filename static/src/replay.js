@@ -0,0 +1,43 @@
+// decoder for the binary replay served by /api/replay.bin, layout in replay.py
+const MAGIC = 0x52484f4b; // "KOHR"
+const VERSION = 1;
+const MAP_SIZE = 50;
+const CHAR_COLUMNS = ["cid", "team", "is_fork", "spawn_x", "spawn_y", "spawn_turn", "dead_turn"];
+const CHEST_COLUMNS = ["cid", "x", "y", "spawn_turn", "opened_turn"];
+
+// columns are typed array views into the buffer, nothing is copied
+export function decodeReplay(buffer) {
+    const view = new DataView(buffer);
+    if (view.getUint32(0, true) !== MAGIC || view.getUint16(4, true) !== VERSION) {
+        throw new Error("not a replay file");
+    }
+    const team_num = view.getUint16(6, true);
+    const turns = view.getUint32(8, true);
+    const char_count = view.getUint32(12, true);
+    const chest_count = view.getUint32(16, true);
+    const tape_size = view.getUint32(20, true);
+    let offset = 24;
+
+    const map = new Uint8Array(buffer, offset, MAP_SIZE * MAP_SIZE);
+    offset += MAP_SIZE * MAP_SIZE;
+    const chars = {};
+    for (const name of CHAR_COLUMNS) {
+        chars[name] = new Int32Array(buffer, offset, char_count);
+        offset += 4 * char_count;
+    }
+    const tape_start = new Int32Array(buffer, offset, char_count + 1);
+    offset += 4 * (char_count + 1);
+    const tapes = [];
+    for (let i = 0; i < char_count; i++) {
+        tapes.push(new Uint8Array(buffer, offset + tape_start[i], tape_start[i + 1] - tape_start[i]));
+    }
+    offset += (tape_size + 3) & ~3;
+    const chests = {};
+    for (const name of CHEST_COLUMNS) {
+        chests[name] = new Int32Array(buffer, offset, chest_count);
+        offset += 4 * chest_count;
+    }
+    // scores[t * team_num + team - 1], row 0 is the start of the round
+    const scores = new Int32Array(buffer, offset, (turns + 1) * team_num);
+    return { team_num, turns, map, chars, tapes, chests, scores };
+}
@@ -1,3 +1,5 @@
+import { decodeReplay } from "../replay.js";
+
 // status: "running", "shutdown"
 const RUNNING = "running";
 const SHUTDOWN = "shutdown"
@@ -66,10 +68,15 @@ export class Start extends Phaser.Scene {
             all: Phaser.Input.Keyboard.KeyCodes.TWO
         });
 
-        this.start_game();
+        // ?replay=<round> shows an archived round instead of following the live one
+        const replay = new URLSearchParams(window.location.search).get("replay");
+        if (replay !== null) {
+            this.load_replay(replay);
+        } else {
+            this.connect_stream();
+        }
     }
-    start_event = null;
-    sync_event = null;
+    stream = null;
 
     reset() {
         for (let chest of Object.values(this.chests)) {
@@ -118,122 +125,126 @@ export class Start extends Phaser.Scene {
         }
     }
 
-    restart() {
-        console.log("restart");
-        if (this.sync_event) {
-            this.sync_event.remove();
-        }
-        this.status = SHUTDOWN;
-        this.start_event = this.time.addEvent({
-            delay: 1000, // 毫秒
-            callback: this.start_game,
-            callbackScope: this,
-            loop: true
+    // one event per simulated turn, plus round_start / round_finish
+    connect_stream() {
+        this.stream = new EventSource(`${HOST}/api/stream`);
+        this.stream.addEventListener("round_start", (e) => this.start_round(JSON.parse(e.data)));
+        this.stream.addEventListener("turn", (e) => this.apply_turn(JSON.parse(e.data)));
+        this.stream.addEventListener("round_finish", (e) => {
+            const info = JSON.parse(e.data);
+            console.log("round finished", info);
+            // the finished round as one binary replay, in case the stream dropped events
+            this.load_replay(info.round);
         });
     }
 
-    async start_game() {
-        this.reset();
-        let r = await fetch(`${HOST}/api/round_info`).then(r => r.json());
-        if (r["status"] == "running") {
-            this.status = RUNNING;
-        } else {
-            if (this.status == RUNNING) {
-                this.restart();
-            } else {
-                this.status = SHUTDOWN;
-            }
+    async load_replay(round) {
+        let buffer;
+        try {
+            buffer = await fetch(`${HOST}/api/replay.bin?round=${round}`).then(r => r.arrayBuffer());
+        } catch {
             return;
         }
+        const replay = decodeReplay(buffer);
+        this.reset();
+        this.map = Array.from({ length: 50 }, (_, y) => Array.from(replay.map.subarray(y * 50, y * 50 + 50)));
+        this.create_map();
 
-        if (this.start_event) {
-            this.start_event.remove();
-            this.start_event = null;
+        const { chars, chests } = replay;
+        for (let i = 0; i < chars.cid.length; i++) {
+            this.characters[chars.cid[i]] = {
+                player: chars.team[i],
+                spawn_x: chars.spawn_x[i],
+                spawn_y: chars.spawn_y[i],
+                opcodes: Array.from(replay.tapes[i]),
+                spawn_turn: chars.spawn_turn[i],
+                dead_turn: chars.dead_turn[i],
+                sprite: this.add.image(
+                    chars.spawn_x[i] * displayTileSize - displayTileSize / 2,
+                    chars.spawn_y[i] * displayTileSize - displayTileSize,
+                    `character-${chars.team[i]}`
+                ).setScale(scaleFactor).setOrigin(0)
+            };
+        }
+        for (let i = 0; i < chests.cid.length; i++) {
+            this.chests[chests.cid[i]] = {
+                cid: chests.cid[i],
+                x: chests.x[i],
+                y: chests.y[i],
+                spawn_turn: chests.spawn_turn[i],
+                opened_turn: chests.opened_turn[i],
+                sprite: this.add.image(
+                    chests.x[i] * displayTileSize,
+                    chests.y[i] * displayTileSize,
+                    "chest"
+                ).setScale(scaleFactor).setOrigin(0)
+            };
+        }
+        this.scores = {};
+        for (let id = 1; id <= replay.team_num; id++) {
+            this.scores[id] = [];
+            for (let t = 0; t <= replay.turns; t++) {
+                this.scores[id].push(replay.scores[t * replay.team_num + id - 1]);
+            }
         }
-        console.log(this.status)
-        this.map = await this.get_map();
-        this.create_map();
-        this.sync_score();
         this.load_score();
-        this.sync_character();
-        this.sync_chest();
-        this.sync_event = this.time.addEvent({
-            delay: 1000, // 毫秒
-            callback: async () => {
-                let r = await fetch(`${HOST}/api/round_info`).then(r => r.json());
-                if (r["status"] != "running") {
-                    this.restart();
-                    return;
-                }
-                if (!r["simulate_finished"]) {
-                    this.sync_character();
-                    this.sync_chest();
-                    this.sync_score();
-                }
-            },
-            callbackScope: this,
-            loop: true
-        });
     }
 
-    async sync_character() {
-        console.log("sync character");
-        let records = await fetch(`${HOST}/get_character_records`).then(r => r.json());
-        let i = 1;
-        for (const [player, charList] of Object.entries(records)) {
-            for (const char of charList) {
-                if (!this.characters[char.cid]) {
-                    this.characters[char.cid] = {
-                        player: player,
-                        spawn_x: char.spawn_x,
-                        spawn_y: char.spawn_y,
-                        opcodes: char.opcodes.split('').map(o => parseInt(o)),
-                        spawn_turn: char.spawn_turn,
-                        dead_turn: char.dead_turn,
-                        sprite: this.add.image(
-                            char.spawn_x * displayTileSize - displayTileSize / 2,
-                            char.spawn_y * displayTileSize - displayTileSize,
-                            `character-${i}`
-                        ).setScale(scaleFactor).setOrigin(0)
-                    };
-                } else {
-                    this.characters[char.cid].opcodes = char.opcodes.split('').map(o => parseInt(o));
-                    this.characters[char.cid].dead_turn = char.dead_turn;
-                }
-            }
-            i++;
+    async start_round(info) {
+        console.log("round start", info);
+        this.reset();
+        this.status = RUNNING;
+        this.scores = {};
+        for (let id = 1; id <= info.team_num; id++) {
+            this.scores[id] = [0];
         }
-        console.log(records);
+        this.load_score();
+        this.map = await this.get_map();
+        this.create_map();
     }
 
-    async sync_chest() {
-        console.log("sync chest");
-        let records = await fetch(`${HOST}/get_chest_records`).then(r => r.json());
-        for (const chest of records) {
-            if (!this.chests[chest.cid]) {
-                this.chests[chest.cid] = {
-                    cid: chest.cid,
-                    x: chest.x,
-                    y: chest.y,
-                    spawn_turn: chest.spawn_turn,
-                    opened_turn: chest.opened_turn,
-                    sprite: this.add.image(
-                        chest.x * displayTileSize,
-                        chest.y * displayTileSize,
-                        "chest"
-                    ).setScale(scaleFactor).setOrigin(0)
-                };
-            } else {
-                this.chests[chest.cid].opened_turn = chest.opened_turn;
-            }
+    apply_turn(event) {
+        for (const char of event.spawned) {
+            this.characters[char.cid] = {
+                player: char.team,
+                spawn_x: char.spawn_x,
+                spawn_y: char.spawn_y,
+                opcodes: [],
+                spawn_turn: char.spawn_turn,
+                dead_turn: -1,
+                sprite: this.add.image(
+                    char.spawn_x * displayTileSize - displayTileSize / 2,
+                    char.spawn_y * displayTileSize - displayTileSize,
+                    `character-${char.team}`
+                ).setScale(scaleFactor).setOrigin(0)
+            };
         }
-        console.log(records);
-    }
-    async sync_score() {
-        console.log("sync score");
-        let records = await fetch(`${HOST}/get_score_records`).then(r => r.json());
-        this.scores = records;
-        console.log(this.scores);
+        for (const [cid, opcode] of event.opcodes) {
+            this.characters[cid].opcodes.push(opcode);
+        }
+        for (const cid of event.dead) {
+            this.characters[cid].dead_turn = event.turn;
+        }
+        for (const chest of event.chests) {
+            this.chests[chest.cid] = {
+                cid: chest.cid,
+                x: chest.x,
+                y: chest.y,
+                spawn_turn: chest.spawn_turn,
+                opened_turn: -1,
+                sprite: this.add.image(
+                    chest.x * displayTileSize,
+                    chest.y * displayTileSize,
+                    "chest"
+                ).setScale(scaleFactor).setOrigin(0)
+            };
+        }
+        for (const cid of event.opened) {
+            this.chests[cid].opened_turn = event.turn;
+        }
+        event.scores.forEach((score, i) => {
+            this.scores[i + 1].push(score);
+        });
     }
 
     async get_map() {
@@ -0,0 +1,198 @@
+'''
+Offline tournaments between scripts.
+
+    python tournament.py a.txt b.txt c.txt                    round robin, 1v1, every map
+    python tournament.py *.txt --format swiss --rounds 5      Swiss system
+    python tournament.py *.txt --size 4 --seeds 3 --json out.json
+
+Every pairing plays one game per (seed, map). Games run on a process pool
+(spawn context: the VM's worker threads and the challenge pool make fork
+unsafe), each in a fresh Simulator, so results only depend on the inputs.
+'''
+import argparse
+import concurrent.futures
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import statistics
+from typing import Callable
+
+from mapstore import MAPS, MapStore
+from simulator import Simulator
+
+ROUND_ROBIN = "round-robin"
+SWISS = "swiss"
+# two-sided 95% normal quantile
+Z_95 = 1.96
+
+
+def play_game(scripts: list[str], seed: int, map_index: int, turns: int) -> list[int]:
+    """Scores of one game, in seat order. Runs in a pool worker."""
+    sim = Simulator(len(scripts), seed=seed, maps=MapStore([MAPS.maps[map_index]]))
+    try:
+        for team, script in enumerate(scripts, 1):
+            sim.set_script(team, script)
+        for _ in range(turns):
+            sim.simulate()
+        scores = sim.dump_scores()
+        return [scores[team] for team in range(1, len(scripts) + 1)]
+    finally:
+        sim.close()
+
+
+class Tournament:
+    def __init__(self, names: list[str], scripts: list[str], size: int = 2, seeds: int = 1,
+                 maps: list[int] | None = None, turns: int = 200, processes: int | None = None):
+        if len(scripts) < size:
+            raise ValueError(f"need at least {size} scripts for {size}-team games")
+        self.names = names
+        self.scripts = scripts
+        self.size = size
+        self.seeds = seeds
+        self.maps = maps if maps is not None else list(range(len(MAPS.maps)))
+        self.turns = turns
+        self.processes = processes or os.cpu_count() or 1
+        # (players in seat order, seed, map index, scores in seat order)
+        self.games: list[tuple[tuple[int, ...], int, int, list[int]]] = []
+        self.byes = [0] * len(scripts)
+
+    def games_for(self, group: tuple[int, ...]) -> list[tuple[tuple[int, ...], int, int]]:
+        games = []
+        for i, (seed, map_index) in enumerate(itertools.product(range(self.seeds), self.maps)):
+            # rotate seats so no script keeps the same team slot in every game
+            shift = i % len(group)
+            games.append((group[shift:] + group[:shift], seed, map_index))
+        return games
+
+    def play(self, pool: concurrent.futures.Executor, games, progress: Callable[[int], None] | None = None):
+        futures = {pool.submit(play_game, [self.scripts[p] for p in players], seed, map_index, self.turns):
+                   (players, seed, map_index) for players, seed, map_index in games}
+        for future in concurrent.futures.as_completed(futures):
+            players, seed, map_index = futures[future]
+            self.games.append((players, seed, map_index, future.result()))
+            if progress:
+                progress(len(self.games))
+
+    def run(self, format: str = ROUND_ROBIN, rounds: int | None = None,
+            progress: Callable[[int], None] | None = None) -> list[dict]:
+        context = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(self.processes, mp_context=context) as pool:
+            if format == ROUND_ROBIN:
+                games = [game for group in itertools.combinations(range(len(self.scripts)), self.size)
+                         for game in self.games_for(group)]
+                self.play(pool, games, progress)
+            elif format == SWISS:
+                if self.size != 2:
+                    raise ValueError("swiss pairings are 1v1")
+                played: set[frozenset[int]] = set()
+                for _ in range(rounds or max(1, math.ceil(math.log2(len(self.scripts))))):
+                    pairs, bye = swiss_pairings(self.standings(), played, self.byes)
+                    if bye is not None:
+                        self.byes[bye] += 1
+                    played.update(frozenset(pair) for pair in pairs)
+                    self.play(pool, [game for pair in pairs for game in self.games_for(pair)], progress)
+            else:
+                raise ValueError(f"unknown format {format!r}")
+        return self.leaderboard()
+
+    def standings(self) -> list[int]:
+        """Script indices, best first."""
+        board = self.leaderboard()
+        return [entry["index"] for entry in board]
+
+    def leaderboard(self) -> list[dict]:
+        scores = [[] for _ in self.scripts]
+        wins = [0] * len(self.scripts)
+        draws = [0] * len(self.scripts)
+        for players, _, _, result in self.games:
+            best = max(result)
+            winners = [p for p, score in zip(players, result) if score == best]
+            for p, score in zip(players, result):
+                scores[p].append(score)
+                if score == best:
+                    if len(winners) == 1:
+                        wins[p] += 1
+                    else:
+                        draws[p] += 1
+        board = []
+        for i, name in enumerate(self.names):
+            n = len(scores[i])
+            mean = statistics.fmean(scores[i]) if n else 0.0
+            # normal approximation, the interval of the mean score over this script's games
+            half = Z_95 * statistics.stdev(scores[i]) / math.sqrt(n) if n > 1 else None
+            board.append({
+                "index": i,
+                "name": name,
+                "games": n,
+                "wins": wins[i],
+                "draws": draws[i],
+                "losses": n - wins[i] - draws[i],
+                # a bye counts as a win
+                "points": wins[i] + draws[i] / 2 + self.byes[i],
+                "mean_score": mean,
+                "ci95": None if half is None else [mean - half, mean + half],
+            })
+        board.sort(key=lambda entry: (-entry["points"], -entry["mean_score"], entry["index"]))
+        return board
+
+
+def swiss_pairings(standings: list[int], played: set[frozenset[int]],
+                   byes: list[int]) -> tuple[list[tuple[int, int]], int | None]:
+    """Pair neighbours in the standings, skipping rematches where possible.
+    Returns the pairs and the script left with a bye (odd count), if any: the
+    lowest ranked of the scripts with the fewest byes so far."""
+    remaining = list(standings)
+    bye = None
+    if len(remaining) % 2:
+        fewest = min(byes[p] for p in remaining)
+        bye = next(p for p in reversed(remaining) if byes[p] == fewest)
+        remaining.remove(bye)
+    pairs = []
+    while remaining:
+        a = remaining.pop(0)
+        b = next((b for b in remaining if frozenset((a, b)) not in played), remaining[0])
+        remaining.remove(b)
+        pairs.append((a, b))
+    return pairs, bye
+
+
+def format_leaderboard(board: list[dict]) -> str:
+    lines = [f"{'#':>3} {'script':24} {'pts':>6} {'W-D-L':>10} {'mean':>9} {'95% CI':>21}"]
+    for rank, entry in enumerate(board, 1):
+        ci = "" if entry["ci95"] is None else f"[{entry['ci95'][0]:8.1f}, {entry['ci95'][1]:8.1f}]"
+        wdl = f"{entry['wins']}-{entry['draws']}-{entry['losses']}"
+        lines.append(f"{rank:>3} {entry['name'][:24]:24} {entry['points']:>6.1f} {wdl:>10} "
+                     f"{entry['mean_score']:>9.1f} {ci:>21}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play scripts against each other.")
+    parser.add_argument("scripts", nargs="+", help="script files")
+    parser.add_argument("--format", choices=[ROUND_ROBIN, SWISS], default=ROUND_ROBIN)
+    parser.add_argument("--rounds", type=int, default=None, help="swiss rounds, default log2(scripts)")
+    parser.add_argument("--size", type=int, default=2, help="teams per game (round robin)")
+    parser.add_argument("--seeds", type=int, default=1, help="seeds per pairing and map")
+    parser.add_argument("--maps", type=int, nargs="*", default=None, help="map indices, default all")
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--processes", type=int, default=None, help="default one per CPU")
+    parser.add_argument("--json", help="also write the leaderboard and every game here")
+    args = parser.parse_args()
+
+    scripts = []
+    for path in args.scripts:
+        with open(path, "r") as f:
+            scripts.append(f.read())
+    tournament = Tournament([os.path.basename(path) for path in args.scripts], scripts, args.size,
+                            args.seeds, args.maps, args.turns, args.processes)
+    board = tournament.run(args.format, args.rounds)
+    print(format_leaderboard(board))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"leaderboard": board, "games": tournament.games}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
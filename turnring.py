@@ -0,0 +1,294 @@
+from array import array
+import json
+from multiprocessing import shared_memory
+import struct
+
+from metrics import PHASES
+from replay import MatchRecord
+from simulator import MAP_SIZE, RoundView
+
+'''
+Turn frames, little-endian, written by a round played in another process:
+
+    start    u8 kind, u16 team_num, map MAP_SIZE * MAP_SIZE bytes (the walls),
+             then the UTF-8 map name
+    turn     u8 kind, u32 turn, u32 counts of spawned, dead, opcodes, chests, opened
+             then int32 columns: spawned (cid, team, spawn_x, spawn_y, spawn_turn,
+             is_fork per character), dead cids, opcode cids, chests (cid, x, y,
+             spawn_turn per chest), opened cids, scores (team_num), and finally
+             one opcode byte per opcode cid
+    metrics  u8 kind, f64 seconds per phase (metrics.PHASES), u32 timeouts,
+             u32 faults, u32 forks, then u32 steps per fork
+    finish   u8 kind, u8 outcome
+    profile  u8 kind, then Simulator.dump_profile() as UTF-8 JSON, written
+             once before finish by a profiling round
+
+A turn frame carries exactly one Simulator turn event, so positions are
+those of the replay format: spawn cells plus the opcode tape.
+'''
+FRAME_START = 0
+FRAME_TURN = 1
+FRAME_METRICS = 2
+FRAME_FINISH = 3
+FRAME_PROFILE = 4
+
+OUTCOME_FINISHED = 0
+OUTCOME_CANCELLED = 1
+
+START_HEADER = struct.Struct("<BxH")
+TURN_HEADER = struct.Struct("<BxxxIIIIII")
+METRICS_HEADER = struct.Struct(f"<Bxxx{len(PHASES)}dIII")
+FINISH_FRAME = struct.Struct("<BB")
+
+SPAWN_FIELDS = ("cid", "team", "spawn_x", "spawn_y", "spawn_turn", "is_fork")
+CHEST_FIELDS = ("cid", "x", "y", "spawn_turn")
+
+
+def frame_kind(frame: bytes) -> int:
+    return frame[0]
+
+
+def encode_start(team_num: int, map: bytes, map_name: str) -> bytes:
+    return START_HEADER.pack(FRAME_START, team_num) + bytes(map) + map_name.encode()
+
+
+def decode_start(frame: bytes) -> tuple[int, bytes, str]:
+    _, team_num = START_HEADER.unpack_from(frame)
+    map_end = START_HEADER.size + MAP_SIZE * MAP_SIZE
+    return team_num, frame[START_HEADER.size:map_end], frame[map_end:].decode()
+
+
+def encode_turn(event: dict) -> bytes:
+    spawned = array("i", [int(character[field]) for character in event["spawned"] for field in SPAWN_FIELDS])
+    chests = array("i", [chest[field] for chest in event["chests"] for field in CHEST_FIELDS])
+    cids = array("i", [cid for cid, _ in event["opcodes"]])
+    return b"".join([
+        TURN_HEADER.pack(FRAME_TURN, event["turn"], len(event["spawned"]), len(event["dead"]),
+                         len(event["opcodes"]), len(event["chests"]), len(event["opened"])),
+        spawned.tobytes(),
+        array("i", event["dead"]).tobytes(),
+        cids.tobytes(),
+        chests.tobytes(),
+        array("i", event["opened"]).tobytes(),
+        array("i", event["scores"]).tobytes(),
+        bytes(opcode for _, opcode in event["opcodes"]),
+    ])
+
+
+def decode_turn(frame: bytes, team_num: int) -> dict:
+    """The turn event encode_turn was given."""
+    _, turn, n_spawned, n_dead, n_opcodes, n_chests, n_opened = TURN_HEADER.unpack_from(frame)
+    offset = TURN_HEADER.size
+
+    def take(count: int) -> array:
+        nonlocal offset
+        column = array("i", frame[offset:offset + 4 * count])
+        offset += 4 * count
+        return column
+
+    spawned = take(n_spawned * len(SPAWN_FIELDS))
+    dead = take(n_dead)
+    cids = take(n_opcodes)
+    chests = take(n_chests * len(CHEST_FIELDS))
+    opened = take(n_opened)
+    scores = take(team_num)
+    opcodes = frame[offset:offset + n_opcodes]
+
+    characters = []
+    for i in range(0, len(spawned), len(SPAWN_FIELDS)):
+        character = dict(zip(SPAWN_FIELDS, spawned[i:i + len(SPAWN_FIELDS)]))
+        character["is_fork"] = bool(character["is_fork"])
+        characters.append(character)
+    return {
+        "turn": turn,
+        "spawned": characters,
+        "dead": dead.tolist(),
+        "opcodes": [[cid, opcode] for cid, opcode in zip(cids, opcodes)],
+        "chests": [dict(zip(CHEST_FIELDS, chests[i:i + len(CHEST_FIELDS)]))
+                   for i in range(0, len(chests), len(CHEST_FIELDS))],
+        "opened": opened.tolist(),
+        "scores": scores.tolist(),
+    }
+
+
+def encode_metrics(phase_seconds: dict[str, float], steps, timeouts: int, faults: int) -> bytes:
+    return (METRICS_HEADER.pack(FRAME_METRICS, *(phase_seconds[phase] for phase in PHASES),
+                                timeouts, faults, len(steps))
+            + array("I", steps).tobytes())
+
+
+def decode_metrics(frame: bytes) -> tuple[dict[str, float], array, int, int]:
+    """The arguments of the Metrics.observe_turn call encode_metrics was given."""
+    _, *seconds, timeouts, faults, forks = METRICS_HEADER.unpack_from(frame)
+    steps = array("I", frame[METRICS_HEADER.size:METRICS_HEADER.size + 4 * forks])
+    return dict(zip(PHASES, seconds)), steps, timeouts, faults
+
+
+def encode_finish(outcome: int) -> bytes:
+    return FINISH_FRAME.pack(FRAME_FINISH, outcome)
+
+
+def decode_finish(frame: bytes) -> int:
+    return FINISH_FRAME.unpack_from(frame)[1]
+
+
+def encode_profile(profile: list[dict]) -> bytes:
+    return bytes([FRAME_PROFILE]) + json.dumps(profile).encode()
+
+
+def decode_profile(frame: bytes) -> list[dict]:
+    return json.loads(frame[1:])
+
+
+class RingOverrun(Exception):
+    """The reader fell more than a ring's worth of bytes behind and lost frames."""
+
+
+class TurnRing:
+    """Single-writer byte ring of frames in a multiprocessing.shared_memory block.
+
+    The writer never waits for readers: each frame (u32 length + payload) is
+    copied in at `head`, wrapping around, and only then is the new head
+    published. Readers keep their own cursor into the byte stream, so they
+    need no lock; one that is more than `capacity` bytes behind gets
+    RingOverrun instead of frames that were overwritten.
+
+    head is a total byte count, stored with a single aligned 8-byte write,
+    so a reader never sees it half updated.
+    """
+    # header words: magic, capacity, head, reserved
+    MAGIC = int.from_bytes(b"KOHT\0\0\0\1", "little")
+    HEADER_WORDS = 4
+    HEAD = 2
+    DATA = 8 * HEADER_WORDS
+    LENGTH = struct.Struct("<I")
+
+    def __init__(self, memory: shared_memory.SharedMemory, owner: bool):
+        self.memory = memory
+        self.owner = owner
+        self.words = memory.buf[:self.DATA].cast("Q")
+        if self.words[0] != self.MAGIC:
+            raise ValueError(f"{memory.name}: not a turn ring")
+        self.capacity = self.words[1]
+        self.data = memory.buf[self.DATA:self.DATA + self.capacity]
+
+    @classmethod
+    def create(cls, capacity: int = 4 << 20) -> "TurnRing":
+        memory = shared_memory.SharedMemory(create=True, size=cls.DATA + capacity)
+        words = memory.buf[:cls.DATA].cast("Q")
+        words[1] = capacity
+        words[cls.HEAD] = 0
+        words[0] = cls.MAGIC
+        words.release()
+        return cls(memory, owner=True)
+
+    @classmethod
+    def attach(cls, name: str) -> "TurnRing":
+        return cls(shared_memory.SharedMemory(name=name), owner=False)
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    @property
+    def head(self) -> int:
+        return self.words[self.HEAD]
+
+    def _copy_in(self, position: int, data: bytes):
+        start = position % self.capacity
+        first = min(len(data), self.capacity - start)
+        self.data[start:start + first] = data[:first]
+        self.data[:len(data) - first] = data[first:]
+
+    def _copy_out(self, position: int, size: int) -> bytes:
+        start = position % self.capacity
+        first = min(size, self.capacity - start)
+        return bytes(self.data[start:start + first]) + bytes(self.data[:size - first])
+
+    def write(self, frame: bytes):
+        size = self.LENGTH.size + len(frame)
+        if size > self.capacity:
+            raise ValueError(f"frame of {len(frame)} bytes does not fit a {self.capacity} byte ring")
+        head = self.head
+        self._copy_in(head, self.LENGTH.pack(len(frame)) + frame)
+        self.words[self.HEAD] = head + size
+
+    def read(self, cursor: int) -> tuple[list[bytes], int]:
+        """Frames written since byte `cursor`, and the cursor to pass next time."""
+        start, head = cursor, self.head
+        if head - start > self.capacity:
+            raise RingOverrun(f"{head - start} bytes behind a {self.capacity} byte ring")
+        frames = []
+        while cursor < head:
+            (length,) = self.LENGTH.unpack(self._copy_out(cursor, self.LENGTH.size))
+            if cursor + self.LENGTH.size + length > head:
+                raise RingOverrun("frame overwritten while reading")
+            frames.append(self._copy_out(cursor + self.LENGTH.size, length))
+            cursor += self.LENGTH.size + length
+        # the writer may have lapped us while we copied
+        if self.head - start > self.capacity:
+            raise RingOverrun("frames overwritten while reading")
+        return frames, cursor
+
+    def close(self):
+        self.data.release()
+        self.words.release()
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+class TurnFollower(RoundView):
+    """A round played in another process, rebuilt from its turn frames.
+
+    The web process serves the usual dumps from it; apply() is the only
+    writer and calls the listeners with each turn event, like Simulator.
+    """
+    def __init__(self):
+        self.team_num = 0
+        self.turn = 0
+        self.map: list[list[int]] = []
+        self.map_name = ""
+        self.record: MatchRecord | None = None
+        self.turn_events: list[dict] = []
+        self.listeners = []
+        # cid -> row in the record
+        self.char_rows: dict[int, int] = {}
+        self.chest_rows: dict[int, int] = {}
+        # what the round process profiled, set once the round is over
+        self.profile: list[dict] = []
+
+    def start(self, team_num: int, map: bytes, map_name: str):
+        self.team_num = team_num
+        self.map_name = map_name
+        self.map = [list(map[y * MAP_SIZE:(y + 1) * MAP_SIZE]) for y in range(MAP_SIZE)]
+        self.record = MatchRecord(team_num, bytes(map))
+        self.publish()
+
+    def apply(self, event: dict):
+        record = self.record
+        # rows are created in the order the simulator created them, spawns before the opcodes they run
+        for character in event["spawned"]:
+            self.char_rows[character["cid"]] = record.add_character(
+                character["cid"], character["team"], character["is_fork"],
+                character["spawn_x"], character["spawn_y"], character["spawn_turn"])
+        for chest in event["chests"]:
+            self.chest_rows[chest["cid"]] = record.add_chest(chest["cid"], chest["x"], chest["y"], chest["spawn_turn"])
+        for cid, opcode in event["opcodes"]:
+            record.tapes[self.char_rows[cid]].append(opcode)
+        for cid in event["dead"]:
+            record.chars["dead_turn"][self.char_rows[cid]] = event["turn"]
+        for cid in event["opened"]:
+            record.chests["opened_turn"][self.chest_rows[cid]] = event["turn"]
+        record.add_scores(event["scores"])
+        self.turn_events.append(event)
+        self.turn = event["turn"] + 1
+        self.publish()
+        for listener in self.listeners:
+            listener(event)
+
+    def dump_profile(self) -> list[dict]:
+        return self.profile
+
+    def close(self):
+        pass
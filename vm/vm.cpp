@@ -8,9 +8,25 @@
 #include <algorithm>
 #include <chrono>
 #include <charconv>
+#include <thread>
+#include <mutex>
+#include <condition_variable>
+#include <deque>
+#include <functional>
 
 #define MAP_SIZE (50)
 
+// VM_Buffer layout: global[50], self[8], tmp[42]
+#define BUFFER_SIZE (100)
+#define SELF_OFFSET (50)
+#define SELF_SIZE (8)
+#define TMP_OFFSET (58)
+#define TMP_SIZE (42)
+
+// wall-clock guard, only consulted every CLOCK_CHECK_INTERVAL instructions
+#define TIME_LIMIT_MS (250)
+#define CLOCK_CHECK_INTERVAL (4096)
+
 static const std::unordered_map<std::string_view, unsigned char> opcode_map = {
     {"mov", INS_MOV},
     {"movi", INS_MOVI},
@@ -250,9 +266,11 @@ Instruction parse_full_instruction(std::string_view line, std::unordered_map<std
     return inst;
 }
 
+// lines, if not NULL, receives the 1-based source line of every parsed instruction
 bool parse_opcode(
     const std::string_view opcode_str,
-    std::vector<Instruction> &instructions, int &error_line)
+    std::vector<Instruction> &instructions, int &error_line,
+    std::vector<unsigned int> *lines = nullptr)
 {
     std::unordered_map<std::string_view, unsigned short> labels;
     {
@@ -352,6 +370,8 @@ bool parse_opcode(
                 return false;
             }
             instructions.push_back(inst);
+            if (lines)
+                lines->push_back(line_parsed);
 
             line_start = line_end + 1;
         }
@@ -359,226 +379,993 @@ bool parse_opcode(
     return true;
 }
 
-int execute_opcode(
-    const std::vector<Instruction> &instructions,
-    const std::unordered_map<std::string, int> &labels,
-    VM_Character *self,
-    unsigned int *buffer,
-    int buffer_size, // 100
-    int team_id,
-    int scores,
-    VM_Chest **chests,
-    int chest_count,
-    unsigned char *map,
-    VM_Character **players,
-    int player_count)
+/*
+ * Internal bytecode. The verifier below lowers every parsed Instruction to
+ * exactly one Op (so label targets keep their index) and splits constant and
+ * register forms into separate ops. Direct register operands are proven to
+ * be inside the buffer here, so the interpreter never bounds-checks them;
+ * instructions that can only fault are lowered to ops reproducing that fault.
+ */
+#define VM_OPS(X)                                               \
+    X(MOV_R) X(MOV_C) X(MOVI)                                   \
+    X(ADD_R) X(ADD_C) X(SHR_R) X(SHR_C) X(SHL_R) X(SHL_C)       \
+    X(MUL_R) X(MUL_C) X(DIV_R) X(DIV_C) X(DIV_ZERO) X(DIV_R_FAULT) \
+    X(JE_R) X(JE_C) X(JG_R) X(JG_C)                             \
+    X(INC) X(DEC) X(AND_R) X(AND_C) X(OR_R) X(OR_C) X(NG)       \
+    X(RET_R) X(RET_C)                                           \
+    X(LOAD_SCORE) X(LOAD_LOC) X(LOAD_MAP) X(GET_ID)             \
+    X(LOCATE_CHEST_R) X(LOCATE_CHEST_C)                         \
+    X(LOCATE_CHAR_R) X(LOCATE_CHAR_C)                           \
+    X(FAULT) X(END)                                             \
+    /* superinstructions, only emitted by optimize_program */   \
+    X(JMP) X(JE_CHAIN)                                          \
+    X(INC_JE_R) X(INC_JE_C) X(INC_JG_R) X(INC_JG_C)             \
+    X(MOV_ADD_R) X(MOV_ADD_C) X(LOAD_LOC_ADD_C)
+
+enum OpCode : unsigned int
 {
-    int pc = 0;
-    auto start_time = std::chrono::steady_clock::now();
+#define X(name) OP_##name,
+    VM_OPS(X)
+#undef X
+        OP_COUNT
+};
 
-    auto read_mem = [&](int addr) -> unsigned int
+struct Op
+{
+    unsigned int code;
+    unsigned int a; // destination register
+    unsigned int b; // source register or constant
+    unsigned int c; // jump target, second source register, constant or writable word count
+};
+
+// one arm of a JE_CHAIN: jump to target if the register equals value
+struct Case
+{
+    unsigned int value;
+    unsigned int target;
+};
+
+static bool in_buffer(unsigned int addr)
+{
+    return addr < BUFFER_SIZE;
+}
+
+// number of words of an n-word write starting at base that land inside the buffer
+static unsigned int writable(unsigned int base, unsigned int n)
+{
+    return std::min(n, BUFFER_SIZE - base);
+}
+
+static Op lower_instruction(const Instruction &inst, unsigned int code_size)
+{
+    const Op fault{OP_FAULT, 0, 0, 0};
+    unsigned int opcode = inst.opcode & ~CONST_INST;
+    bool is_const = inst.opcode & CONST_INST;
+    unsigned int a = inst.arg1, b = inst.arg2, c = inst.arg3;
+
+    // every register form reads arg2 before doing anything else
+    if (!is_const && !in_buffer(b))
+        return fault;
+
+    auto binary = [&](OpCode reg_form, OpCode const_form) -> Op
     {
-        if (addr < 0 || addr >= buffer_size)
-        {
-            throw std::runtime_error("Memory read out of bounds");
-        }
-        return buffer[addr];
+        if (!in_buffer(a))
+            return fault;
+        return {is_const ? const_form : reg_form, a, b, 0};
     };
 
-    auto write_mem = [&](int addr, unsigned int val)
+    switch (opcode)
     {
-        if (addr < 0 || addr >= buffer_size)
-        {
-            throw std::runtime_error("Memory write out of bounds");
-        }
-        buffer[addr] = val;
-    };
+    case INS_MOV:
+        return binary(OP_MOV_R, OP_MOV_C);
+    case INS_MOVI:
+        return binary(OP_MOVI, OP_MOVI);
+    case INS_ADD:
+        return binary(OP_ADD_R, OP_ADD_C);
+    case INS_SHR:
+        return binary(OP_SHR_R, OP_SHR_C);
+    case INS_SHL:
+        return binary(OP_SHL_R, OP_SHL_C);
+    case INS_MUL:
+        return binary(OP_MUL_R, OP_MUL_C);
+    case INS_AND:
+        return binary(OP_AND_R, OP_AND_C);
+    case INS_OR:
+        return binary(OP_OR_R, OP_OR_C);
+    case INS_DIV:
+        // the divisor is checked before the destination is touched
+        if (is_const && b == 0)
+            return {OP_DIV_ZERO, 0, 0, 0};
+        if (!in_buffer(a))
+            return is_const ? fault : Op{OP_DIV_R_FAULT, 0, b, 0};
+        return binary(OP_DIV_R, OP_DIV_C);
+    case INS_JE:
+    case INS_JG:
+    {
+        if (!in_buffer(a))
+            return fault;
+        Op op = opcode == INS_JE ? binary(OP_JE_R, OP_JE_C) : binary(OP_JG_R, OP_JG_C);
+        // jumping past the end stops the script, same as reaching the END sentinel
+        op.c = std::min<unsigned int>(c, code_size);
+        return op;
+    }
+    case INS_INC:
+        return in_buffer(a) ? Op{OP_INC, a, 0, 0} : fault;
+    case INS_DEC:
+        return in_buffer(a) ? Op{OP_DEC, a, 0, 0} : fault;
+    case INS_NG:
+        return in_buffer(a) ? Op{OP_NG, a, 0, 0} : fault;
+    case INS_LOAD_SCORE:
+        return in_buffer(a) ? Op{OP_LOAD_SCORE, a, 0, 0} : fault;
+    case INS_GET_ID:
+        return in_buffer(a) ? Op{OP_GET_ID, a, 0, 0} : fault;
+    case INS_RET:
+        return {is_const ? OP_RET_C : OP_RET_R, 0, b, 0};
+    case INS_LOAD_LOC:
+        if (!in_buffer(a))
+            return fault;
+        return {OP_LOAD_LOC, a, 0, writable(a, 2)};
+    case INS_LOAD_MAP:
+        if (!in_buffer(c) || !in_buffer(a))
+            return fault;
+        return {OP_LOAD_MAP, a, b, c};
+    case INS_LOCATE_NEAREST_CHEST:
+        if (!in_buffer(a))
+            return fault;
+        return {is_const ? OP_LOCATE_CHEST_C : OP_LOCATE_CHEST_R, a, b, writable(a, 2)};
+    case INS_LOCATE_NEAREST_CHAR:
+        if (!in_buffer(a))
+            return fault;
+        return {is_const ? OP_LOCATE_CHAR_C : OP_LOCATE_CHAR_R, a, b, writable(a, 3)};
+    default:
+        return fault;
+    }
+}
+
+static std::vector<Op> lower_program(const std::vector<Instruction> &instructions)
+{
+    std::vector<Op> code;
+    code.reserve(instructions.size() + 1);
+    for (const auto &inst : instructions)
+        code.push_back(lower_instruction(inst, instructions.size()));
+    code.push_back({OP_END, 0, 0, 0});
+    return code;
+}
+
+struct VM_Program
+{
+    std::vector<Op> code;
+    std::vector<Case> cases;
+    // source line of every op, 0 for the END sentinel
+    std::vector<unsigned int> lines;
+};
+
+/*
+ * Peephole pass over verified bytecode. Semantics are unchanged, every op
+ * removed or merged here could not fault and only touched registers the
+ * surviving op accounts for; a merged sequence counts as one instruction
+ * against the budget. Ops are never merged across a jump target, so every
+ * label still lands on the op that starts its original sequence.
+ *
+ *   - identity ops (add #0, mul #1, mov r r, ...) and never-taken jumps go
+ *   - `je r r` is an unconditional JMP
+ *   - mov #c followed by arithmetic on the same register folds into one
+ *     mov #c, and a constant compare right after it into JMP or nothing
+ *   - jumps to JMPs are threaded, a JMP to a ret / END becomes that op
+ *   - inc + je/jg, mov + add, load_loc + add and runs of je #c on one
+ *     register become superinstructions
+ *   - ops unreachable from the entry are dropped
+ */
+static const unsigned int OP_DELETED = OP_COUNT;
+
+static bool is_jump(unsigned int code)
+{
+    switch (code)
+    {
+    case OP_JMP:
+    case OP_JE_R:
+    case OP_JE_C:
+    case OP_JG_R:
+    case OP_JG_C:
+    case OP_INC_JE_R:
+    case OP_INC_JE_C:
+    case OP_INC_JG_R:
+    case OP_INC_JG_C:
+        return true;
+    default:
+        return false;
+    }
+}
+
+// ops that end the run wherever they are
+static bool is_exit(unsigned int code)
+{
+    switch (code)
+    {
+    case OP_RET_R:
+    case OP_RET_C:
+    case OP_DIV_ZERO:
+    case OP_DIV_R_FAULT:
+    case OP_FAULT:
+    case OP_END:
+        return true;
+    default:
+        return false;
+    }
+}
+
+// ops that only change buf[a] and cannot fault
+static bool is_identity(const Op &op)
+{
+    switch (op.code)
+    {
+    case OP_ADD_C:
+    case OP_OR_C:
+        return op.b == 0;
+    case OP_SHR_C:
+    case OP_SHL_C:
+        return (op.b & 31) == 0;
+    case OP_MUL_C:
+    case OP_DIV_C:
+        return op.b == 1;
+    case OP_AND_C:
+        return op.b == ~0u;
+    case OP_MOV_R:
+    case OP_AND_R:
+    case OP_OR_R:
+        return op.a == op.b;
+    default:
+        return false;
+    }
+}
 
-    auto is_constant = [](const std::string &token)
+// buf[op.a] after op, given its value before; false if op is not foldable
+static bool fold_constant(const Op &op, unsigned int &value)
+{
+    switch (op.code)
     {
-        return !token.empty() && token[0] == '#';
+    case OP_MOV_C: value = op.b; return true;
+    case OP_ADD_C: value += op.b; return true;
+    case OP_SHR_C: value >>= op.b & 31; return true;
+    case OP_SHL_C: value <<= op.b & 31; return true;
+    case OP_MUL_C: value *= op.b; return true;
+    case OP_DIV_C: value /= op.b; return true; // DIV_C never has a zero divisor
+    case OP_AND_C: value &= op.b; return true;
+    case OP_OR_C: value |= op.b; return true;
+    case OP_INC: value++; return true;
+    case OP_DEC: value--; return true;
+    case OP_NG: value = ~value; return true;
+    default: return false;
+    }
+}
+
+static void optimize_program(VM_Program &program)
+{
+    std::vector<Op> &code = program.code;
+    const unsigned int size = code.size(); // the END sentinel is last and always kept
+    std::vector<char> is_target(size);
+
+    // first op after pc that is still there
+    auto next_live = [&](unsigned int pc)
+    {
+        do
+            ++pc;
+        while (code[pc].code == OP_DELETED);
+        return pc;
+    };
+    auto mark_targets = [&]()
+    {
+        std::fill(is_target.begin(), is_target.end(), 0);
+        for (const Op &op : code)
+            if (is_jump(op.code))
+                is_target[op.c] = 1;
+        for (const Case &arm : program.cases)
+            is_target[arm.target] = 1;
+    };
+    // pc can be merged into the op before it: no jump lands on it or on a deleted op just before it
+    auto mergeable = [&](unsigned int prev, unsigned int pc)
+    {
+        for (unsigned int i = prev + 1; i <= pc; ++i)
+            if (is_target[i])
+                return false;
+        return true;
     };
 
-    auto parse_operand = [&](const std::string &token) -> unsigned int
+    for (unsigned int pc = 0; pc + 1 < size; ++pc)
     {
-        if (is_constant(token))
+        Op &op = code[pc];
+        if (op.code == OP_JE_R && op.a == op.b)
+            op = {OP_JMP, 0, 0, op.c};
+        else if ((op.code == OP_JG_R && op.a == op.b) || is_identity(op))
+            op.code = OP_DELETED;
+    }
+
+    mark_targets();
+    for (unsigned int pc = 0; pc + 1 < size; ++pc)
+    {
+        if (code[pc].code != OP_MOV_C)
+            continue;
+        Op &mov = code[pc];
+        unsigned int prev = pc;
+        for (unsigned int next = next_live(pc); next + 1 < size && mergeable(prev, next); next = next_live(next))
         {
-            return std::stoi(token.substr(1));
+            Op &op = code[next];
+            if ((op.code == OP_JE_C || op.code == OP_JG_C) && op.a == mov.a)
+            {
+                bool taken = op.code == OP_JE_C ? mov.b == op.b : mov.b > op.b;
+                op = taken ? Op{OP_JMP, 0, 0, op.c} : Op{OP_DELETED, 0, 0, 0};
+                break;
+            }
+            if (op.a != mov.a || !fold_constant(op, mov.b))
+                break;
+            op.code = OP_DELETED;
+            prev = next;
         }
-        else
+    }
+
+    // follow JMPs and deleted ops to where a jump really lands; a JMP cycle spins until the budget runs out either way
+    auto resolve = [&](unsigned int pc)
+    {
+        for (unsigned int hops = 0; hops < size; ++hops)
         {
-            int addr = std::stoi(token);
-            return read_mem(addr);
+            if (code[pc].code == OP_DELETED)
+                pc++;
+            else if (code[pc].code == OP_JMP && code[pc].c != pc)
+                pc = code[pc].c;
+            else
+                break;
         }
+        return pc;
     };
-    while (pc < (int)instructions.size())
+    for (unsigned int pc = 0; pc + 1 < size; ++pc)
     {
+        Op &op = code[pc];
+        if (!is_jump(op.code))
+            continue;
+        op.c = resolve(op.c);
+        if (op.c == next_live(pc))
+            op.code = OP_DELETED;
+        else if (op.code == OP_JMP && is_exit(code[op.c].code))
+            op = code[op.c];
+    }
 
-        auto now = std::chrono::steady_clock::now();
-        auto elapsed = std::chrono::duration_cast<std::chrono::milliseconds>(now - start_time).count();
-        if (elapsed >= 250)
+    mark_targets();
+    for (unsigned int pc = 0; pc + 1 < size; ++pc)
+    {
+        Op &op = code[pc];
+        if (op.code == OP_DELETED)
+            continue;
+        unsigned int next = next_live(pc);
+        if (next + 1 >= size || !mergeable(pc, next))
+            continue;
+        Op &second = code[next];
+
+        if (op.code == OP_INC && second.a == op.a &&
+            (second.code == OP_JE_R || second.code == OP_JE_C || second.code == OP_JG_R || second.code == OP_JG_C))
+        {
+            static const unsigned int fused[] = {OP_INC_JE_R, OP_INC_JE_C, OP_INC_JG_R, OP_INC_JG_C};
+            op = {fused[second.code - OP_JE_R], op.a, second.b, second.c};
+        }
+        else if (op.code == OP_MOV_R && second.a == op.a && second.code == OP_ADD_C)
+            op = {OP_MOV_ADD_C, op.a, op.b, second.b};
+        else if (op.code == OP_MOV_R && second.a == op.a && second.code == OP_ADD_R && second.b != op.a)
+            op = {OP_MOV_ADD_R, op.a, op.b, second.b};
+        else if (op.code == OP_LOAD_LOC && op.c == 2 && second.code == OP_ADD_C &&
+                 (second.a == op.a || second.a == op.a + 1))
+            op = {OP_LOAD_LOC_ADD_C, op.a, second.b, second.a - op.a};
+        else if (op.code == OP_JE_C && second.code == OP_JE_C && second.a == op.a)
         {
-            return 0;
+            unsigned int first = program.cases.size();
+            program.cases.push_back({op.b, op.c});
+            unsigned int last = pc;
+            do
+            {
+                program.cases.push_back({code[next].b, code[next].c});
+                code[next].code = OP_DELETED;
+                last = next;
+                next = next_live(next);
+            } while (next + 1 < size && code[next].code == OP_JE_C && code[next].a == op.a && mergeable(last, next));
+            op = {OP_JE_CHAIN, op.a, first, (unsigned int)program.cases.size() - first};
+            pc = last;
+            continue;
         }
+        else
+            continue;
+        second.code = OP_DELETED;
+        pc = next;
+    }
 
-        const auto &inst = instructions[pc++];
+    // drop what the entry cannot reach
+    std::vector<char> reached(size);
+    std::vector<unsigned int> work{0};
+    while (!work.empty())
+    {
+        unsigned int pc = work.back();
+        work.pop_back();
+        while (pc < size && !reached[pc])
+        {
+            reached[pc] = 1;
+            const Op &op = code[pc];
+            if (is_jump(op.code))
+                work.push_back(op.c);
+            else if (op.code == OP_JE_CHAIN)
+                for (unsigned int i = 0; i < op.c; ++i)
+                    work.push_back(program.cases[op.b + i].target);
+            if (op.code == OP_JMP || is_exit(op.code))
+                break;
+            pc++;
+        }
+    }
 
-        auto opcode = inst.opcode & ~CONST_INST;
-        auto is_const = inst.opcode & CONST_INST;
-        auto r = is_const ? inst.arg2 : read_mem(inst.arg2);
-        switch (opcode)
+    // compact, an old index maps to the first op kept at or after it
+    std::vector<unsigned int> remap(size);
+    std::vector<Op> out;
+    std::vector<unsigned int> lines;
+    for (unsigned int pc = 0; pc < size; ++pc)
+    {
+        remap[pc] = out.size();
+        if (code[pc].code != OP_DELETED && (reached[pc] || pc + 1 == size))
         {
-        case INS_MOV:
-            write_mem(inst.arg1, r);
-            break;
-        case INS_MOVI:
+            out.push_back(code[pc]);
+            lines.push_back(program.lines[pc]);
+        }
+    }
+    for (Op &op : out)
+        if (is_jump(op.code))
+            op.c = remap[op.c];
+    for (Case &arm : program.cases)
+        arm.target = remap[arm.target];
+    code.swap(out);
+    program.lines.swap(lines);
+}
+
+// parse result -> runnable program
+static void build_program(VM_Program &program, const std::vector<Instruction> &instructions,
+                          const std::vector<unsigned int> &lines)
+{
+    program.code = lower_program(instructions);
+    program.lines = lines;
+    program.lines.resize(program.code.size());
+    optimize_program(program);
+}
+
+/*
+ * Nearest-neighbour index over one turn's snapshot, shared by every fork of
+ * a batch. Points are bucketed by grid cell; a query ring-searches outwards
+ * from the querying cell and only sorts the candidates it needs. The sorted
+ * prefix is cached per querying cell, so forks standing on the same cell (or
+ * asking again for a larger k) reuse it. Ties are broken by point index.
+ */
+class NearestIndex
+{
+public:
+    struct Point
+    {
+        int x, y, idx;
+        int team_id;
+        bool is_fork;
+    };
+
+    explicit NearestIndex(std::vector<Point> points)
+        : points(std::move(points)), cell_start(MAP_SIZE * MAP_SIZE + 1, 0), cache(MAP_SIZE * MAP_SIZE)
+    {
+        for (const auto &p : this->points)
         {
-            unsigned int dst = read_mem(inst.arg1);
-            unsigned int src = read_mem(inst.arg2);
-            write_mem(dst, read_mem(src));
-            break;
+            if (!in_grid(p.x, p.y))
+                all_in_grid = false;
+            else
+                cell_start[p.y * MAP_SIZE + p.x + 1]++;
         }
-        case INS_ADD:
-            write_mem(inst.arg1, read_mem(inst.arg1) + r);
-            break;
-        case INS_SHR:
-            write_mem(inst.arg1, read_mem(inst.arg1) >> r);
-            break;
-        case INS_SHL:
-            write_mem(inst.arg1, read_mem(inst.arg1) << r);
-            break;
-        case INS_MUL:
-            write_mem(inst.arg1, read_mem(inst.arg1) * r);
-            break;
-        case INS_DIV:
+        for (int c = 0; c < MAP_SIZE * MAP_SIZE; ++c)
+            cell_start[c + 1] += cell_start[c];
+        by_cell.resize(cell_start.back());
+        std::vector<int> fill(cell_start.begin(), cell_start.end() - 1);
+        for (int i = 0; i < (int)this->points.size(); ++i)
         {
-            unsigned int divisor = r;
-            if (divisor == 0)
-                return -1;
-            write_mem(inst.arg1, read_mem(inst.arg1) / divisor);
-            break;
+            const auto &p = this->points[i];
+            if (in_grid(p.x, p.y))
+                by_cell[fill[p.y * MAP_SIZE + p.x]++] = i;
         }
-        case INS_JE:
-            if (read_mem(inst.arg1) == r)
-            {
-                pc = inst.arg3;
-            }
-            break;
-        case INS_JG:
-            if (read_mem(inst.arg1) > r)
+    }
+
+    int size() const { return points.size(); }
+
+    /*
+     * k-th nearest point to (x, y) among points skip() rejects, or nullptr.
+     * Returns a copy so callers never hold on to cache memory.
+     */
+    template <class Skip>
+    bool kth(int x, int y, unsigned int k, Skip skip, Point &found)
+    {
+        if (!in_grid(x, y) || !all_in_grid)
+            return kth_uncached(x, y, k, skip, found);
+
+        int cell = y * MAP_SIZE + x;
+        std::lock_guard<std::mutex> lock(locks[cell % LOCK_STRIPES]);
+        CacheEntry &entry = cache[cell];
+        for (;;)
+        {
+            unsigned int seen = 0;
+            for (int i : entry.prefix)
             {
-                pc = inst.arg3;
-            }
-            break;
-        case INS_INC:
-            write_mem(inst.arg1, read_mem(inst.arg1) + 1);
-            break;
-        case INS_DEC:
-            write_mem(inst.arg1, read_mem(inst.arg1) - 1);
-            break;
-        case INS_AND:
-            write_mem(inst.arg1, read_mem(inst.arg1) & r);
-            break;
-        case INS_OR:
-            write_mem(inst.arg1, read_mem(inst.arg1) | r);
-            break;
-        case INS_NG:
-            write_mem(inst.arg1, ~read_mem(inst.arg1));
-            break;
-        case INS_RET:
-            return r;
-        case INS_LOAD_SCORE:
-            write_mem(inst.arg1, scores);
-            break;
-        case INS_LOAD_LOC:
-            write_mem(inst.arg1, self->x);
-            write_mem(inst.arg1 + 1, self->y);
-            break;
-        case INS_LOAD_MAP:
-        {
-            auto x = read_mem(inst.arg2);
-            auto y = read_mem(inst.arg3);
-            if (x >= 0 && x < MAP_SIZE && y >= 0 && y < MAP_SIZE){
-                write_mem(inst.arg1, map[y * MAP_SIZE + x]);
-            }else{
-                write_mem(inst.arg1, 1);
+                if (skip(points[i]))
+                    continue;
+                if (seen++ == k)
+                {
+                    found = points[i];
+                    return true;
+                }
             }
-            break;
+            if (entry.complete)
+                return false;
+            size_t want = std::max<size_t>({entry.prefix.size() * 2, k + 1, 8});
+            extend(entry, x, y, want);
         }
+    }
+
+private:
+    static constexpr int LOCK_STRIPES = 64;
+
+    struct CacheEntry
+    {
+        std::vector<int> prefix; // point indices in (dist, idx) order
+        bool complete = false;   // prefix holds every point
+    };
+
+    std::vector<Point> points;
+    std::vector<int> cell_start; // CSR offsets into by_cell, one slot per grid cell
+    std::vector<int> by_cell;
+    std::vector<CacheEntry> cache;
+    std::mutex locks[LOCK_STRIPES];
+    bool all_in_grid = true;
+
+    static bool in_grid(int x, int y)
+    {
+        return x >= 0 && x < MAP_SIZE && y >= 0 && y < MAP_SIZE;
+    }
 
-        case INS_GET_ID:
+    int dist(int i, int x, int y) const
+    {
+        int dx = points[i].x - x;
+        int dy = points[i].y - y;
+        return dx * dx + dy * dy;
+    }
+
+    void sort_prefix(std::vector<int> &candidates, size_t n, int x, int y) const
+    {
+        auto closer = [&](int a, int b)
         {
-            write_mem(inst.arg1, self->is_fork ? 0 : team_id);
-            break;
-        }
-        case INS_LOCATE_NEAREST_CHEST:
+            int da = dist(a, x, y), db = dist(b, x, y);
+            return da != db ? da < db : a < b;
+        };
+        n = std::min(n, candidates.size());
+        std::partial_sort(candidates.begin(), candidates.begin() + n, candidates.end(), closer);
+        candidates.resize(n);
+    }
+
+    // collect rings of cells around (x, y) until the nearest `want` points are known
+    void extend(CacheEntry &entry, int x, int y, size_t want)
+    {
+        int max_radius = std::max({x, MAP_SIZE - 1 - x, y, MAP_SIZE - 1 - y});
+        std::vector<int> candidates;
+        auto take_cell = [&](int cx, int cy)
         {
-            int mem_base = inst.arg1;
-            unsigned int k = r;
-            if (k >= (unsigned int)chest_count)
-            {
-                write_mem(mem_base, -1);
-                write_mem(mem_base + 1, -1);
-                break;
-            }
+            if (!in_grid(cx, cy))
+                return;
+            int cell = cy * MAP_SIZE + cx;
+            for (int j = cell_start[cell]; j < cell_start[cell + 1]; ++j)
+                candidates.push_back(by_cell[j]);
+        };
 
-            struct Entry
-            {
-                int x, y, dist, idx;
-            };
-            std::vector<Entry> chest_info;
-            for (int i = 0; i < chest_count; ++i)
-            {
-                int dx = chests[i]->x - self->x;
-                int dy = chests[i]->y - self->y;
-                int dist = dx * dx + dy * dy;
-                chest_info.push_back({chests[i]->x, chests[i]->y, dist, i});
-            }
-            std::sort(chest_info.begin(), chest_info.end(), [](auto &a, auto &b)
-                      { return a.dist < b.dist; });
-            write_mem(mem_base, chest_info[k].x);
-            write_mem(mem_base + 1, chest_info[k].y);
-            break;
-        }
-        case INS_LOCATE_NEAREST_CHAR:
+        int r = 0;
+        for (;; ++r)
         {
-            int mem_base = inst.arg1;
-            unsigned int k = r;
-            struct Entry
+            if (r == 0)
+                take_cell(x, y);
+            for (int cx = x - r; r > 0 && cx <= x + r; ++cx)
             {
-                int x, y, dist, idx;
-                Entry(int x, int y, int d, int i) : x(x), y(y), dist(d), idx(i) {}
-            };
-            std::vector<Entry> character_info;
-            for (int i = 0; i < player_count; ++i)
-            {
-                if(players[i]->team_id == team_id) continue;
-                int dx = players[i]->x - self->x;
-                int dy = players[i]->y - self->y;
-                int dist = dx * dx + dy * dy;
-                character_info.emplace_back(players[i]->x, players[i]->y, dist, i);
+                take_cell(cx, y - r);
+                take_cell(cx, y + r);
             }
-            if (k >= character_info.size())
+            for (int cy = y - r + 1; r > 0 && cy <= y + r - 1; ++cy)
             {
-                write_mem(mem_base, -1);
-                write_mem(mem_base + 1, -1);
-                write_mem(mem_base + 2, -1);
+                take_cell(x - r, cy);
+                take_cell(x + r, cy);
+            }
+            if (r >= max_radius)
                 break;
+            // anything outside the rings is at least (r + 1)^2 away
+            if (candidates.size() >= want)
+            {
+                int bound = (r + 1) * (r + 1);
+                size_t certain = std::count_if(candidates.begin(), candidates.end(), [&](int i)
+                                               { return dist(i, x, y) < bound; });
+                if (certain >= want)
+                    break;
             }
-            std::sort(character_info.begin(), character_info.end(), [](auto &a, auto &b)
-                      { return a.dist < b.dist; });
-            int idx = character_info[k].idx;
-            write_mem(mem_base, players[idx]->is_fork ? 1 : 0);
-            write_mem(mem_base + 1, players[idx]->x);
-            write_mem(mem_base + 2, players[idx]->y);
-            break;
         }
-        default:
-            throw std::runtime_error("Unknown instruction opcode");
+
+        entry.complete = r >= max_radius && want >= candidates.size();
+        sort_prefix(candidates, want, x, y);
+        entry.prefix = std::move(candidates);
+    }
+
+    template <class Skip>
+    bool kth_uncached(int x, int y, unsigned int k, Skip skip, Point &found) const
+    {
+        std::vector<int> candidates;
+        for (int i = 0; i < (int)points.size(); ++i)
+            if (!skip(points[i]))
+                candidates.push_back(i);
+        if (k >= candidates.size())
+            return false;
+        auto closer = [&](int a, int b)
+        {
+            int da = dist(a, x, y), db = dist(b, x, y);
+            return da != db ? da < db : a < b;
+        };
+        std::nth_element(candidates.begin(), candidates.begin() + k, candidates.end(), closer);
+        found = points[candidates[k]];
+        return true;
+    }
+};
+
+// everything locate_nearest_k_* needs to know about one turn
+struct TurnIndex
+{
+    NearestIndex chests;
+    NearestIndex characters;
+
+    // at(i) is the i-th chest, which is also its point index
+    template <typename At>
+    static std::vector<NearestIndex::Point> chest_points(int chest_count, At at)
+    {
+        std::vector<NearestIndex::Point> points;
+        points.reserve(chest_count);
+        for (int i = 0; i < chest_count; ++i)
+        {
+            const VM_Chest &chest = at(i);
+            points.push_back({chest.x, chest.y, i, 0, false});
         }
+        return points;
     }
 
-    return 0;
+    template <typename At>
+    static std::vector<NearestIndex::Point> character_points(int player_count, At at)
+    {
+        std::vector<NearestIndex::Point> points;
+        points.reserve(player_count);
+        for (int i = 0; i < player_count; ++i)
+        {
+            const VM_Character &player = at(i);
+            points.push_back({player.x, player.y, i, player.team_id, player.is_fork});
+        }
+        return points;
+    }
+
+    TurnIndex(VM_Character **players, int player_count, VM_Chest **chests, int chest_count)
+        : chests(chest_points(chest_count, [&](int i) -> const VM_Chest & { return *chests[i]; })),
+          characters(character_points(player_count, [&](int i) -> const VM_Character & { return *players[i]; }))
+    {
+    }
+
+    // entity store layout: the i-th entity is entities[slots[i]]
+    TurnIndex(const VM_Character *characters, const int *slots, int player_count,
+              const VM_Chest *chests, const int *chest_slots, int chest_count)
+        : chests(chest_points(chest_count, [&](int i) -> const VM_Chest & { return chests[chest_slots[i]]; })),
+          characters(character_points(player_count, [&](int i) -> const VM_Character & { return characters[slots[i]]; }))
+    {
+    }
+};
+
+// k-th nearest chest as (x, y), or (-1, -1)
+static void locate_chest(unsigned int k, const VM_Character *self, TurnIndex &index, unsigned int out[2])
+{
+    NearestIndex::Point p;
+    if (k >= (unsigned int)index.chests.size() ||
+        !index.chests.kth(self->x, self->y, k, [](const NearestIndex::Point &)
+                          { return false; }, p))
+    {
+        out[0] = out[1] = -1;
+        return;
+    }
+    out[0] = p.x;
+    out[1] = p.y;
+}
+
+// k-th nearest enemy as (is_fork, x, y), or (-1, -1, -1)
+static void locate_character(unsigned int k, int team_id, const VM_Character *self,
+                             TurnIndex &index, unsigned int out[3])
+{
+    NearestIndex::Point p;
+    if (k >= (unsigned int)index.characters.size() ||
+        !index.characters.kth(self->x, self->y, k, [&](const NearestIndex::Point &q)
+                              { return q.team_id == team_id; }, p))
+    {
+        out[0] = out[1] = out[2] = -1;
+        return;
+    }
+    out[0] = p.is_fork ? 1 : 0;
+    out[1] = p.x;
+    out[2] = p.y;
+}
+
+/*
+ * Threaded interpreter over verified bytecode. Returns a VM_STATUS_* code
+ * and stores the script's return value in *result and, if steps is not
+ * NULL, the number of instructions dispatched in *steps.
+ * The Profile instantiation also adds one to hits[pc] for every op it
+ * dispatches; hits has one counter per op of program.code.
+ */
+template <bool Profile>
+static int execute_program(
+    const VM_Program &program,
+    VM_Character *self,
+    unsigned int *buffer,
+    int team_id,
+    int scores,
+    TurnIndex &index,
+    unsigned char *map,
+    unsigned int max_instructions, // 0 -> wall-clock limit only
+    int *result,
+    unsigned int *steps,
+    unsigned long long *hits)
+{
+    static const void *dispatch_table[OP_COUNT] = {
+#define X(name) &&L_##name,
+        VM_OPS(X)
+#undef X
+    };
+
+    const Op *code = program.code.data();
+    const Case *cases = program.cases.data();
+    const Op *op;
+    unsigned int *buf = buffer;
+    unsigned int pc = 0;
+    unsigned int out[3];
+
+    auto start_time = std::chrono::steady_clock::now();
+    unsigned long long remaining = max_instructions ? max_instructions : ~0ULL;
+    unsigned int chunk = 0;
+    unsigned long long issued = 0;
+
+    // every exit path returns straight out of a handler, so the count is taken on scope exit
+    struct StepCount
+    {
+        const unsigned long long &issued;
+        const unsigned int &chunk;
+        unsigned int *steps;
+        ~StepCount()
+        {
+            if (steps)
+                *steps = (unsigned int)(issued - chunk);
+        }
+    } step_count{issued, chunk, steps};
+
+    *result = 0;
+
+#define DISPATCH()                     \
+    do                                 \
+    {                                  \
+        if (chunk-- == 0)              \
+            goto refill;               \
+        if constexpr (Profile)         \
+            ++hits[pc];                \
+        op = &code[pc++];              \
+        goto *dispatch_table[op->code]; \
+    } while (0)
+
+#define WRITE_OUT(n)                    \
+    do                                  \
+    {                                   \
+        for (unsigned int i = 0; i < op->c; ++i) \
+            buf[op->a + i] = out[i];    \
+        if (op->c < (n))                \
+            return VM_STATUS_FAULT;     \
+    } while (0)
+
+refill:
+    chunk = 0;
+    if (remaining == 0)
+        return VM_STATUS_TIMEOUT;
+    // the first chunk starts with the clock; any later one may follow a jump back to pc 0
+    if (issued != 0)
+    {
+        auto now = std::chrono::steady_clock::now();
+        auto elapsed = std::chrono::duration_cast<std::chrono::milliseconds>(now - start_time).count();
+        if (elapsed >= TIME_LIMIT_MS)
+            return VM_STATUS_TIMEOUT;
+    }
+    chunk = (unsigned int)std::min<unsigned long long>(remaining, CLOCK_CHECK_INTERVAL);
+    remaining -= chunk;
+    issued += chunk;
+    DISPATCH();
+
+L_MOV_R:
+    buf[op->a] = buf[op->b];
+    DISPATCH();
+L_MOV_C:
+    buf[op->a] = op->b;
+    DISPATCH();
+L_MOVI:
+{
+    unsigned int dst = buf[op->a];
+    unsigned int src = buf[op->b];
+    if (!in_buffer(src) || !in_buffer(dst))
+        return VM_STATUS_FAULT;
+    buf[dst] = buf[src];
+    DISPATCH();
+}
+L_ADD_R:
+    buf[op->a] += buf[op->b];
+    DISPATCH();
+L_ADD_C:
+    buf[op->a] += op->b;
+    DISPATCH();
+L_SHR_R:
+    buf[op->a] >>= buf[op->b] & 31;
+    DISPATCH();
+L_SHR_C:
+    buf[op->a] >>= op->b & 31;
+    DISPATCH();
+L_SHL_R:
+    buf[op->a] <<= buf[op->b] & 31;
+    DISPATCH();
+L_SHL_C:
+    buf[op->a] <<= op->b & 31;
+    DISPATCH();
+L_MUL_R:
+    buf[op->a] *= buf[op->b];
+    DISPATCH();
+L_MUL_C:
+    buf[op->a] *= op->b;
+    DISPATCH();
+L_DIV_R:
+    if (buf[op->b] == 0)
+    {
+        *result = -1;
+        return VM_STATUS_OK;
+    }
+    buf[op->a] /= buf[op->b];
+    DISPATCH();
+L_DIV_C:
+    buf[op->a] /= op->b;
+    DISPATCH();
+L_DIV_ZERO:
+    *result = -1;
+    return VM_STATUS_OK;
+L_DIV_R_FAULT:
+    if (buf[op->b] == 0)
+    {
+        *result = -1;
+        return VM_STATUS_OK;
+    }
+    return VM_STATUS_FAULT;
+L_JE_R:
+    if (buf[op->a] == buf[op->b])
+        pc = op->c;
+    DISPATCH();
+L_JE_C:
+    if (buf[op->a] == op->b)
+        pc = op->c;
+    DISPATCH();
+L_JG_R:
+    if (buf[op->a] > buf[op->b])
+        pc = op->c;
+    DISPATCH();
+L_JG_C:
+    if (buf[op->a] > op->b)
+        pc = op->c;
+    DISPATCH();
+L_INC:
+    buf[op->a]++;
+    DISPATCH();
+L_DEC:
+    buf[op->a]--;
+    DISPATCH();
+L_AND_R:
+    buf[op->a] &= buf[op->b];
+    DISPATCH();
+L_AND_C:
+    buf[op->a] &= op->b;
+    DISPATCH();
+L_OR_R:
+    buf[op->a] |= buf[op->b];
+    DISPATCH();
+L_OR_C:
+    buf[op->a] |= op->b;
+    DISPATCH();
+L_NG:
+    buf[op->a] = ~buf[op->a];
+    DISPATCH();
+L_RET_R:
+    *result = buf[op->b];
+    return VM_STATUS_OK;
+L_RET_C:
+    *result = op->b;
+    return VM_STATUS_OK;
+L_LOAD_SCORE:
+    buf[op->a] = scores;
+    DISPATCH();
+L_LOAD_LOC:
+    out[0] = self->x;
+    out[1] = self->y;
+    WRITE_OUT(2);
+    DISPATCH();
+L_LOAD_MAP:
+{
+    unsigned int x = buf[op->b];
+    unsigned int y = buf[op->c];
+    buf[op->a] = (x < MAP_SIZE && y < MAP_SIZE) ? map[y * MAP_SIZE + x] : 1;
+    DISPATCH();
+}
+L_GET_ID:
+    buf[op->a] = self->is_fork ? 0 : team_id;
+    DISPATCH();
+L_LOCATE_CHEST_R:
+    locate_chest(buf[op->b], self, index, out);
+    WRITE_OUT(2);
+    DISPATCH();
+L_LOCATE_CHEST_C:
+    locate_chest(op->b, self, index, out);
+    WRITE_OUT(2);
+    DISPATCH();
+L_LOCATE_CHAR_R:
+    locate_character(buf[op->b], team_id, self, index, out);
+    WRITE_OUT(3);
+    DISPATCH();
+L_LOCATE_CHAR_C:
+    locate_character(op->b, team_id, self, index, out);
+    WRITE_OUT(3);
+    DISPATCH();
+L_FAULT:
+    return VM_STATUS_FAULT;
+L_END:
+    return VM_STATUS_OK;
+L_JMP:
+    pc = op->c;
+    DISPATCH();
+L_JE_CHAIN:
+{
+    unsigned int value = buf[op->a];
+    for (const Case *arm = cases + op->b, *last = arm + op->c; arm != last; ++arm)
+        if (arm->value == value)
+        {
+            pc = arm->target;
+            break;
+        }
+    DISPATCH();
+}
+L_INC_JE_R:
+    if (++buf[op->a] == buf[op->b])
+        pc = op->c;
+    DISPATCH();
+L_INC_JE_C:
+    if (++buf[op->a] == op->b)
+        pc = op->c;
+    DISPATCH();
+L_INC_JG_R:
+    if (++buf[op->a] > buf[op->b])
+        pc = op->c;
+    DISPATCH();
+L_INC_JG_C:
+    if (++buf[op->a] > op->b)
+        pc = op->c;
+    DISPATCH();
+L_MOV_ADD_R:
+    buf[op->a] = buf[op->b] + buf[op->c];
+    DISPATCH();
+L_MOV_ADD_C:
+    buf[op->a] = buf[op->b] + op->c;
+    DISPATCH();
+L_LOAD_LOC_ADD_C:
+    buf[op->a] = self->x;
+    buf[op->a + 1] = self->y;
+    buf[op->a + op->c] += op->b;
+    DISPATCH();
+
+#undef DISPATCH
+#undef WRITE_OUT
 }
 
 void debug_print_parsed(
@@ -610,6 +1397,101 @@ extern "C" bool vm_parse_script(
     return parse_opcode(std::string(script), instructions, *error_line);
 }
 
+/*
+ * Parse, verify and optimize a script once and keep the bytecode around, so the
+ * per-turn cost of vm_run_compiled only depends on executed instructions.
+ * Returns NULL (and sets error_line) if the script does not parse.
+ */
+extern "C" VM_Program *vm_compile(
+    const char script[], int *error_line)
+{
+    std::vector<Instruction> instructions;
+    std::vector<unsigned int> lines;
+    int line = 0;
+    if (!parse_opcode(script, instructions, line, &lines))
+    {
+        if (error_line)
+            *error_line = line;
+        return nullptr;
+    }
+    auto program = new VM_Program();
+    build_program(*program, instructions, lines);
+    return program;
+}
+
+extern "C" void vm_free(VM_Program *program)
+{
+    delete program;
+}
+
+extern "C" unsigned int vm_program_size(const VM_Program *program)
+{
+    return program->code.size();
+}
+
+extern "C" void vm_program_lines(const VM_Program *program, unsigned int *lines)
+{
+    std::copy(program->lines.begin(), program->lines.end(), lines);
+}
+
+/*
+-1 vm_run error
+ops:
+0 stop
+1 up
+2 down
+3 left
+4 right
+5 interact
+6 attack
+7 fork
+
+others –> 0
+*/
+static int run_program(
+    const VM_Program &program,
+    int team_id,
+    unsigned int *buffer,
+    TurnIndex &index,
+    unsigned char *map,
+    int scores, VM_Character *self,
+    unsigned int max_instructions,
+    int *status_out = nullptr,
+    unsigned int *steps = nullptr,
+    unsigned long long *hits = nullptr)
+{
+    int ret = 0;
+    // profiling is a separate instantiation, so the plain interpreter keeps its dispatch
+    int status = hits ? execute_program<true>(program, self, buffer, team_id, scores, index,
+                                              map, max_instructions, &ret, steps, hits)
+                      : execute_program<false>(program, self, buffer, team_id, scores, index,
+                                               map, max_instructions, &ret, steps, nullptr);
+    if (status_out)
+        *status_out = status;
+    if (status != VM_STATUS_OK)
+        ret = 0;
+    if (ret < -1 || ret > 7)
+        ret = 0;
+
+    return ret;
+}
+
+extern "C" int vm_run_compiled(
+    const VM_Program *program,
+    int team_id,
+    unsigned int *buffer,
+    VM_Character **players, int player_count,
+    VM_Chest **chests, int chest_count,
+    unsigned char *map,
+    int scores, VM_Character *self,
+    unsigned int max_instructions)
+{
+    if (!program)
+        return 0;
+    TurnIndex index(players, player_count, chests, chest_count);
+    return run_program(*program, team_id, buffer, index, map, scores, self, max_instructions);
+}
+
 extern "C" int vm_run(
     int team_id,
     const char opcode_cstr[],
@@ -617,50 +1499,176 @@ extern "C" int vm_run(
     VM_Character **players, int player_count,
     VM_Chest **chests, int chest_count,
     unsigned char *map,
-    int scores, VM_Character *self)
+    int scores, VM_Character *self,
+    unsigned int max_instructions)
 {
-
+    // like the compiled path, but a script that fails to parse still runs its valid prefix
     std::vector<Instruction> instructions;
-    std::unordered_map<std::string, int> labels;
-
-    int ret = 0;
+    std::vector<unsigned int> lines;
     int error_line = 0;
-    try
+    parse_opcode(opcode_cstr, instructions, error_line, &lines);
+
+    VM_Program program;
+    build_program(program, instructions, lines);
+    TurnIndex index(players, player_count, chests, chest_count);
+    return run_program(program, team_id, buffer, index, map, scores, self, max_instructions);
+}
+
+/*
+ * Persistent pool shared by every vm_run_batch call, so a turn does not pay
+ * for thread startup. The submitting thread also drains the queue while it
+ * waits, which keeps a batch making progress even with zero workers.
+ */
+class WorkerPool
+{
+public:
+    explicit WorkerPool(unsigned int worker_count)
     {
-        parse_opcode(opcode_cstr, instructions, error_line);
-        // check_opcode_format(instructions);
+        for (unsigned int i = 0; i < worker_count; ++i)
+            workers.emplace_back([this]
+                                 { worker_loop(); });
     }
-    catch (const std::runtime_error &e)
+
+    void run(int task_count, const std::function<void(int)> &fn)
     {
-        std::cerr << "[vm_run error] error: " << e.what() << "\n";
-        return -1;
+        if (task_count <= 1 || workers.empty())
+        {
+            for (int i = 0; i < task_count; ++i)
+                fn(i);
+            return;
+        }
+        Latch latch{task_count};
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+            for (int i = 0; i < task_count; ++i)
+                tasks.push_back({&fn, i, &latch});
+        }
+        cv.notify_all();
+        while (run_one())
+            ;
+        std::unique_lock<std::mutex> lock(latch.mutex);
+        latch.cv.wait(lock, [&]
+                      { return latch.remaining == 0; });
     }
 
-    /*
-    -1 vm_run error
-    ops:
-    0 stop
-    1 up
-    2 down
-    3 left
-    4 right
-    5 interact
-    6 attack
-    7 fork
-
-    others –> 0
-    */
-    try
-    {
-        ret = execute_opcode(instructions, labels, self, buffer, 100, team_id, scores, chests, chest_count, map, players, player_count);
-    }
-    catch (const std::runtime_error &e)
-    {
-        std::cerr << "[vm_run error] error: " << e.what() << "\n";
-        ret = 0;
+private:
+    struct Latch
+    {
+        int remaining;
+        std::mutex mutex;
+        std::condition_variable cv;
+    };
+    struct Task
+    {
+        const std::function<void(int)> *fn;
+        int index;
+        Latch *latch;
+    };
+
+    std::vector<std::thread> workers;
+    std::deque<Task> tasks;
+    std::mutex mutex;
+    std::condition_variable cv;
+
+    static void finish(const Task &task)
+    {
+        (*task.fn)(task.index);
+        std::lock_guard<std::mutex> lock(task.latch->mutex);
+        if (--task.latch->remaining == 0)
+            task.latch->cv.notify_all();
     }
-    if (ret < -1 || ret > 7)
-        ret = 0;
 
-    return ret;
+    bool run_one()
+    {
+        Task task;
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+            if (tasks.empty())
+                return false;
+            task = tasks.front();
+            tasks.pop_front();
+        }
+        finish(task);
+        return true;
+    }
+
+    void worker_loop()
+    {
+        for (;;)
+        {
+            Task task;
+            {
+                std::unique_lock<std::mutex> lock(mutex);
+                cv.wait(lock, [&]
+                        { return !tasks.empty(); });
+                task = tasks.front();
+                tasks.pop_front();
+            }
+            finish(task);
+        }
+    }
+};
+
+static WorkerPool &worker_pool()
+{
+    // never destroyed: workers stay parked until the process exits
+    static WorkerPool *pool = new WorkerPool(
+        std::max(1u, std::thread::hardware_concurrency()) - 1);
+    return *pool;
+}
+
+extern "C" void vm_run_batch(
+    const VM_Program **programs, const int *team_ids, const int *scores,
+    unsigned int **buffers, const int *fork_counts, int team_count,
+    VM_Character *characters, unsigned int *selfbufs,
+    const int *slots, int player_count,
+    const VM_Chest *chests, const int *chest_slots, int chest_count,
+    unsigned char *map,
+    unsigned int max_instructions,
+    int *opcodes,
+    int *statuses,
+    unsigned int *steps,
+    unsigned long long **hits,
+    unsigned long long *nanos)
+{
+    std::vector<int> first_fork(team_count);
+    for (int t = 0, offset = 0; t < team_count; ++t)
+    {
+        first_fork[t] = offset;
+        offset += fork_counts[t];
+    }
+
+    // built once per turn and shared by every fork
+    TurnIndex index(characters, slots, player_count, chests, chest_slots, chest_count);
+
+    worker_pool().run(team_count, [&](int t)
+                      {
+        unsigned int *buffer = buffers[t];
+        unsigned long long *team_hits = hits ? hits[t] : nullptr;
+        for (int i = first_fork[t]; i < first_fork[t] + fork_counts[t]; ++i)
+        {
+            unsigned int *selfbuf = selfbufs + (size_t)slots[i] * SELF_SIZE;
+            memset(buffer + TMP_OFFSET, 0, TMP_SIZE * sizeof(unsigned int));
+            memcpy(buffer + SELF_OFFSET, selfbuf, SELF_SIZE * sizeof(unsigned int));
+            std::chrono::steady_clock::time_point start_time;
+            if (nanos)
+                start_time = std::chrono::steady_clock::now();
+            if (programs[t])
+                opcodes[i] = run_program(*programs[t], team_ids[t], buffer, index, map, scores[t], &characters[slots[i]],
+                                         max_instructions, statuses ? &statuses[i] : nullptr,
+                                         steps ? &steps[i] : nullptr, team_hits);
+            else
+            {
+                opcodes[i] = 0;
+                if (statuses)
+                    statuses[i] = VM_STATUS_OK;
+                if (steps)
+                    steps[i] = 0;
+            }
+            if (nanos)
+                nanos[i] = std::chrono::duration_cast<std::chrono::nanoseconds>(
+                               std::chrono::steady_clock::now() - start_time)
+                               .count();
+            memcpy(selfbuf, buffer + SELF_OFFSET, SELF_SIZE * sizeof(unsigned int));
+        } });
 }
@@ -51,6 +51,13 @@ enum {
 /* opcode 0xxxxxxx -> mem */
 #define CONST_INST ((unsigned char)0x80)
 
+/* how a single fork run ended */
+enum {
+    VM_STATUS_OK = 0,            // ret executed, script ended or division by zero (-1)
+    VM_STATUS_TIMEOUT,           // instruction budget or wall-clock limit exhausted
+    VM_STATUS_FAULT,             // out-of-bounds memory access
+};
+
 struct Instruction{
     unsigned char opcode;
     unsigned char arg1;
@@ -58,11 +65,76 @@ struct Instruction{
     unsigned int arg2;
 };
 
+typedef struct VM_Program VM_Program;
+
+/*
+ * max_instructions: per-fork instruction budget for one run, a fork that
+ * exhausts it returns 0. 0 disables the budget and leaves only the coarse
+ * 250 ms wall-clock guard.
+ */
+
 bool vm_parse_script(
     const char script[],
     int *error_line
 );
 
+VM_Program* vm_compile(
+    const char script[],
+    int *error_line
+);
+
+int vm_run_compiled(
+    const VM_Program* program,
+    int team_id,
+    unsigned int* buffer,
+    VM_Character** players, int player_count,
+    VM_Chest** chests, int chest_count,
+    unsigned char* map,
+    int scores, VM_Character* self,
+    unsigned int max_instructions
+);
+
+void vm_free(VM_Program* program);
+
+/*
+ * Number of ops in a compiled program, and the 1-based source line of each
+ * (0 for the end of the script) copied into lines[0..size). Optimized ops
+ * report the line of the first instruction they stand for.
+ */
+unsigned int vm_program_size(const VM_Program* program);
+
+void vm_program_lines(const VM_Program* program, unsigned int* lines);
+
+/*
+ * Run every fork of every team for one turn.
+ * characters and selfbufs are entity store columns indexed by slot, slot s has
+ * 8 words (VM_Buffer.self) of self memory at selfbufs + s * 8. slots[i] is the
+ * i-th character to run and chest_slots[i] the i-th chest of chests; the order
+ * also breaks ties in locate_nearest_k_*.
+ * Team t owns fork_counts[t] consecutive entries of slots, in team order.
+ * Forks of one team run in order on the team's buffer; teams run on the worker pool.
+ * opcodes[i] receives the result of the i-th character, and if they are not NULL,
+ * statuses[i] its VM_STATUS_* and steps[i] the number of instructions it executed.
+ * Profiling: if hits is not NULL and hits[t] is not NULL, team t runs on the
+ * counting interpreter and hits[t][pc] (vm_program_size(programs[t]) counters)
+ * is incremented for every op it executes, across all its forks. If nanos is
+ * not NULL, nanos[i] receives the wall-clock time of the i-th character's run.
+ */
+void vm_run_batch(
+    const VM_Program** programs, const int* team_ids, const int* scores,
+    unsigned int** buffers, const int* fork_counts, int team_count,
+    VM_Character* characters, unsigned int* selfbufs,
+    const int* slots, int player_count,
+    const VM_Chest* chests, const int* chest_slots, int chest_count,
+    unsigned char* map,
+    unsigned int max_instructions,
+    int* opcodes,
+    int* statuses,
+    unsigned int* steps,
+    unsigned long long** hits,
+    unsigned long long* nanos
+);
+
 int vm_run(
     int team_id,
     const char script_cstr[],
@@ -70,7 +142,8 @@ int vm_run(
     VM_Character** players, int player_count,
     VM_Chest** chests, int chest_count,
     unsigned char* map,
-    int scores, VM_Character* self
+    int scores, VM_Character* self,
+    unsigned int max_instructions
 );
 
 #ifdef __cplusplus